@@ -1,23 +1,106 @@
 import subprocess
-# import multiprocessing
-import time
+import bisect
+import collections
+import importlib
 import re
 import argparse
+import logging
 import sys
 import os
+import ibdiag_metrics
+
+log = logging.getLogger("ibdiag")
+LOG_LEVELS = ["debug", "info", "warning", "error"]
+
+QUOTED_RE = re.compile(r'\"(.*?)\"')
+SWITCH_NAME_RE = re.compile(r'\"(.+?)\"')
+HEX_RE = re.compile('(0x[0-9,a-f,A-F]*)')
+SPACES_RE = re.compile(' +')
+BLANKS_RE = re.compile('[ \t]+')
+EMPTY_BRACKETS_RE = re.compile(r'\[ \]|\( \)')
+ROUTE_HEADER_RE = re.compile('switch Lid ([0-9]*)')
+# regex syntax in a host name pattern
+REGEX_SPECIAL_RE = re.compile(r'[.\^$*+?{}\[\]\\|()]')
+LST_NODE_RE = re.compile(r'\{\s*(\w+)\s+Ports:(\w+)\s+SystemGUID:(\w+)\s+NodeGUID:(\w+)\s+PortGUID:(\w+)'
+                         r'.*?\{(.*?)\}\s+LID:(\w+)\s+PN:(\w+)\s*\}')
+LST_LINK_RE = re.compile(r'PHY=(\S+)\s+LOG=(\S+)\s+SPD=(\S+)')
+FDBS_HEADER_RE = re.compile(r'Switch\s+(0x[0-9a-fA-F]+)')
+# ibdiagnet2.lst SPD= values -> the lane rate iblinkinfo prints
+LST_SPEEDS = {"2.5": "2.5 Gbps", "5": "5.0 Gbps", "10": "10.0 Gbps", "FDR10": "10.3125 Gbps", "14": "14.0625 Gbps",
+              "25": "25.78125 Gbps", "50": "53.125 Gbps", "100": "106.25 Gbps"}
+
+class LazyModule:
+    # stands in for a heavy module (numpy) at the top of a module that must stay cheap to import: the
+    # module is imported on the first attribute access, and each attribute is kept once looked up
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self._name), attr)
+        setattr(self, attr, value)
+        return value
 
 def get_arg_parser(description="ibdiag: Generate IB connection data"):
+    import ibdiag_snapshot
     argparser = argparse.ArgumentParser(description=description, add_help=True)
     argparser.add_argument("--switch_info_file", dest="switch_info_file", default = None, 
-        help="file containing the results of the 'ibswitches' command")
+        help="file containing the results of the 'ibswitches' command, or an ibdiagnet2.lst file")
     argparser.add_argument("--link_info_file", dest="link_info_file", default = None, 
-        help="file containing the results of the 'iblinkinfo --switches-only -l' command")
+        help="file containing the results of the 'iblinkinfo --switches-only -l' command, or an ibdiagnet2.lst file")
     argparser.add_argument("--route_info_file", dest="route_info_file", default = None, 
-        help="file containing the concatenated results of the 'ibroute <switch lid>' command, for all switches'")
+        help="file containing the concatenated results of the 'ibroute <switch lid>' command, for all switches', or an "
+             "ibdiagnet2.fdbs file")
     argparser.add_argument("--skip_routing", dest="skip_routing", action='store_true',
         help="Skip gathering/calculating routing information")
+    argparser.add_argument("--route_jobs", dest="route_jobs", type=int, default=16,
+        help="number of concurrent 'ibroute' commands when collecting routing information from the fabric")
+    argparser.add_argument("--route_timeout", dest="route_timeout", type=float, default=60,
+        help="seconds to wait for a single switch's 'ibroute' command before giving up on it")
+    argparser.add_argument("--route_retries", dest="route_retries", type=int, default=2,
+        help="number of times a failed or timed out 'ibroute' command is retried")
+    argparser.add_argument("--route_contention", dest="route_contention", action='store_true',
+        help="report how many host-to-host routes share each ISL, for routes from --starthost to --otherhosts")
+    argparser.add_argument("--starthost", dest="starthost", default=None,
+        help="comma separated list of host name prefixes routes start from (default: all hosts)")
+    argparser.add_argument("--otherhosts", dest="otherhosts", default=None,
+        help="comma separated list of host name prefixes routes go to (default: all hosts)")
+    argparser.add_argument("--contention_top", dest="contention_top", type=int, default=20,
+        help="number of most loaded ISLs listed in the route contention report")
+    argparser.add_argument("--contention_file", dest="contention_file", default=None,
+        help="file name for a CSV file with the route count of every ISL")
+    argparser.add_argument("--route_balance", dest="route_balance", action='store_true',
+        help="report how evenly each switch spreads the endpoint LIDs it routes over its ISL ports")
+    argparser.add_argument("--balance_tolerance", dest="balance_tolerance", type=float, default=0.25,
+        help="fraction the busiest port of a port group may be over the group's mean before it is reported")
+    argparser.add_argument("--balance_top", dest="balance_top", type=int, default=20,
+        help="number of most imbalanced port groups listed in the route balance report")
+    argparser.add_argument("--no_cache", "--no-cache", dest="no_cache", action='store_true',
+        help="always parse the input files; don't read or write the parsed fabric snapshot cache")
+    argparser.add_argument("--cache_dir", dest="cache_dir", default=None,
+        help="directory for cached parsed fabric snapshots (default: $XDG_CACHE_HOME/ibdiag_graph)")
+    argparser.add_argument("--cache_max_mb", dest="cache_max_mb", type=int,
+        default=ibdiag_snapshot.DEFAULT_CACHE_MAX_MB,
+        help="size limit in MB for the snapshot cache; least recently used snapshots are removed first")
+    argparser.add_argument("--save_snapshot", dest="save_snapshot", default=None,
+        help="file name to save the parsed fabric to, for later use with ibdiag_diff")
+    argparser.add_argument("--metrics_file", dest="metrics_file", default=None,
+        help="file name for per-phase wall time, CPU time, peak RSS and item counts in JSON format")
+    argparser.add_argument("--profile", dest="profile", default=None,
+        help="comma separated list of phases (e.g. 'routes,xlsx,savefig', or 'all') to run under cProfile; a "
+             "phase inside one already profiled is part of that profile")
+    argparser.add_argument("--profile_dir", dest="profile_dir", default=".",
+        help="directory for the profile-<phase>.prof files written for --profile")
+    argparser.add_argument("--log_level", dest="log_level", choices=LOG_LEVELS, default="info",
+        help="console verbosity; 'debug' adds the per-switch/endpoint/host listings and per-switch progress")
+    argparser.add_argument("--report_file", dest="report_file", default=None,
+        help="file name for the full per-switch/endpoint/host listing, whatever the log level")
     return argparser
 
+def configure_logging(parsed_args, stream=None):
+    # plain messages on stdout, as the tools always printed them; only the level is new
+    logging.basicConfig(level=getattr(logging, parsed_args.log_level.upper()), format="%(message)s",
+                        stream=stream or sys.stdout, force=True)
+
 def get_args():
     argparser = get_arg_parser()
     a = argparser.parse_args()
@@ -29,13 +112,68 @@ def run_cmd(cmd_args_list):
         proc = subprocess.Popen(cmd_args_list, stdout=subprocess.PIPE, universal_newlines=True)
         output = proc.communicate()[0]
     except subprocess.SubprocessError as exc:
-        print(f"Error running {cmd_args_list}: {exc}")
+        log.error(f"Error running {cmd_args_list}: {exc}")
     except FileNotFoundError as exc:
-        print(exc)
-        print(f"Error running {cmd_args_list}; please verify that {cmd_args_list[0]} is installed and in $PATH")
+        log.error(exc)
+        log.error(f"Error running {cmd_args_list}; please verify that {cmd_args_list[0]} is installed and in $PATH")
         exit(1)
     return output
 
+def iter_cmd_lines(cmd_args_list):
+    # yields the command's stdout line by line while it is still running
+    try:
+        proc = subprocess.Popen(cmd_args_list, stdout=subprocess.PIPE, universal_newlines=True)
+    except FileNotFoundError as exc:
+        log.error(exc)
+        log.error(f"Error running {cmd_args_list}; please verify that {cmd_args_list[0]} is installed and in $PATH")
+        exit(1)
+    with proc:
+        yield from proc.stdout
+
+def iter_input_lines(input_file, cmd_args_list):
+    # lines of input_file when it exists, otherwise of the command's output - never the whole input at once
+    if input_file is not None and os.path.isfile(input_file):
+        with open(input_file, 'r') as infile:
+            yield from infile
+    else:
+        yield from iter_cmd_lines(cmd_args_list)
+
+def run_cmd_with_timeout(cmd_args_list, timeout, retries=0):
+    # returns None if the command never completes successfully; FileNotFoundError is left to the caller
+    for attempt in range(1, retries + 2):
+        try:
+            proc = subprocess.run(cmd_args_list, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                  universal_newlines=True, timeout=timeout)
+            if proc.returncode == 0:
+                return proc.stdout
+            log.warning(f"Error running {cmd_args_list}: exit status {proc.returncode} (attempt {attempt})")
+        except subprocess.TimeoutExpired:
+            log.warning(f"Error running {cmd_args_list}: timed out after {timeout} seconds (attempt {attempt})")
+        except subprocess.SubprocessError as exc:
+            log.warning(f"Error running {cmd_args_list}: {exc} (attempt {attempt})")
+    return None
+
+def get_ibroute_cmd(slid):
+    return ['ibroute', "-t", "15", "-n", f"{slid}"]
+
+def collect_switch_routes(switch_lids, jobs=16, timeout=60, retries=2):
+    # yields (switch lid, ibroute output) in completion order, so a hung switch doesn't hold up the others;
+    # output is None for switches that failed on every attempt
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = {pool.submit(run_cmd_with_timeout, get_ibroute_cmd(slid), timeout, retries): slid
+                   for slid in switch_lids}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                output = future.result()
+            except FileNotFoundError as exc:
+                log.error(exc)
+                log.error(f"Error running ibroute; please verify that ibroute is installed and in $PATH")
+                for f in futures:
+                    f.cancel()
+                exit(1)
+            yield futures[future], output
+
 
 class IBLink:
     def __init__(self, src, srcport, dst, dstport, speed):
@@ -72,16 +210,75 @@ class IBHost(_IBBase):
         return result
 
 
+class LinearForwardingTable:
+    # a switch's LID -> exit port table, one byte per LID up to the highest routed LID.  Reads like the
+    # dict it replaces; NO_ROUTE (255 - never a valid IB port number) marks LIDs without a route.
+    NO_ROUTE = 255
+
+    def __init__(self, ports=None):
+        self.ports = bytearray() if ports is None else bytearray(ports)
+        self._count = len(self.ports) - self.ports.count(self.NO_ROUTE)
+        self._by_port = None
+
+    def __setitem__(self, lid, port):
+        if lid >= len(self.ports):
+            self.ports.extend(b'\xff' * (lid + 1 - len(self.ports)))
+        if self.ports[lid] == self.NO_ROUTE:
+            self._count += 1
+        self.ports[lid] = port
+        self._by_port = None
+
+    def __getitem__(self, lid):
+        if 0 <= lid < len(self.ports) and self.ports[lid] != self.NO_ROUTE:
+            return self.ports[lid]
+        raise KeyError(lid)
+
+    def get(self, lid, default=None):
+        if 0 <= lid < len(self.ports) and self.ports[lid] != self.NO_ROUTE:
+            return self.ports[lid]
+        return default
+
+    def __contains__(self, lid):
+        return 0 <= lid < len(self.ports) and self.ports[lid] != self.NO_ROUTE
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [lid for lid, port in enumerate(self.ports) if port != self.NO_ROUTE]
+
+    def items(self):
+        return [(lid, port) for lid, port in enumerate(self.ports) if port != self.NO_ROUTE]
+
+    def by_port(self):
+        # port -> list of routed LIDs, built on first use and kept until the table changes
+        if self._by_port is None:
+            self._by_port = {}
+            for lid, port in enumerate(self.ports):
+                if port != self.NO_ROUTE:
+                    if port not in self._by_port:
+                        self._by_port[port] = [lid]
+                    else:
+                        self._by_port[port].append(lid)
+        return self._by_port
+
+
 class IBSwitch(_IBBase):
     def __init__(self, lid, name, guid, portcount):
         self.portcount = portcount
-        self.routes = {}
-        self.routes_by_port = {}
+        self.routes = LinearForwardingTable()
         self.connections = {}
         self.isls = {}
         self.endpoints = {}
         _IBBase.__init__(self, lid, name, guid)
 
+    @property
+    def routes_by_port(self):
+        return self.routes.by_port()
+
     def __str__(self):
         result = _IBBase.__str__(self) + " " + self.portcount + " ports>"
         return result
@@ -121,24 +318,19 @@ def short_speed_info(speedinfo):
     
 def get_line_quoted_substrings(line):
     # assumes substring is double quoted
-    return re.findall('\"(.*?)\"', line)
+    return QUOTED_RE.findall(line)
 
 def get_hex_val(line):
-    hexpattern = '(0x[0-9,a-f,A-F]*)'
-    return re.search(hexpattern, line)
+    return HEX_RE.search(line)
 
 def get_hex_vals(line):
-    hexpattern = '(0x[0-9,a-f,A-F]*)'
-    return re.findall(hexpattern, line)
+    return HEX_RE.findall(line)
 
 def cleanup_linkinfo_string(string):
-    string = string.strip()
-    string = re.sub(' +', ' ', string)
-    string = re.sub(r'[\[] ]', '', string)
-    string = re.sub(r'[(] [)]', '', string).strip()
-    return string
+    string = SPACES_RE.sub(' ', string.strip())
+    return EMPTY_BRACKETS_RE.sub('', string).strip()
 
-def parse_linkinfo_line(line, switches, endpoints):
+def split_linkinfo_line(line):
     # linkinfo line format:
     # srcguid(hex) "   srcname(possibly space padded)" srclid srcport[  ]  \
     # ==( < speed and port info >)==>  dstguid(hex) dstlid dstport[  ] "   dstname" ( )
@@ -155,42 +347,120 @@ def parse_linkinfo_line(line, switches, endpoints):
     src_guid, src = src.split(' \"')
     src_name, src = src.strip().split('\" ')
     src_lid, src_port = src.split(" ")
-    src_lid = int(src_lid)
     dst, dst_name = dst.split(' \"')
     dst_name, _ = dst_name.split('\"')
     dst_guid, dst_lid, dst_port = dst.split(" ")
-    dst_lid = int(dst_lid)
+    return src_guid, src_name, int(src_lid), int(src_port), dst_guid, int(dst_lid), int(dst_port), dst_name, speedinfo
+
+def add_link(link, switches, endpoints):
+    # link is a split_linkinfo_line() tuple
+    _, _, src_lid, src_port, dst_guid, dst_lid, dst_port, dst_name, speedinfo = link
     if src_lid in switches:
         if dst_lid in switches:
-            switches[src_lid].connections[int(src_port)] = switches[dst_lid]
-            switches[src_lid].isls[int(src_port)] = (switches[dst_lid], int(dst_port), speedinfo)
-            switches[dst_lid].connections[int(dst_port)] = switches[src_lid]
-            switches[dst_lid].isls[int(dst_port)] = (switches[src_lid], int(src_port), speedinfo)
+            switches[src_lid].connections[src_port] = switches[dst_lid]
+            switches[src_lid].isls[src_port] = (switches[dst_lid], dst_port, speedinfo)
+            switches[dst_lid].connections[dst_port] = switches[src_lid]
+            switches[dst_lid].isls[dst_port] = (switches[src_lid], src_port, speedinfo)
         else:
-            endpoint = IBHost(dst_lid, dst_name, dst_guid, switches[src_lid], int(src_port), speedinfo)
-            switches[src_lid].connections[int(src_port)] = endpoint
-            switches[src_lid].endpoints[int(src_port)] = endpoint
+            endpoint = IBHost(dst_lid, dst_name, dst_guid, switches[src_lid], src_port, speedinfo)
+            switches[src_lid].connections[src_port] = endpoint
+            switches[src_lid].endpoints[src_port] = endpoint
             endpoints[dst_lid] = endpoint
     else:
-        print(f" non-switch as source in parse_linkinfo_line {line}")
+        log.warning(f" non-switch as source in add_link {link}")
 
-def load_linkinfo_data(switches, link_info_file=None):
+def parse_linkinfo_line(line, switches, endpoints):
+    add_link(split_linkinfo_line(line), switches, endpoints)
+
+def iter_active_link_lines(lines):
+    for line in lines:
+        if line.startswith("0x") and "Active/ " in line:
+            yield line
+
+def parse_linkinfo_lines(switches, lines):
     endpoints = {}
-    if link_info_file is not None and os.path.isfile(link_info_file):
-        with open(link_info_file, 'r') as infile:
-            lines = infile.readlines()
-    else:
-        cmd = ['iblinkinfo', '--switches-only', '-l']
-        output = run_cmd(cmd)
-        lines = output.splitlines()
+    for line in iter_active_link_lines(lines):
+        parse_linkinfo_line(line, switches, endpoints)
+    return endpoints
+
+def normalize_guid(guid):
+    # "0002c903000a1b2c" or "0x2c903000a1b2c" -> "0x0002c903000a1b2c", as ibswitches and iblinkinfo print them
+    return f"0x{int(guid, 16):016x}"
+
+def is_lst_file(input_file):
+    return input_file is not None and input_file.endswith(".lst") and os.path.isfile(input_file)
+
+def is_fdbs_file(input_file):
+    return input_file is not None and input_file.endswith(".fdbs") and os.path.isfile(input_file)
+
+def get_input_format(input_file):
+    # the parser an input file is read with, which is chosen by its extension
+    if is_lst_file(input_file):
+        return "lst"
+    if is_fdbs_file(input_file):
+        return "fdbs"
+    return "text"
+
+def split_lst_line(line):
+    # ibdiagnet2.lst line format, one line per link, with Ports, LID and PN in hex:
+    # { SW Ports:28 SystemGUID:<hex> NodeGUID:<hex> PortGUID:<hex> VenID:.. DevID:.. Rev:.. {<name>} LID:0001 PN:0D } \
+    # { CA Ports:01 ... {<name>} LID:0009 PN:01 } PHY=4x LOG=ACT SPD=50
+    # returns (node, node, speedinfo, active) with each node (type, port count, guid, name, lid, port), or
+    # None for a line that isn't a link
+    nodes = LST_NODE_RE.findall(line)
+    link = LST_LINK_RE.search(line)
+    if len(nodes) != 2 or link is None:
+        return None
+    ends = []
+    for node_type, ports, _, node_guid, port_guid, name, lid, port in nodes:
+        guid = normalize_guid(node_guid if node_type == "SW" else port_guid)
+        ends.append((node_type, int(ports, 16), guid, name.strip(), int(lid, 16), int(port, 16)))
+    phy, state, speed = link.groups()
+    return ends[0], ends[1], f"{phy.upper()} {LST_SPEEDS.get(speed, speed + ' Gbps')}", state == "ACT"
+
+def iter_lst_links(lines):
     for line in lines:
-        if not re.search("Active/ ", line):
+        if line.startswith("{"):
+            link = split_lst_line(line)
+            if link is not None:
+                yield link
+
+def add_lst_switches(switches, link):
+    # the switches at either end of a link line, active or not, as ibswitches lists every switch the SM found
+    for node_type, ports, guid, name, lid, _ in link[:2]:
+        if node_type == "SW" and lid not in switches:
+            switches[lid] = IBSwitch(lid, switch_short_name(name), guid, str(ports))
+
+def get_lst_switches(lines):
+    result = {}
+    for link in iter_lst_links(lines):
+        add_lst_switches(result, link)
+    return result
+
+def parse_lst_lines(switches, lines):
+    # one pass over ibdiagnet2.lst: adds the switches of every line that aren't in switches yet, and every
+    # active link; returns the endpoints
+    endpoints = {}
+    for link in iter_lst_links(lines):
+        add_lst_switches(switches, link)
+        src, dst, speedinfo, active = link
+        if not active:
             continue
-        if not line.startswith("0x"):
+        if src[0] != "SW":
+            src, dst = dst, src
+        if src[0] != "SW":
             continue
-        parse_linkinfo_line(line, switches, endpoints)
+        add_link((src[2], src[3], src[4], src[5], dst[2], dst[4], dst[5], dst[3], speedinfo), switches, endpoints)
     return endpoints
 
+def get_linkinfo_cmd():
+    return ['iblinkinfo', '--switches-only', '-l']
+
+def load_linkinfo_data(switches, link_info_file=None):
+    if is_lst_file(link_info_file):
+        return parse_lst_lines(switches, iter_input_lines(link_info_file, None))
+    return parse_linkinfo_lines(switches, iter_input_lines(link_info_file, get_linkinfo_cmd()))
+
 def parse_route_line(line):
     # route file line format:
     # lid(hex) out-port ': (' <'Switch' | 'Channel Adapter' > 'portguid' guid(hex): <quoted name>')'
@@ -198,67 +468,114 @@ def parse_route_line(line):
     lid = int(vals[0], 16)
     return [lid, int(vals[1])]
 
-def compute_route_info(switches, route_info_file=None):
+def compute_route_info(switches, route_info_file=None, jobs=16, timeout=60, retries=2, switch_lids=None):
+    # switch_lids limits the collection to those switches, replacing their current routes; a switch keeps
+    # its current routes if they can't be collected.  Returns the lids of those switches.
+    if switch_lids is not None:
+        switch_lids = [slid for slid in switch_lids if slid in switches]
     if route_info_file is not None and os.path.isfile(route_info_file):
-        with open(route_info_file, 'r') as infile:
-            lines = infile.readlines()
-    else:
-        lines = []
-        for slid in switches.keys():
-            cmd = ['ibroute', "-t", "15", "-n", f"{slid}"]
-            output = run_cmd(cmd)
-            lines += output.splitlines()
+        lines = iter_input_lines(route_info_file, None)
+        if is_fdbs_file(route_info_file):
+            entries = iter_fdbs_route_entries(switches, lines)
+        else:
+            entries = iter_route_entries(lines)
+        if switch_lids is None:
+            for lid, dest_lid, port in entries:
+                switches[lid].routes[dest_lid] = port
+            return []
+        for slid in switch_lids:
+            switches[slid].routes = LinearForwardingTable()
+        wanted = set(switch_lids)
+        for lid, dest_lid, port in entries:
+            if lid in wanted:
+                switches[lid].routes[dest_lid] = port
+        return []
+    failed = []
+    for slid, output in collect_switch_routes(switches.keys() if switch_lids is None else switch_lids,
+                                              jobs, timeout, retries):
+        if output is None:
+            failed.append(slid)
+            continue
+        switches[slid].routes = LinearForwardingTable()
+        parse_route_lines(switches, output.splitlines())
+    if len(failed) > 0:
+        log.warning(f"*** Warning: no routing information collected for {len(failed)} switch(es): "
+              f"{', '.join(f'{switches[l].name} ({l})' for l in failed)}")
+    return failed
+
+def iter_route_entries(lines):
+    # yields (switch lid, destination lid, exit port) for every route line in concatenated ibroute output
     lid = -1
     for line in lines:
         if not line.startswith("0x"):
             if line.startswith("Unicast"):
-                tmp = re.search('switch Lid ([0-9]*)', line).group(1)
-                lid = int(tmp)
-                print(f"Getting routes for switch {lid}")
+                lid = int(ROUTE_HEADER_RE.search(line).group(1))
+                log.debug(f"Getting routes for switch {lid}")
             continue
-        route = parse_route_line(line)
-        switches[lid].routes[route[0]] = route[1]
-        if route[1] not in switches[lid].routes_by_port.keys():
-            switches[lid].routes_by_port[route[1]] = [route[0]]
-        else:
-            switches[lid].routes_by_port[route[1]].append(route[0])
+        dest_lid, port = parse_route_line(line)
+        yield lid, dest_lid, port
+
+def iter_fdbs_route_entries(switches, lines):
+    # the same for ibdiagnet2.fdbs, where each switch's table starts with a line naming its guid:
+    # osm_ucast_mgr_dump_ucast_routes: Switch 0x<guid>
+    # LID    : Port : Hops : Optimal
+    # 0x0001 : 017  : 00   : yes
+    # tables of switches that aren't in switches are skipped
+    switch_by_guid = dict((sw.guid, lid) for lid, sw in switches.items())
+    lid = None
+    for line in lines:
+        if not line.startswith("0x"):
+            header = FDBS_HEADER_RE.search(line)
+            if header is not None:
+                lid = switch_by_guid.get(normalize_guid(header.group(1)))
+                log.debug(f"Getting routes for switch {lid}")
+            continue
+        vals = line.split(":", 2)
+        if lid is None or len(vals) < 2 or not vals[1].strip().isdigit():
+            continue
+        yield lid, int(vals[0], 16), int(vals[1])
 
-def get_switches(switch_info_file=None):
-    if switch_info_file is not None and os.path.isfile(switch_info_file):
-        with open(switch_info_file, 'r') as infile:
-            lines = infile.readlines()
-    else:
-        cmd = ['ibswitches']
-        output = run_cmd(cmd)
-        lines = output.splitlines()
+def parse_route_lines(switches, lines):
+    for lid, dest_lid, port in iter_route_entries(lines):
+        switches[lid].routes[dest_lid] = port
 
+def get_switches(switch_info_file=None):
+    if is_lst_file(switch_info_file):
+        return get_lst_switches(iter_input_lines(switch_info_file, None))
     result = {}
-    for line in lines:
+    for line in iter_input_lines(switch_info_file, ['ibswitches']):
         if not line.startswith("Switch"):
             continue
-        line = re.sub(' +', ' ', line)
-        line = re.sub('\t', ' ', line)
-        quoted_strings = re.findall(r'\"(.+?)\"', line)
-        name = quoted_strings[0]
-        if name is list:
-            name = name[0]
-        line = re.sub(r'\"(.+?)\"', 'nreplaced', line)
+        line = BLANKS_RE.sub(' ', line)
+        name = SWITCH_NAME_RE.search(line).group(1)
+        line = SWITCH_NAME_RE.sub('nreplaced', line)
         line_items = line.split(" ")
         _, _, guid, _, portcount, _, _, _, _, _, lid, _, _ = line_items
         lid = int(lid)
         result[lid] = IBSwitch(lid, switch_short_name(name), guid, portcount)
     return result
 
-def get_route(lid1, lid2, endports):
+def get_route(lid1, lid2, endports, max_hops=64):
+    # raises ValueError for a route that can't be followed; ibdiag_validate reports all of them at once
     next_switch = endports[lid1].switch
     lid1_port = endports[lid1].switch_port
     end_switch = endports[lid2].switch
-    next_port = next_switch.routes[lid2]
+    next_port = next_switch.routes.get(lid2)
     route = [(lid1, lid1_port), (next_switch.lid, next_port)]
     while next_switch != end_switch:
-        next_switch = next_switch.connections[next_port]
-        next_port = next_switch.routes[lid2]
+        if next_port is None:
+            raise ValueError(f"route from lid {lid1} to lid {lid2}: no route on switch {next_switch.name}")
+        if next_port not in next_switch.isls:
+            raise ValueError(f"route from lid {lid1} to lid {lid2}: switch {next_switch.name} port {next_port} "
+                             f"is not an ISL")
+        if len(route) > max_hops:
+            raise ValueError(f"route from lid {lid1} to lid {lid2}: not at the destination after {max_hops} "
+                             f"switches (forwarding loop)")
+        next_switch = next_switch.isls[next_port][0]
+        next_port = next_switch.routes.get(lid2)
         route.append((next_switch.lid, next_port))
+    if next_port is None:
+        raise ValueError(f"route from lid {lid1} to lid {lid2}: no route on switch {next_switch.name}")
     route.append(lid2)
     return route
 
@@ -267,78 +584,151 @@ def get_portstripped_hostname(hostname):
     return stripped_name
 
 def get_hostnames_list(all_switches, strip_port_name=True):
-    resultlist = []
-    for swlid, sw in all_switches:
-        for swport, endpoint in sw.endpoints:
+    resultlist = {}     # dict rather than list: insertion ordered, with O(1) duplicate checks
+    for swlid, sw in all_switches.items():
+        for swport, endpoint in sw.endpoints.items():
             if strip_port_name:
-                stripped_name = endpoint.name.split(" ", 1)[0]
+                stripped_name = get_portstripped_hostname(endpoint.name)
             else:
                 stripped_name = endpoint.name
-            if stripped_name not in resultlist:
-                resultlist.append(stripped_name)
-    return resultlist
+            resultlist[stripped_name] = None
+    return list(resultlist)
 
 def get_stripped_host_by_name_dict(all_switches):
     resultdict = {}
-    for swlid, sw in all_switches:
-        for swport, endpoint in sw.endpoints:
-            host_name, port_name = endpoint.name.split(" ", 1)
+    for swlid, sw in all_switches.items():
+        for swport, endpoint in sw.endpoints.items():
+            host_name = get_portstripped_hostname(endpoint.name)
             if host_name not in resultdict:
                 resultdict[host_name] = [endpoint]
             else:
                 resultdict[host_name].append(endpoint)
     return resultdict
 
-def get_hostinfo_tables(all_endports):
-    host_names_only = []
+class HostIndex:
+    # port-consolidated host name -> LIDs (a dict, in discovery order), plus the names sorted for prefix
+    # lookups.  Pattern expansions are cached, as the same patterns tend to be expanded more than once.
+    def __init__(self, host_lids):
+        self.host_lids = host_lids
+        self.names = list(host_lids)
+        self.sorted_names = sorted(host_lids)
+        self.position = dict((name, i) for i, name in enumerate(self.names))
+        self.cache = {}
+
+    def __contains__(self, name):
+        return name in self.host_lids
+
+    def __len__(self):
+        return len(self.names)
+
+    def in_order(self, names):
+        # names deduplicated, in discovery order
+        return sorted(set(names), key=self.position.__getitem__)
+
+    def with_prefix(self, prefix):
+        # the names in the sorted list that start with prefix are one run, found by bisection
+        i = bisect.bisect_left(self.sorted_names, prefix)
+        result = []
+        while i < len(self.sorted_names) and self.sorted_names[i].startswith(prefix):
+            result.append(self.sorted_names[i])
+            i += 1
+        return result
+
+    def expand_prefixes(self, prefixes):
+        key = ('prefix', tuple(prefixes))
+        if key not in self.cache:
+            matches = []
+            for prefix in prefixes:
+                matches.extend(self.with_prefix(prefix))
+            self.cache[key] = self.in_order(matches)
+        return self.cache[key]
+
+    def match_patterns(self, patterns, anchored_end=True):
+        # names matching any of the regular expressions (from the start of the name; to its end too if
+        # anchored_end).  Each pattern is first looked up literally, as a name or a name prefix, so FQDN
+        # names like 'cn3.2' need no escaping; the patterns with regex syntax and no literal match are
+        # combined into one expression and matched in a single pass over the names.
+        key = ('regex', tuple(patterns), anchored_end)
+        if key not in self.cache:
+            matches, regexes = [], []
+            for pattern in patterns:
+                if anchored_end:
+                    literal = [pattern] if pattern in self.host_lids else []
+                else:
+                    literal = self.with_prefix(pattern)
+                if len(literal) > 0:
+                    matches.extend(literal)
+                elif REGEX_SPECIAL_RE.search(pattern) is not None:
+                    regexes.append(pattern)
+            if len(regexes) > 0:
+                regex = re.compile("(?:" + "|".join(f"(?:{r})" for r in regexes) + ")" + ("$" if anchored_end else ""))
+                matches.extend(name for name in self.names if regex.match(name))
+            self.cache[key] = self.in_order(matches)
+        return self.cache[key]
+
+def get_host_index(all_endports):
     host_lids = {}
-    for k, v in all_endports.items():
-        end_lid = k
-        host_name, port_name = v.name.split(" ", 1)
-        if host_name not in host_names_only:
-            host_names_only.append(host_name)
+    for end_lid, v in all_endports.items():
+        host_name = get_portstripped_hostname(v.name)
         if host_name not in host_lids:
             host_lids[host_name] = [end_lid]
         else:
             host_lids[host_name].append(end_lid)
-    return host_names_only, host_lids
+    return HostIndex(host_lids)
+
+def get_hostinfo_tables(all_endports):
+    host_index = get_host_index(all_endports)
+    return host_index.names, host_index.host_lids
 
 def subroute_str(subroute, all_switches):
     ((s1, p1), (s2, p2)) = subroute
     return f"{all_switches[s1].name}({p1}) --> {all_switches[s2].name}({p2})"
 
 def compute_subroutes(host1_lids, host2_lids, all_endports, all_switches):
-    all_subroutes = {}
+    # per-pair version, fine for a handful of hosts; compute_isl_contention scales to all-to-all
+    all_subroutes = collections.defaultdict(set)
     for l1 in host1_lids:
         for l2 in host2_lids:
+            if l1 == l2:
+                continue
             route_forward = get_route(l1, l2, all_endports)
-            pairs_f = list(zip(route_forward[1:-1], route_forward[2:-1]))
-            # print(f"route from {l1} to {l2}: {route_forward}, subroute count: {len(all_subroutes)}")
-            for subroute in pairs_f:
-                subroute_s = subroute_str(subroute, all_switches)
-                if subroute not in all_subroutes:
-                    print(f"    New subroute {subroute_s}, in route from {l1} to {l2}; unique subroute count: {len(all_subroutes)}")
-                    all_subroutes[subroute] = [(l1, l2)]
-                elif (l1, l2) not in all_subroutes[subroute]:
-                    # print(f"    shared subroute: {subroute_s} users: {all_subroutes[subroute]}")
-                    all_subroutes[subroute].append((l1, l2))
-                else:
-                    # print(f"   {subroute_s} already used - users: {all_subroutes[subroute]}    (from {l1})")
-                    # all_subroutes[subroute].append(l2)
-                    pass
+            for subroute in zip(route_forward[1:-1], route_forward[2:-1]):
+                all_subroutes[subroute].add((l1, l2))
     return all_subroutes
 
-def expand_hostnames(host, host_names_list=None):
-    if host_names_list is None:
-        host_names_list = get_hostnames_list(strip_port_name=True)
+def compute_isl_contention(host1_lids, host2_lids, all_endports, all_switches):
+    # returns (per-ISL route counts, trace results); counts are keyed by (switch lid, port) and
+    # cover both directions when the two host groups differ
+    import ibdiag_trace
+    tables = ibdiag_trace.FabricTables(all_switches, all_endports)
+    results = [ibdiag_trace.trace_all_pairs(tables, host1_lids, host2_lids)]
+    if set(host1_lids) != set(host2_lids):
+        results.append(ibdiag_trace.trace_all_pairs(tables, host2_lids, host1_lids))
+    isl_load = collections.Counter()
+    for sw in all_switches.values():
+        for p in sw.isls:
+            isl_load[(sw.lid, p)] = 0
+    for result in results:
+        for (slid, p), _, count in result.isl_usage_items():
+            isl_load[(slid, p)] += count
+    return isl_load, results
+
+def get_load_histogram(loads, bucket_count=10):
+    # [(low, high, number of ISLs with low <= load <= high), ...] over equal-width load ranges
+    if len(loads) == 0:
+        return []
+    top = max(loads)
+    width = max(1, -(-(top + 1) // bucket_count))
+    buckets = collections.Counter(load // width for load in loads)
+    return [(b * width, min(top, (b + 1) * width - 1), buckets[b]) for b in range(-(-(top + 1) // width))]
+
+def expand_hostnames(host, host_names_list):
+    # host: host name prefix(es); host_names_list: a HostIndex or a list of host names
+    if not isinstance(host_names_list, HostIndex):
+        host_names_list = HostIndex(dict.fromkeys(host_names_list, []))
     if not isinstance(host, list):
         host = [host]
-    result = []
-    for hostpattern in host:
-        for h in host_names_list:
-            if h.startswith(hostpattern):
-                result.append(h)
-    return result
+    return host_names_list.expand_prefixes(host)
 
 def get_all_host_lids(host_lids, hosts):
     result = []
@@ -347,36 +737,82 @@ def get_all_host_lids(host_lids, hosts):
             result.append(hl)
     return result
 
-def print_switch_information(all_switches):
+def print_switch_information(all_switches, out=None):
     for key, val in all_switches.items():
-        print(f"Switch {val} - {len(val.routes)} route entries.")
+        print(f"Switch {val} - {len(val.routes)} route entries.", file=out)
         print(f"    Connection count: {len(val.connections)}; "
-              f"{len(val.isls)} ISLs, {len(val.connections) - len(val.isls)} endpoints")
-        print(f"        ISLs for switch {val}:")
+              f"{len(val.isls)} ISLs, {len(val.connections) - len(val.isls)} endpoints", file=out)
+        print(f"        ISLs for switch {val}:", file=out)
         for p, (sw, swp, speed) in val.isls.items():
             print(f"            from port {p:3} to: port {swp:3} on switch {sw.name}"
-                  f" (lid {sw.lid:3} {sw.guid}) speed {speed}")
+                  f" (lid {sw.lid:3} {sw.guid}) speed {speed}", file=out)
             if p in val.routes_by_port.keys():
                 rs = [r for r in val.routes_by_port[p] if r not in all_switches.keys()]
-                print(f"                routes to endport lids: {rs}")
-        print(f"        Endpoints for switch {val}:")
+                print(f"                routes to endport lids: {rs}", file=out)
+        print(f"        Endpoints for switch {val}:", file=out)
         for p, val2 in val.connections.items():
             if val2.lid not in all_switches:
                 print(f"            port {p:3}: '{val2.name}'{' '.ljust(32 - len(val2.name))} "
-                      f"(lid {val2.lid:3} {val2.guid}) speed {val2.speed}")
-        print()
-
-def print_shared_subroutes(all_switches, all_subroutes, all_endports):
-    for subroute, used_by in all_subroutes.items():
-        if len(used_by) > 1:
-            (s1, p1), (s2, p2) = subroute
-            s1name = all_switches[s1].name
-            s2name = all_switches[s2].name
-            print(f"    {len(used_by)} routes use ISL from switch '{s1name}'({s1}) p{p1}"
-                  f" to switch '{s2name}'({s2}) p{p2}: ")
-            for s, d in used_by:
-                # print(f"            route '{all_endports[s].name}' -> '{all_endports[d].name}'")
-                pass
+                      f"(lid {val2.lid:3} {val2.guid}) speed {val2.speed}", file=out)
+        print(file=out)
+
+def print_isl_contention(all_switches, isl_load, results, top=20):
+    for result in results:
+        src_switches = len(set(result.src.tolist()))
+        print(f"    {result.pair_count()} routes traced ({len(result)} source switch/destination flows from "
+              f"{src_switches} switch(es)); status: {result.status_counts()}; switch hops: {result.hop_histogram()}")
+    loads = list(isl_load.values())
+    if len(loads) == 0:
+        print(f"    No ISLs found.")
+        return
+    used = [l for l in loads if l > 0]
+    print(f"    {len(loads)} ISL directions, {len(used)} used; routes per ISL: max {max(loads)}, "
+          f"mean {sum(loads) / len(loads):.1f}, mean of used {sum(used) / max(1, len(used)):.1f}")
+    print(f"    {min(top, len(loads))} most loaded ISLs:")
+    for (slid, p), load in isl_load.most_common(top):
+        dest_sw, dest_port, speed = all_switches[slid].isls[p]
+        print(f"        {load:8} routes: {all_switches[slid].name}({slid}) p{p} --> "
+              f"{dest_sw.name}({dest_sw.lid}) p{dest_port} ({short_speed_info(speed)})")
+    print(f"    ISL load histogram (routes per ISL: number of ISLs):")
+    histogram = get_load_histogram(loads)
+    biggest = max(count for _, _, count in histogram)
+    for low, high, count in histogram:
+        print(f"        {low:8} - {high:8}: {count:6} {'#' * (50 * count // biggest)}")
+
+def write_isl_contention_csv(all_switches, isl_load, filename):
+    with open(filename, 'w') as outfile:
+        outfile.write("switch,switch_lid,port,dest_switch,dest_lid,dest_port,speed,routes\n")
+        for (slid, p), load in sorted(isl_load.items()):
+            dest_sw, dest_port, speed = all_switches[slid].isls[p]
+            outfile.write(f'"{all_switches[slid].name}",{slid},{p},"{dest_sw.name}",{dest_sw.lid},{dest_port},'
+                          f'{short_speed_info(speed)},{load}\n')
+
+def do_route_contention(parsed_args, all_switches, all_endports, host_index):
+    print(f"\n--- Route contention: (computing between: {parsed_args.starthost or 'all hosts'} and "
+          f"{parsed_args.otherhosts or 'all hosts'})")
+    host1_exp = host_index.names
+    if parsed_args.starthost is not None:
+        host1_exp = expand_hostnames(parsed_args.starthost.split(","), host_index)
+    host2_exp = host_index.names
+    if parsed_args.otherhosts is not None:
+        host2_exp = expand_hostnames(parsed_args.otherhosts.split(","), host_index)
+    host_lids = host_index.host_lids
+    host1_lids = get_all_host_lids(host_lids, host1_exp)
+    host2_lids = get_all_host_lids(host_lids, host2_exp)
+    print_route_tracing_message(host1_lids, host1_exp, host2_lids, host2_exp, parsed_args)
+    if len(host1_lids) == 0 or len(host2_lids) == 0:
+        return
+    isl_load, results = compute_isl_contention(host1_lids, host2_lids, all_endports, all_switches)
+    print_isl_contention(all_switches, isl_load, results, parsed_args.contention_top)
+    if parsed_args.contention_file is not None:
+        write_isl_contention_csv(all_switches, isl_load, parsed_args.contention_file)
+        print(f"    Per-ISL route counts written to {parsed_args.contention_file}")
+
+def do_route_balance(parsed_args, all_switches, all_endports):
+    import ibdiag_balance
+    print()
+    balance = ibdiag_balance.get_route_balance(all_switches, all_endports)
+    ibdiag_balance.print_route_balance(balance, parsed_args.balance_tolerance, parsed_args.balance_top)
 
 def print_route_tracing_message(host1_lids, host1_exp, host2_lids, host2_exp, parsed_args):
     if len(host1_lids) == 0 or len(host2_lids) == 0:
@@ -384,57 +820,133 @@ def print_route_tracing_message(host1_lids, host1_exp, host2_lids, host2_exp, pa
               f" {parsed_args.otherhosts}:{host2_exp}"
               f"- not enough valid hosts found for route tracing.  Skipping.")
         return
-    print(f"\n    Computing routing usage between (expanded hosts) {host1_exp}\nand\n{host2_exp}")
+    print(f"\n    Computing routing usage between {len(host1_exp)} hosts ({len(host1_lids)} ports) and "
+          f"{len(host2_exp)} hosts ({len(host2_lids)} ports)")
     # print(f"        lids: {host1_lids} and {host2_lids}")
 
-def print_switches(all_switches):
-    print(f"--- Switches ({len(all_switches)} found): ")
+def print_switches(all_switches, out=None):
+    print(f"--- Switches ({len(all_switches)} found): ", file=out)
     for k, s in all_switches.items():
-        print(f"   {k:3}: {s}")
+        print(f"   {k:3}: {s}", file=out)
 
-def print_endports(all_endports):
-    print(f"--- Endpoints ({len(all_endports)} found):")
+def print_endports(all_endports, out=None):
+    print(f"--- Endpoints ({len(all_endports)} found):", file=out)
     for k, v in all_endports.items():
-        print(f"    '{v.name}'{' '.ljust(32-len(v.name))} lid {k:3} on switch {v.switch} port {v.switch_port}")
+        print(f"    '{v.name}'{' '.ljust(32-len(v.name))} lid {k:3} on switch {v.switch} port {v.switch_port}",
+              file=out)
 
-def do_diag_run(parsed_args):
-    all_switches = get_switches(parsed_args.switch_info_file)
-    print_switches(all_switches)
-    if not parsed_args.skip_routing:
-        compute_route_info(all_switches, parsed_args.route_info_file)
-    print(f"\n    Finding switch connections...\n")
-    all_endports = load_linkinfo_data(all_switches, parsed_args.link_info_file)
-    print_endports(all_endports)
-    print(f"\n--- Switch information:")
-    print_switch_information(all_switches)
-    host_names_only, host_lids = get_hostinfo_tables(all_endports)
-    print(f"--- Hosts:")
-    print(f"{len(host_lids)} port-consolidated hosts found (assumes hostname<space><portname> format for endport):")
+def print_hosts(host_lids, out=None):
+    print(f"--- Hosts:", file=out)
+    print(f"{len(host_lids)} port-consolidated hosts found (assumes hostname<space><portname> format for endport):",
+          file=out)
     for hname, lids in host_lids.items():
-        print(f"    {hname} {' '.ljust(32 - len(hname))} lids: {lids}")
-    # print(f"\n--- Route contention: (computing between: {parsed_args.starthost} and {parsed_args.otherhosts})")
-    # host1_exp = expand_hostnames(parsed_args.starthost, host_names_list=host_names_only)
-    # host1_lids = get_all_host_lids(host_lids, host1_exp)
-    # host2_exp = expand_hostnames(parsed_args.otherhosts, host_names_list=host_names_only)
-    # host2_lids = get_all_host_lids(host_lids, host2_exp)
-    # print_route_tracing_message(host1_lids, host1_exp, host2_lids, host2_exp, parsed_args)
-    # all_subroutes = compute_subroutes(host1_lids, host2_lids, all_endports, all_switches)
-    # print(f"\n    Finding and printing shared ISLs for routes...\n")
-    # print_shared_subroutes(all_switches, all_subroutes, all_endports)
-    # print(f"\n    Computing routing usage between (expanded hosts) {host1_exp} and {host2_exp}")
-    # print(f"\n        lids: {host2_lids} and {host1_lids}")
-    # all_subroutes = compute_subroutes(host2_lids, host1_lids, all_endports, all_switches)
-    # print(f"\n    Finding and printing shared ISLs for routes...\n")
-    # print_shared_subroutes(all_switches, all_subroutes, all_endports)
-    print("Done.")
+        print(f"    {hname} {' '.ljust(32 - len(hname))} lids: {lids}", file=out)
+
+def print_fabric_report(all_switches, all_endports, host_lids, out=None):
+    print_switches(all_switches, out)
+    print_endports(all_endports, out)
+    print(f"\n--- Switch information:", file=out)
+    print_switch_information(all_switches, out)
+    print_hosts(host_lids, out)
+
+def print_fabric_summary(all_switches, all_endports, host_lids):
+    isl_count = sum(len(sw.isls) for sw in all_switches.values())
+    route_count = sum(len(sw.routes) for sw in all_switches.values())
+    log.info(f"--- Fabric: {len(all_switches)} switches, {isl_count} ISL directions, {len(all_endports)} endpoints "
+             f"({len(host_lids)} port-consolidated hosts), {route_count} route entries")
+
+def get_input_source(input_file):
+    return "file" if input_file is not None and os.path.isfile(input_file) else "fabric"
+
+def load_fabric(parsed_args):
+    # an ibdiagnet2.lst file given for both the switches and the links is read once, for both
+    single_lst = (is_lst_file(parsed_args.switch_info_file) and
+                  parsed_args.link_info_file == parsed_args.switch_info_file)
+    with ibdiag_metrics.span("switches", source=get_input_source(parsed_args.switch_info_file)) as span:
+        if single_lst:
+            all_switches = {}
+            all_endports = parse_lst_lines(all_switches, iter_input_lines(parsed_args.switch_info_file, None))
+        else:
+            all_switches = get_switches(parsed_args.switch_info_file)
+        span.items = len(all_switches)
+    if not parsed_args.skip_routing:
+        with ibdiag_metrics.span("routes", source=get_input_source(parsed_args.route_info_file)) as span:
+            compute_route_info(all_switches, parsed_args.route_info_file, parsed_args.route_jobs,
+                               parsed_args.route_timeout, parsed_args.route_retries)
+            span.items = sum(len(sw.routes) for sw in all_switches.values())
+    if not single_lst:
+        log.info(f"\n    Finding switch connections...\n")
+        with ibdiag_metrics.span("links", source=get_input_source(parsed_args.link_info_file)) as span:
+            all_endports = load_linkinfo_data(all_switches, parsed_args.link_info_file)
+            span.items = len(all_endports)
+    return all_switches, all_endports
+
+def load_fabric_cached(parsed_args):
+    # parsing is skipped when a snapshot of the same input files is in the cache
+    import ibdiag_snapshot
+    cache_key = None
+    cache_dir = parsed_args.cache_dir or ibdiag_snapshot.get_default_cache_dir()
+    if not parsed_args.no_cache:
+        cache_key = ibdiag_snapshot.get_run_cache_key(parsed_args)
+    if cache_key is not None:
+        with ibdiag_metrics.span("cache_load"):
+            cached = ibdiag_snapshot.load_cached_fabric(cache_dir, cache_key)
+        if cached is not None:
+            log.info(f"Using cached fabric snapshot {ibdiag_snapshot.get_cache_file(cache_dir, cache_key)}")
+            return cached[0], cached[1]
+    all_switches, all_endports = load_fabric(parsed_args)
+    if cache_key is not None:
+        try:
+            with ibdiag_metrics.span("cache_store"):
+                ibdiag_snapshot.store_cached_fabric(cache_dir, cache_key, all_switches, all_endports,
+                                                    parsed_args.cache_max_mb * 1024 * 1024)
+        except OSError as exc:
+            log.warning(f"Unable to write fabric snapshot to cache directory {cache_dir}: {exc}")
+    return all_switches, all_endports
+
+def save_requested_snapshot(parsed_args, all_switches, all_endports):
+    if parsed_args.save_snapshot is not None:
+        import ibdiag_snapshot
+        ibdiag_snapshot.save_snapshot(parsed_args.save_snapshot, all_switches, all_endports)
+        log.info(f"Fabric snapshot saved to {parsed_args.save_snapshot}")
+
+def do_diag_run(parsed_args):
+    with ibdiag_metrics.span("collect") as span:
+        all_switches, all_endports = load_fabric_cached(parsed_args)
+        save_requested_snapshot(parsed_args, all_switches, all_endports)
+        span.items = len(all_switches) + len(all_endports)
+    with ibdiag_metrics.span("report"):
+        host_index = get_host_index(all_endports)
+        host_lids = host_index.host_lids
+        # the full listings are only built when someone is going to read them
+        if log.isEnabledFor(logging.DEBUG):
+            print_fabric_report(all_switches, all_endports, host_lids)
+        if parsed_args.report_file is not None:
+            with open(parsed_args.report_file, 'w') as outfile:
+                print_fabric_report(all_switches, all_endports, host_lids, outfile)
+            log.info(f"Fabric report written to {parsed_args.report_file}")
+        print_fabric_summary(all_switches, all_endports, host_lids)
+    if parsed_args.route_contention:
+        if parsed_args.skip_routing:
+            log.error(f"*** Error: --route_contention needs routing information; it can't be used with --skip_routing")
+        else:
+            with ibdiag_metrics.span("route_contention"):
+                do_route_contention(parsed_args, all_switches, all_endports, host_index)
+    if parsed_args.route_balance:
+        if parsed_args.skip_routing:
+            log.error(f"*** Error: --route_balance needs routing information; it can't be used with --skip_routing")
+        else:
+            with ibdiag_metrics.span("route_balance"):
+                do_route_balance(parsed_args, all_switches, all_endports)
+    log.info("Done.")
     return all_switches, all_endports
 
 def main():
-    time_a = time.time()
     args = get_args()
+    configure_logging(args)
+    ibdiag_metrics.configure(args)
     do_diag_run(args)
-    time_c = time.time()
-    print(f"run took: {time_c - time_a}")
+    ibdiag_metrics.finish()
 
 def add_argv_arg(arg, string=None):
     sys.argv.append(arg)
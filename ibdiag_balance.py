@@ -0,0 +1,148 @@
+import ibdiag
+import ibdiag_trace
+
+np = ibdiag.LazyModule("numpy")
+
+# Route balance: how evenly each switch spreads the endpoint LIDs it routes over its ISL ports.  The
+# ports are grouped by the switch they lead to (parallel links to one neighbor), and all ISL ports of a
+# switch form one more group - for a leaf switch, its uplinks.  The routed LID count of every (switch,
+# port) comes from one bincount over the switch x endpoint LID part of the forwarding tables; the group
+# statistics from bincounts and reduceat over the ISL ports sorted by group.
+
+MAX_PORTS = ibdiag_trace.MAX_PORTS
+ALL_ISLS = -1               # neighbor of the group of all a switch's ISL ports
+BALANCE_TOLERANCE = 0.25    # a group is out of balance when its busiest port is this much over the mean
+
+
+class RouteBalance:
+    # port_lids[s * MAX_PORTS + p]: endpoint lids routed out of port p of switch index s.  Per group g:
+    # switch[g], neighbor[g] (switch index or ALL_ISLS), ports[g], total[g] routed lids and the min,
+    # max, mean and stddev of its ports' counts; the group's channels are channels[starts[g]:starts[g + 1]]
+    def __init__(self, tables, port_lids, channels, starts, switch, neighbor, ports, total, minimum, maximum,
+                 mean, stddev):
+        self.tables = tables
+        self.port_lids = port_lids
+        self.channels = channels
+        self.starts = starts
+        self.switch = switch
+        self.neighbor = neighbor
+        self.ports = ports
+        self.total = total
+        self.minimum = minimum
+        self.maximum = maximum
+        self.mean = mean
+        self.stddev = stddev
+
+    def __len__(self):
+        return len(self.switch)
+
+    def imbalance(self):
+        # busiest port over the mean; 1 for a perfectly balanced (or unused) group
+        return np.where(self.mean > 0, self.maximum / np.maximum(self.mean, 1e-9), 1.0)
+
+    def uplink_groups(self):
+        # the all-ISL groups of the switches with endpoints (leaf switches), where they are the uplinks;
+        # on the other switches they mix links to leaves with different endpoint counts
+        has_endpoints = np.zeros(len(self.tables.switches), dtype=bool)
+        has_endpoints[self.tables.lid_switch[self.tables.endpoint_lids()]] = True
+        return (self.neighbor == ALL_ISLS) & has_endpoints[self.switch]
+
+    def out_of_balance(self, tolerance=BALANCE_TOLERANCE):
+        # neighbor and uplink groups of two or more ports whose busiest port is more than tolerance over
+        # the mean, and more than one lid over the least used port (integer counts can't be split more evenly)
+        return ((self.ports >= 2) & ((self.neighbor != ALL_ISLS) | self.uplink_groups())
+                & (self.maximum - self.minimum > 1) & (self.imbalance() > 1 + tolerance))
+
+    def outliers(self, tolerance=BALANCE_TOLERANCE):
+        # indexes of the groups out of balance, worst first
+        bad = np.flatnonzero(self.out_of_balance(tolerance))
+        return bad[np.argsort(-self.imbalance()[bad], kind='stable')]
+
+    def group_ports(self, g):
+        # [(port, routed lids), ...] of group g
+        channels = self.channels[self.starts[g]:self.starts[g + 1]]
+        return list(zip((channels % MAX_PORTS).tolist(), self.port_lids[channels].tolist()))
+
+    def group_str(self, g):
+        sw = self.tables.switches[self.switch[g]]
+        if self.neighbor[g] == ALL_ISLS:
+            return f"{sw.name}({sw.lid}) all ISLs"
+        dest = self.tables.switches[self.neighbor[g]]
+        return f"{sw.name}({sw.lid}) --> {dest.name}({dest.lid})"
+
+
+def compute_route_balance(tables, chunk_size=4096):
+    n = len(tables.switches)
+    lids = tables.endpoint_lids()
+    base = (np.arange(n, dtype=np.int64) * MAX_PORTS)[:, None]
+    port_lids = np.zeros(n * MAX_PORTS, dtype=np.int64)
+    for start in range(0, len(lids), chunk_size):
+        port = tables.lft[:, lids[start:start + chunk_size]]
+        port_lids += np.bincount((base + port).ravel(), minlength=n * MAX_PORTS)
+    channels = tables.isl_channels()
+    s = channels // MAX_PORTS
+    # group key switch * (n + 1) + neighbor, with n standing for all ISLs so that group sorts last
+    keys = np.concatenate([s * (n + 1) + tables.neighbor.ravel()[channels], s * (n + 1) + n])
+    order = np.argsort(keys, kind='stable')
+    keys, members = keys[order], np.concatenate([channels, channels])[order]
+    group_keys, starts, ports = np.unique(keys, return_index=True, return_counts=True)
+    group = np.repeat(np.arange(len(group_keys)), ports)
+    counts = port_lids[members]
+    total = np.bincount(group, weights=counts, minlength=len(group_keys)).astype(np.int64)
+    mean = total / np.maximum(ports, 1)
+    stddev = np.sqrt(np.bincount(group, weights=(counts - mean[group]) ** 2, minlength=len(group_keys))
+                     / np.maximum(ports, 1))
+    if len(group_keys) > 0:
+        minimum, maximum = np.minimum.reduceat(counts, starts), np.maximum.reduceat(counts, starts)
+    else:
+        minimum, maximum = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    neighbor = group_keys % (n + 1)
+    neighbor[neighbor == n] = ALL_ISLS
+    return RouteBalance(tables, port_lids, members, np.append(starts, len(members)), group_keys // (n + 1),
+                        neighbor, ports, total, minimum, maximum, mean, stddev)
+
+
+def get_route_balance(switches, endpoints):
+    return compute_route_balance(ibdiag_trace.FabricTables(switches, endpoints))
+
+
+def iter_balance_rows(balance, tolerance=BALANCE_TOLERANCE):
+    # (switch, neighbor switch or None for all ISLs, ports, routed lids, min, max, mean, stddev,
+    # max/mean, out of balance) per group, in switch order
+    imbalance = balance.imbalance()
+    out_of_balance = balance.out_of_balance(tolerance)
+    for g, (s, d) in enumerate(zip(balance.switch.tolist(), balance.neighbor.tolist())):
+        yield (balance.tables.switches[s], None if d == ALL_ISLS else balance.tables.switches[d],
+               int(balance.ports[g]), int(balance.total[g]), int(balance.minimum[g]), int(balance.maximum[g]),
+               float(balance.mean[g]), float(balance.stddev[g]), float(imbalance[g]), bool(out_of_balance[g]))
+
+
+def print_route_balance(balance, tolerance=BALANCE_TOLERANCE, top=20, max_ports=16):
+    tables = balance.tables
+    parallel = balance.neighbor != ALL_ISLS
+    print(f"--- Route balance: endpoint LIDs routed per ISL port, over {len(tables.switches)} switches "
+          f"({int(parallel.sum())} neighbor groups, {int((parallel & (balance.ports >= 2)).sum())} with "
+          f"parallel links)")
+    if len(balance) == 0:
+        print(f"    No ISLs found.")
+        return
+    imbalance = balance.imbalance()
+    for label, groups in [("neighbor groups of 2+ ports", parallel & (balance.ports >= 2)),
+                          ("leaf switch uplinks", balance.uplink_groups() & (balance.ports >= 2))]:
+        if groups.any():
+            print(f"    {label}: max/mean median {np.median(imbalance[groups]):.2f}, worst "
+                  f"{imbalance[groups].max():.2f}; stddev median {np.median(balance.stddev[groups]):.1f}, worst "
+                  f"{balance.stddev[groups].max():.1f}")
+    outliers = balance.outliers(tolerance)
+    if len(outliers) == 0:
+        print(f"    All port groups are balanced (busiest port at most {tolerance:.0%} over the mean).")
+        return
+    print(f"    {len(outliers)} port groups out of balance (busiest port more than {tolerance:.0%} over the mean), "
+          f"worst {min(top, len(outliers))}:")
+    for g in outliers[:top].tolist():
+        ports = balance.group_ports(g)
+        listed = " ".join(f"p{p}:{c}" for p, c in ports[:max_ports]) + (" ..." if len(ports) > max_ports else "")
+        print(f"        {balance.group_str(g)}: {balance.ports[g]} ports, {balance.total[g]} LIDs, min "
+              f"{balance.minimum[g]} max {balance.maximum[g]} mean {balance.mean[g]:.1f} stddev "
+              f"{balance.stddev[g]:.1f} (max/mean {imbalance[g]:.2f})")
+        print(f"            {listed}")
@@ -0,0 +1,228 @@
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import glob
+import os
+import queue
+import threading
+import time
+
+import ibdiag
+import ibdiag_graph
+import ibdiag_metrics
+import ibdiag_xlsx
+
+# Runs the ibdiag_graph pipeline (xlsx, and graph unless --xlsx_only) over many collected fabrics in a
+# pool of worker processes.  Each worker process handles at most --max_tasks_per_child fabrics and is
+# then replaced, so the memory a large fabric leaves behind is returned to the system.  Every fabric's
+# console output goes to <outdir>/<name>.log; a summary of all fabrics is printed and written as CSV.
+
+SUMMARY_COLUMNS = ['name', 'status', 'switches', 'isls', 'endpoints', 'hosts', 'route_entries', 'down_ports',
+                   'seconds', 'peak_rss_mb', 'error']
+
+
+def find_fabric_files(batch_dir):
+    # <prefix>switches.txt, <prefix>links.txt and (optional) <prefix>routes.txt in batch_dir or below, as
+    # written by ibdiag_fabricgen; the fabric is named after the prefix's path relative to batch_dir
+    fabrics = []
+    pattern = os.path.join(glob.escape(batch_dir), "**", "*switches.txt")
+    for switch_file in sorted(glob.glob(pattern, recursive=True)):
+        prefix = switch_file[:-len("switches.txt")]
+        link_file, route_file = prefix + "links.txt", prefix + "routes.txt"
+        if not os.path.isfile(link_file):
+            ibdiag.log.warning(f"*** Warning: skipping {switch_file}: no {os.path.basename(link_file)} next to it")
+            continue
+        name = os.path.relpath(prefix, batch_dir).rstrip("-_.").replace(os.sep, "_") or "fabric"
+        fabrics.append((name, switch_file, link_file, route_file if os.path.isfile(route_file) else None))
+    return fabrics
+
+
+def read_manifest(manifest_file):
+    # CSV lines of name,switches file,links file[,routes file]; '#' starts a comment line and relative
+    # paths are relative to the manifest's directory
+    fabrics = []
+    base = os.path.dirname(os.path.abspath(manifest_file))
+    with open(manifest_file, 'r', newline='') as infile:
+        for row in csv.reader(infile):
+            row = [field.strip() for field in row]
+            if len(row) == 0 or row[0] == "" or row[0].startswith("#"):
+                continue
+            if len(row) < 3:
+                raise ValueError(f"{manifest_file}: expected name,switches,links[,routes], got {','.join(row)}")
+            files = [os.path.join(base, f) if f else None for f in row[1:4]]
+            fabrics.append((row[0], files[0], files[1], files[2] if len(files) > 2 else None))
+    return fabrics
+
+
+def get_fabric_args(batch_args, name, switch_file, link_file, route_file):
+    # the batch options with this fabric's input and output files, as ibdiag_graph would have parsed them
+    fabric_args = argparse.Namespace(**vars(batch_args))
+    fabric_args.switch_info_file = switch_file
+    fabric_args.link_info_file = link_file
+    fabric_args.route_info_file = route_file
+    fabric_args.skip_routing = batch_args.skip_routing or route_file is None
+    fabric_args.xlsx_file = os.path.join(batch_args.outdir, f"{name}.xlsx")
+    fabric_args.graph_all_file = os.path.join(batch_args.outdir, f"{name}-graph")
+    fabric_args.report_file = None
+    if batch_args.batch_reports:
+        fabric_args.report_file = os.path.join(batch_args.outdir, f"{name}-report.txt")
+    if batch_args.save_snapshot is not None:
+        fabric_args.save_snapshot = os.path.join(batch_args.outdir, f"{name}.ibdsnap")
+    fabric_args.metrics_file = None
+    fabric_args.profile = None
+    fabric_args.route_contention = False
+    return fabric_args
+
+
+def get_fabric_summary(switches, endpoints):
+    return {'switches': len(switches),
+            'isls': sum(len(sw.isls) for sw in switches.values()) // 2,
+            'endpoints': len(endpoints),
+            'hosts': len(set(ibdiag.get_portstripped_hostname(ep.name) for ep in endpoints.values())),
+            'route_entries': sum(len(sw.routes) for sw in switches.values()),
+            'down_ports': sum(int(sw.portcount) - len(sw.connections) for sw in switches.values())}
+
+
+def process_fabric(name, fabric_args):
+    # runs in a worker process; errors are returned in the summary row rather than raised, so one broken
+    # input doesn't stop the batch
+    result = {'name': name, 'status': "ok", 'error': ""}
+    time_a = time.perf_counter()
+    ibdiag_metrics.METRICS = ibdiag_metrics.PhaseMetrics()
+    with open(os.path.join(fabric_args.outdir, f"{name}.log"), 'w') as logfile, \
+            contextlib.redirect_stdout(logfile):
+        ibdiag.configure_logging(fabric_args, logfile)
+        try:
+            # a missing file would make ibdiag collect that part from the fabric this host is on instead
+            for f in [fabric_args.switch_info_file, fabric_args.link_info_file, fabric_args.route_info_file]:
+                if f is not None and not os.path.isfile(f):
+                    raise FileNotFoundError(f"no such file: {f}")
+            switches, endpoints = ibdiag.do_diag_run(fabric_args)
+            result.update(get_fabric_summary(switches, endpoints))
+            if len(switches) == 0:
+                raise ValueError(f"no switches found in {fabric_args.switch_info_file}")
+            with ibdiag_metrics.span("xlsx"):
+                ibdiag_xlsx.write_xlsx(switches, endpoints, fabric_args.xlsx_file, fabric_args.xlsx_max_rows,
+                                       fabric_args.xlsx_overflow)
+            if not fabric_args.xlsx_only:
+                with ibdiag_metrics.span("graph_full"):
+                    ibdiag_graph.do_switch_graph(switches, filename=fabric_args.graph_all_file,
+                                                 collapse=fabric_args.graph_collapse)
+            ibdiag_metrics.METRICS.print_summary()
+        except (Exception, SystemExit) as exc:
+            ibdiag.log.exception(f"*** Error processing fabric {name}")
+            result['status'] = "error"
+            result['error'] = f"{type(exc).__name__}: {exc}"
+    result['seconds'] = round(time.perf_counter() - time_a, 3)
+    result['peak_rss_mb'] = ibdiag_metrics.get_peak_rss_mb()
+    return result
+
+
+def run_worker(tasks, max_tasks, report):
+    # one worker process at a time, which handles up to max_tasks fabrics from the queue and is then
+    # shut down and replaced; ProcessPoolExecutor's own max_tasks_per_child needs Python 3.11
+    while True:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            for _ in range(max_tasks):
+                try:
+                    name, fabric_args = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    report(pool.submit(process_fabric, name, fabric_args).result())
+                except Exception as exc:
+                    # the worker itself died, e.g. killed for running out of memory; it is replaced
+                    report({'name': name, 'status': "failed", 'error': f"{type(exc).__name__}: {exc}"})
+                    break
+
+
+def run_batch(fabrics, batch_args, jobs):
+    results = []
+    lock = threading.Lock()
+    tasks = queue.Queue()
+    for name, switch_file, link_file, route_file in fabrics:
+        tasks.put((name, get_fabric_args(batch_args, name, switch_file, link_file, route_file)))
+
+    def report(result):
+        with lock:
+            ibdiag.log.info(f"    {len(results) + 1}/{len(fabrics)} {result['name']}: {result['status']}"
+                            f"{' (' + result['error'] + ')' if result['error'] else ''}")
+            results.append(result)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as workers:
+        list(workers.map(lambda _: run_worker(tasks, max(1, batch_args.max_tasks_per_child), report), range(jobs)))
+    order = {name: i for i, (name, _, _, _) in enumerate(fabrics)}
+    return sorted(results, key=lambda r: order[r['name']])
+
+
+def print_batch_summary(results):
+    ibdiag.log.info(f"--- Fabrics ({len(results)}):")
+    ibdiag.log.info(f"    {'name':30} {'status':7} {'switches':>8} {'ISLs':>7} {'endpoints':>9} {'hosts':>7} "
+                    f"{'routes':>10} {'down':>7} {'seconds':>8} {'RSS MB':>8}")
+    for r in results:
+        counts = [str(r.get(c, "")) for c in ['switches', 'isls', 'endpoints', 'hosts', 'route_entries',
+                                                'down_ports', 'seconds', 'peak_rss_mb']]
+        ibdiag.log.info(f"    {r['name']:30} {r['status']:7} {counts[0]:>8} {counts[1]:>7} {counts[2]:>9} "
+                        f"{counts[3]:>7} {counts[4]:>10} {counts[5]:>7} {counts[6]:>8} {counts[7]:>8}")
+
+
+def write_batch_summary(results, filename):
+    with open(filename, 'w', newline='') as outfile:
+        writer = csv.DictWriter(outfile, SUMMARY_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def get_arg_parser(description="ibdiag_batch: Generate xlsx files and graphs for many collected IB fabrics"):
+    my_parser = ibdiag_graph.get_arg_parser(description=description)
+    my_parser.add_argument("--batch_dir", dest="batch_dir", default=None,
+        help="directory searched (recursively) for <prefix>switches.txt, <prefix>links.txt and "
+             "<prefix>routes.txt file sets")
+    my_parser.add_argument("--manifest", dest="manifest", default=None,
+        help="CSV file with one name,switches file,links file[,routes file] line per fabric")
+    my_parser.add_argument("--outdir", dest="outdir", default="ibdiag_batch_out",
+        help="directory for the per-fabric outputs and the summary; with --save_snapshot each fabric's snapshot "
+             "is written to <outdir>/<name>.ibdsnap")
+    my_parser.add_argument("--jobs", dest="jobs", type=int, default=os.cpu_count() or 1,
+        help="number of worker processes")
+    my_parser.add_argument("--max_tasks_per_child", dest="max_tasks_per_child", type=int, default=1,
+        help="fabrics a worker process handles before it is replaced")
+    my_parser.add_argument("--batch_reports", dest="batch_reports", action='store_true',
+        help="also write each fabric's full switch/endpoint/host listing to <outdir>/<name>-report.txt")
+    my_parser.add_argument("--summary_file", dest="summary_file", default=None,
+        help="file name for the summary in CSV format (default: <outdir>/summary.csv)")
+    return my_parser
+
+
+def main():
+    my_parser = get_arg_parser()
+    args = my_parser.parse_args()
+    if (args.batch_dir is None) == (args.manifest is None):
+        my_parser.error("exactly one of --batch_dir and --manifest is needed")
+    # each fabric gets the full graph only; a subset or layout file would be shared by all of them
+    for option in ["graph_subset", "graph_layout_file"]:
+        if getattr(args, option) is not None:
+            my_parser.error(f"--{option} can't be used with ibdiag_batch")
+    ibdiag.configure_logging(args)
+    fabrics = find_fabric_files(args.batch_dir) if args.batch_dir is not None else read_manifest(args.manifest)
+    names = collections.Counter(name for name, _, _, _ in fabrics)
+    duplicates = sorted(n for n, count in names.items() if count > 1)
+    if len(duplicates) > 0:
+        my_parser.error(f"duplicate fabric names: {', '.join(duplicates)}")
+    os.makedirs(args.outdir, exist_ok=True)
+    jobs = max(1, min(args.jobs, len(fabrics)))
+    ibdiag.log.info(f"Processing {len(fabrics)} fabric(s) with {jobs} worker process(es)...")
+    time_a = time.perf_counter()
+    results = run_batch(fabrics, args, jobs)
+    print_batch_summary(results)
+    summary_file = args.summary_file or os.path.join(args.outdir, "summary.csv")
+    write_batch_summary(results, summary_file)
+    ibdiag.log.info(f"Batch took {time.perf_counter() - time_a:.1f} seconds; summary written to {summary_file}")
+    if any(r['status'] != "ok" for r in results):
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import ibdiag
+import ibdiag_fabricgen
+
+# End-to-end benchmark: generates synthetic fat-tree input files of increasing size and times each
+# pipeline stage on them.  Every size is run twice - once for wall time, once under tracemalloc for
+# the stage's peak Python memory (tracing slows the code down, so its timings aren't used).
+
+
+def stage_switches(ctx):
+    ctx['switches'] = ibdiag.get_switches(ctx['files'][0])
+    return len(ctx['switches'])
+
+
+def stage_routes(ctx):
+    ibdiag.compute_route_info(ctx['switches'], ctx['files'][2])
+    return sum(len(sw.routes) for sw in ctx['switches'].values())
+
+
+def stage_links(ctx):
+    ctx['endpoints'] = ibdiag.load_linkinfo_data(ctx['switches'], ctx['files'][1])
+    return len(ctx['endpoints'])
+
+
+def stage_xlsx(ctx):
+    import ibdiag_xlsx
+    ibdiag_xlsx.write_xlsx(ctx['switches'], ctx['endpoints'], os.path.join(ctx['workdir'], "bench.xlsx"))
+    return len(ctx['switches'])
+
+
+def stage_graph(ctx):
+    import ibdiag_graph
+    ibdiag_graph.do_switch_graph(ctx['switches'], filename=os.path.join(ctx['workdir'], "bench-graph"))
+    return len(ctx['switches']) + len(ctx['endpoints'])
+
+
+# name -> stage function; a stage returns the number of items it handled.  Order matters: later
+# stages use what earlier ones left in the context.
+BENCH_STAGES = {
+    'switches': stage_switches,
+    'routes': stage_routes,
+    'links': stage_links,
+    'xlsx': stage_xlsx,
+    'graph': stage_graph,
+}
+
+
+# entry point module -> target for the time its import adds to a bare interpreter start, in ms.  The
+# heavy dependencies (networkx, matplotlib, numpy, xlsxwriter) must not be loaded by the import alone.
+STARTUP_TARGETS_MS = {
+    'ibdiag': 100,
+    'ibdiag_xlsx': 100,
+    'ibdiag_export': 100,
+    'ibdiag_diff': 100,
+    'ibdiag_graph': 100,
+    'ibdiag_watch': 100,
+    'ibdiag_server': 100,
+    'ibdiag_batch': 100,
+    'ibdiag_validate': 100,
+    'ibdiag_cdg': 100,
+    'ibdiag_balance': 100,
+    'ibdiag_whatif': 100,
+}
+HEAVY_MODULES = ['networkx', 'matplotlib', 'numpy', 'xlsxwriter', 'pyarrow']
+
+
+def time_python(code, runs):
+    # best wall time of `runs` fresh interpreters running code, and the last run's output
+    best, output = None, ""
+    for _ in range(runs):
+        time_a = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, universal_newlines=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        elapsed = time.perf_counter() - time_a
+        best = elapsed if best is None else min(best, elapsed)
+        output = proc.stdout.strip()
+    return best, output
+
+
+def bench_startup(runs):
+    base, _ = time_python("pass", runs)
+    print(f"--- Startup: import time over a bare interpreter ({base * 1000:.0f} ms), best of {runs} runs")
+    rows = []
+    for module, target_ms in STARTUP_TARGETS_MS.items():
+        elapsed, heavy = time_python(f"import sys, {module}; "
+                                     f"print(' '.join(m for m in {HEAVY_MODULES} if m in sys.modules))", runs)
+        import_ms = max(0.0, (elapsed - base) * 1000)
+        ok = import_ms <= target_ms and heavy == ""
+        rows.append({'hosts': None, 'stage': 'startup', 'module': module, 'seconds': import_ms / 1000,
+                     'target_seconds': target_ms / 1000, 'heavy_modules': heavy.split(), 'ok': ok})
+        loaded = f"  loads {heavy}" if heavy else ""
+        print(f"    {module:14} {import_ms:7.0f} ms (target {target_ms} ms) {'ok' if ok else 'OVER'}{loaded}")
+    return rows
+
+
+def run_stages(ctx, stages, trace_memory):
+    results = {}
+    for name in stages:
+        if trace_memory:
+            tracemalloc.start()
+        time_a = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            items = BENCH_STAGES[name](ctx)
+        elapsed = time.perf_counter() - time_a
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results[name] = (elapsed, peak, items)
+    return results
+
+
+def bench_size(hosts, args):
+    fabric_dir = os.path.join(args.workdir, f"fabric-{hosts}")
+    time_a = time.perf_counter()
+    fabric = ibdiag_fabricgen.build_fat_tree(hosts, args.tiers, args.radix, args.ports_per_host)
+    files = ibdiag_fabricgen.write_fabric_files(fabric, fabric_dir)
+    gen_time = time.perf_counter() - time_a
+    stages = [s for s in args.stages.split(",") if s != 'graph' or hosts <= args.graph_max_hosts]
+    timings = run_stages({'files': files, 'workdir': fabric_dir}, stages, False)
+    memory = {}
+    if not args.no_memory:
+        memory = run_stages({'files': files, 'workdir': fabric_dir}, stages, True)
+    rows = []
+    for name in stages:
+        elapsed, _, items = timings[name]
+        peak = memory[name][1] if name in memory else None
+        rows.append({'hosts': hosts, 'switches': len(fabric.switches), 'host_ports': len(fabric.hostports),
+                     'stage': name, 'seconds': elapsed, 'peak_mb': None if peak is None else peak / 1e6,
+                     'items': items})
+    route_mb = os.path.getsize(files[2]) / 1e6
+    print(f"--- {hosts} hosts: {len(fabric.switches)} switches, {len(fabric.hostports)} host ports, "
+          f"{route_mb:.1f} MB of routes (generated in {gen_time:.2f} seconds)")
+    for row in rows:
+        peak = "" if row['peak_mb'] is None else f"{row['peak_mb']:10.1f} MB peak"
+        print(f"    {row['stage']:10} {row['seconds']:10.3f} s {peak}  ({row['items']} items)")
+    return rows
+
+
+def get_arg_parser(description="ibdiag_bench: Time the ibdiag pipeline stages on generated fat-tree fabrics"):
+    argparser = argparse.ArgumentParser(description=description, add_help=True)
+    argparser.add_argument("--sizes", dest="sizes", default="16,256,2048",
+                           help="comma separated list of host counts to benchmark")
+    argparser.add_argument("--tiers", dest="tiers", type=int, choices=[2, 3], default=None,
+                           help="fat-tree tiers (default: 2 if the hosts fit, otherwise 3)")
+    argparser.add_argument("--radix", dest="radix", type=int, default=40, help="switch port count")
+    argparser.add_argument("--ports_per_host", dest="ports_per_host", type=int, default=1,
+                           help="HCA ports per host")
+    argparser.add_argument("--stages", dest="stages", default=",".join(BENCH_STAGES),
+                           help=f"comma separated list of stages to run, from: {', '.join(BENCH_STAGES)}")
+    argparser.add_argument("--graph_max_hosts", dest="graph_max_hosts", type=int, default=512,
+                           help="skip the graph stage for fabrics with more hosts than this")
+    argparser.add_argument("--no_memory", dest="no_memory", action='store_true',
+                           help="skip the tracemalloc pass that measures peak memory per stage")
+    argparser.add_argument("--startup_runs", dest="startup_runs", type=int, default=5,
+                           help="interpreter starts per entry point for the startup time check; 0 skips it")
+    argparser.add_argument("--workdir", dest="workdir", default="ibdiag_bench",
+                           help="directory for generated fabrics and outputs")
+    argparser.add_argument("--json_file", dest="json_file", default=None,
+                           help="file name for the results in JSON format")
+    return argparser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    for name in args.stages.split(","):
+        if name not in BENCH_STAGES:
+            print(f"*** Error: unknown stage '{name}'; stages are: {', '.join(BENCH_STAGES)}")
+            exit(1)
+    rows = []
+    if args.startup_runs > 0:
+        rows += bench_startup(args.startup_runs)
+    for hosts in [int(h) for h in args.sizes.split(",")]:
+        rows += bench_size(hosts, args)
+    if args.json_file is not None:
+        with open(args.json_file, 'w') as outfile:
+            json.dump(rows, outfile, indent=2)
+        print(f"Results written to {args.json_file}")
+
+
+if __name__ == '__main__':
+    main()
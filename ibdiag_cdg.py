@@ -0,0 +1,196 @@
+import collections
+
+import ibdiag
+import ibdiag_trace
+
+np = ibdiag.LazyModule("numpy")
+
+# Credit-loop (deadlock) detection on the channel dependency graph: the nodes are the ISL directions
+# ("channels"), and channel a depends on channel b when a route enters a switch through a and leaves
+# it through b, so a packet in a's buffer can wait for credits on b.  Routing can deadlock when the
+# graph has a cycle.  All routes from every endpoint's switch are covered, assuming one virtual lane
+# (the SL to VL mapping isn't collected).
+#
+# Channels are numbered densely and dependency edges are built destination chunk by destination chunk
+# as integer arrays, deduplicated as they go.  Cycles are then found by first trimming, with array
+# operations, every channel without incoming or outgoing dependencies until none is left - which
+# removes everything from a deadlock-free (e.g. up/down routed) fabric - and running an iterative
+# Tarjan search for strongly connected components on whatever remains.
+
+MAX_PORTS = ibdiag_trace.MAX_PORTS
+
+
+class ChannelDependencyGraph:
+    # channels[i]: flat channel id (switch index * MAX_PORTS + port) of dense channel i, and dense[flat
+    # channel id] the other way round; the dependency edges are the pairs (src[k], dst[k]) of dense
+    # channel ids, from the routes to dest_lids
+    def __init__(self, tables, channels, dense, dest_lids, src, dst):
+        self.tables = tables
+        self.channels = channels
+        self.dense = dense
+        self.dest_lids = dest_lids
+        self.src = src
+        self.dst = dst
+
+    def __len__(self):
+        return len(self.channels)
+
+    def channel_str(self, i):
+        return self.tables.channel_str(self.channels[i])
+
+
+def iter_dependency_edges(tables, dense, dest_lids, chunk_size):
+    # yields (from channel, to channel, destination lid) arrays, one entry per switch and destination
+    # where a route used by some endpoint passes through the switch between two ISLs
+    n = len(tables.switches)
+    rows = np.arange(n)[:, None]
+    sources = np.zeros(n, dtype=bool)
+    sources[tables.lid_switch[tables.endpoint_lids()]] = True
+    for start in range(0, len(dest_lids), chunk_size):
+        lids = dest_lids[start:start + chunk_size]
+        port = tables.lft[:, lids]
+        # the switch the entry forwards to, -1 when it delivers the packet or doesn't lead to an ISL
+        nxt = tables.neighbor[rows, port]
+        nxt[rows == tables.lid_switch[lids][None, :]] = -1
+        # the entries that carry traffic: those of the switches with endpoints and of every switch
+        # their routes lead through
+        used = np.repeat(sources[:, None], len(lids), axis=1)
+        frontier = used.copy()
+        while True:
+            s, c = np.nonzero(frontier & (nxt >= 0))
+            reached = np.zeros_like(used)
+            reached[nxt[s, c], c] = True
+            frontier = reached & ~used
+            if not frontier.any():
+                break
+            used |= frontier
+        s, c = np.nonzero(used & (nxt >= 0))
+        s2 = nxt[s, c]
+        onward = nxt[s2, c] >= 0
+        s, c, s2 = s[onward], c[onward], s2[onward]
+        a = dense[s * MAX_PORTS + port[s, c]]
+        b = dense[s2 * MAX_PORTS + port[s2, c]]
+        yield a, b, lids[c]
+
+
+def build_channel_dependency_graph(tables, dest_lids=None, chunk_size=2048):
+    # dest_lids: the destinations whose routes are included, by default every endpoint lid
+    channels = tables.isl_channels()
+    dense = np.full(len(tables.switches) * MAX_PORTS, -1, dtype=np.int64)
+    dense[channels] = np.arange(len(channels))
+    dest_lids = tables.endpoint_lids() if dest_lids is None else np.asarray(dest_lids, dtype=np.int64)
+    # an edge is stored as one integer, from * channel count + to, so deduplicating is a sorted union
+    count = max(1, len(channels))
+    keys = np.zeros(0, dtype=np.int64)
+    for a, b, _ in iter_dependency_edges(tables, dense, dest_lids, chunk_size):
+        keys = np.union1d(keys, a * count + b)
+    return ChannelDependencyGraph(tables, channels, dense, dest_lids, keys // count, keys % count)
+
+
+def trim_acyclic(node_count, src, dst):
+    # drops nodes without incoming or outgoing edges (they can't be on a cycle), and their edges, until
+    # every remaining node has both; returns the remaining edges
+    while len(src) > 0:
+        indegree = np.bincount(dst, minlength=node_count)
+        outdegree = np.bincount(src, minlength=node_count)
+        keep = (indegree[src] > 0) & (outdegree[dst] > 0)
+        if keep.all():
+            break
+        src, dst = src[keep], dst[keep]
+    return src, dst
+
+
+def get_strongly_connected_components(node_count, src, dst):
+    # iterative Tarjan; returns the components with more than one node, as lists of node ids
+    order = np.argsort(src, kind='stable')
+    adjacency = dst[order].tolist()
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=node_count))]).tolist()
+    index = [-1] * node_count
+    low = [0] * node_count
+    on_stack = [False] * node_count
+    stack, components, counter = [], [], 0
+    for root in np.unique(src).tolist():
+        if index[root] != -1:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [[root, indptr[root]]]
+        while work:
+            frame = work[-1]
+            v, i = frame
+            if i < indptr[v + 1]:
+                frame[1] = i + 1
+                w = adjacency[i]
+                if index[w] == -1:
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = True
+                    work.append([w, indptr[w]])
+                elif on_stack[w] and index[w] < low[v]:
+                    low[v] = index[w]
+                continue
+            work.pop()
+            if work and low[v] < low[work[-1][0]]:
+                low[work[-1][0]] = low[v]
+            if low[v] == index[v]:
+                component = []
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = False
+                    component.append(w)
+                    if w == v:
+                        break
+                if len(component) > 1:
+                    components.append(component)
+    return components
+
+
+def get_cycle(component, successors):
+    # one shortest cycle through the component's first node; successors holds the edges inside components
+    start = component[0]
+    parent = {start: None}
+    queue = collections.deque([start])
+    while queue:
+        v = queue.popleft()
+        for w in successors[v]:
+            if w == start:
+                cycle = [v]
+                while parent[cycle[-1]] is not None:
+                    cycle.append(parent[cycle[-1]])
+                return cycle[::-1]
+            if w not in parent:
+                parent[w] = v
+                queue.append(w)
+    return [start]
+
+
+class CreditLoop:
+    def __init__(self, channels, cycle, dest_lids):
+        self.channels = channels        # the dense channel ids of the strongly connected set
+        self.cycle = cycle              # one cycle through it, in order
+        self.dest_lids = dest_lids      # destinations whose routes add dependencies inside the set
+
+
+def find_credit_loops(cdg, chunk_size=2048):
+    src, dst = trim_acyclic(len(cdg), cdg.src, cdg.dst)
+    if len(src) == 0:
+        return []
+    components = get_strongly_connected_components(len(cdg), src, dst)
+    component_of = np.full(len(cdg), -1, dtype=np.int64)
+    for i, component in enumerate(components):
+        component_of[component] = i
+    # second pass over the routes, for the destinations that make the dependencies inside each set
+    dest_lids = [set() for _ in components]
+    for a, b, lids in iter_dependency_edges(cdg.tables, cdg.dense, cdg.dest_lids, chunk_size):
+        inside = (component_of[a] >= 0) & (component_of[a] == component_of[b])
+        for i, lid in zip(component_of[a[inside]].tolist(), lids[inside].tolist()):
+            dest_lids[i].add(lid)
+    successors = collections.defaultdict(list)
+    inside = (component_of[src] >= 0) & (component_of[src] == component_of[dst])
+    for a, b in zip(src[inside].tolist(), dst[inside].tolist()):
+        successors[a].append(b)
+    return [CreditLoop(sorted(component), get_cycle(component, successors), sorted(lids))
+            for component, lids in zip(components, dest_lids)]
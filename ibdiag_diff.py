@@ -0,0 +1,258 @@
+import ibdiag
+import ibdiag_metrics
+import ibdiag_snapshot
+
+# Compares two parsed fabrics: switches and endpoints are matched by GUID, ISLs and endpoint links by
+# (switch GUID, port), and forwarding tables chunk by chunk.  The link tables of both fabrics are
+# built in full on every run, so that part takes time linear in the fabric size; forwarding tables
+# are compared with a memory compare per table and per chunk, and only the changed chunks are
+# examined entry by entry.  An ISL is in the link tables from both ends, and its changes are
+# reported from one of them, its lower (switch GUID, port).
+
+LFT_CHUNK = 256
+
+
+class FabricDiff:
+    def __init__(self):
+        self.switches_removed = []      # IBSwitch (old)
+        self.switches_added = []        # IBSwitch (new)
+        self.switch_lid_changes = []    # (old IBSwitch, new IBSwitch)
+        self.isls_down = []             # (old switch, port, old dest switch, dest port, speed)
+        self.isls_up = []               # (new switch, port, new dest switch, dest port, speed)
+        self.isls_rewired = []          # (new switch, port, (old dest, port), (new dest, port))
+        self.isl_speed_changes = []     # (new switch, port, new dest switch, dest port, old speed, new speed)
+        self.endpoints_down = []        # (old switch, port, old IBHost)
+        self.endpoints_up = []          # (new switch, port, new IBHost)
+        self.endpoint_speed_changes = []    # (new switch, port, new IBHost, old speed, new speed)
+        self.endpoint_lid_changes = []  # (new switch, port, new IBHost, old lid, new lid)
+        self.lft_changes = {}           # new switch lid -> [(dest lid, old port, new port), ...]
+
+    def change_count(self):
+        return (len(self.switches_removed) + len(self.switches_added) + len(self.switch_lid_changes) +
+                len(self.isls_down) + len(self.isls_up) + len(self.isls_rewired) + len(self.isl_speed_changes) +
+                len(self.endpoints_down) + len(self.endpoints_up) + len(self.endpoint_speed_changes) +
+                len(self.endpoint_lid_changes) + sum(len(v) for v in self.lft_changes.values()))
+
+    def affected_switch_lids(self):
+        # (guids of switches with link changes, new lids of switches with forwarding table changes)
+        guids = {sw.guid for sw in self.switches_added}
+        guids.update(new.guid for _, new in self.switch_lid_changes)
+        for sw, _, dest_sw, _, _ in self.isls_down + self.isls_up:
+            guids.update((sw.guid, dest_sw.guid))
+        for sw, _, (old_dest, _), (new_dest, _) in self.isls_rewired:
+            guids.update((sw.guid, old_dest.guid, new_dest.guid))
+        for sw, _, dest_sw, _, _, _ in self.isl_speed_changes:
+            guids.update((sw.guid, dest_sw.guid))
+        for change in (self.endpoints_down + self.endpoints_up + self.endpoint_speed_changes +
+                       self.endpoint_lid_changes):
+            guids.add(change[0].guid)
+        return guids, set(self.lft_changes)
+
+
+def get_lft_changes(old_ports, new_ports):
+    # [(lid, old port, new port), ...]; NO_ROUTE stands for a missing entry on either side
+    no_route = ibdiag.LinearForwardingTable.NO_ROUTE
+    size = max(len(old_ports), len(new_ports))
+    old_ports = bytes(old_ports) + bytes([no_route]) * (size - len(old_ports))
+    new_ports = bytes(new_ports) + bytes([no_route]) * (size - len(new_ports))
+    result = []
+    if old_ports == new_ports:
+        return result
+    for start in range(0, size, LFT_CHUNK):
+        old_chunk = old_ports[start:start + LFT_CHUNK]
+        new_chunk = new_ports[start:start + LFT_CHUNK]
+        if old_chunk == new_chunk:
+            continue
+        for i, (a, b) in enumerate(zip(old_chunk, new_chunk)):
+            if a != b:
+                result.append((start + i, a, b))
+    return result
+
+
+def get_link_table(switches):
+    # (switch guid, port) -> (switch, port, remote, remote port, speed, is_isl) for every up port
+    result = {}
+    for sw in switches.values():
+        for port, (dest_sw, dest_port, speed) in sw.isls.items():
+            result[(sw.guid, port)] = (sw, port, dest_sw, dest_port, speed, True)
+        for port, ep in sw.endpoints.items():
+            result[(sw.guid, port)] = (sw, port, ep, None, ep.speed, False)
+    return result
+
+
+def is_reported_end(sw, port, remote, remote_port):
+    # the end of an ISL its changes are reported from, so each physical link is reported once
+    return (sw.guid, port) <= (remote.guid, remote_port)
+
+
+def diff_fabrics(old_switches, new_switches):
+    diff = FabricDiff()
+    old_by_guid = {sw.guid: sw for sw in old_switches.values()}
+    new_by_guid = {sw.guid: sw for sw in new_switches.values()}
+    for guid, sw in old_by_guid.items():
+        if guid not in new_by_guid:
+            diff.switches_removed.append(sw)
+        elif new_by_guid[guid].lid != sw.lid:
+            diff.switch_lid_changes.append((sw, new_by_guid[guid]))
+    for guid, sw in new_by_guid.items():
+        if guid not in old_by_guid:
+            diff.switches_added.append(sw)
+
+    old_links = get_link_table(old_switches)
+    new_links = get_link_table(new_switches)
+    for key, (sw, port, remote, remote_port, speed, is_isl) in old_links.items():
+        reported = not is_isl or is_reported_end(sw, port, remote, remote_port)
+        if key not in new_links:
+            if not is_isl:
+                diff.endpoints_down.append((sw, port, remote))
+            elif reported:
+                diff.isls_down.append((sw, port, remote, remote_port, speed))
+            continue
+        new_sw, _, new_remote, new_remote_port, new_speed, new_is_isl = new_links[key]
+        new_reported = not new_is_isl or is_reported_end(new_sw, port, new_remote, new_remote_port)
+        if is_isl != new_is_isl or remote.guid != new_remote.guid or remote_port != new_remote_port:
+            if is_isl and new_is_isl:
+                diff.isls_rewired.append((new_sw, port, (remote, remote_port), (new_remote, new_remote_port)))
+            else:
+                if not is_isl:
+                    diff.endpoints_down.append((sw, port, remote))
+                elif reported:
+                    diff.isls_down.append((sw, port, remote, remote_port, speed))
+                if not new_is_isl:
+                    diff.endpoints_up.append((new_sw, port, new_remote))
+                elif new_reported:
+                    diff.isls_up.append((new_sw, port, new_remote, new_remote_port, new_speed))
+            continue
+        if not is_isl and remote.lid != new_remote.lid:
+            # same endpoint on the same port, with a new lid from an SM sweep
+            diff.endpoint_lid_changes.append((new_sw, port, new_remote, remote.lid, new_remote.lid))
+        if speed != new_speed:
+            if not is_isl:
+                diff.endpoint_speed_changes.append((new_sw, port, new_remote, speed, new_speed))
+            elif new_reported:
+                diff.isl_speed_changes.append((new_sw, port, new_remote, new_remote_port, speed, new_speed))
+    for key, (sw, port, remote, remote_port, speed, is_isl) in new_links.items():
+        if key not in old_links:
+            if not is_isl:
+                diff.endpoints_up.append((sw, port, remote))
+            elif is_reported_end(sw, port, remote, remote_port):
+                diff.isls_up.append((sw, port, remote, remote_port, speed))
+
+    for guid, sw in new_by_guid.items():
+        if guid in old_by_guid:
+            changes = get_lft_changes(old_by_guid[guid].routes.ports, sw.routes.ports)
+            if len(changes) > 0:
+                diff.lft_changes[sw.lid] = changes
+    return diff
+
+
+def sw_str(sw):
+    return f"{sw.name}({sw.lid})"
+
+
+def print_section(title, lines, max_lines):
+    if len(lines) == 0:
+        return
+    print(f"    {title} ({len(lines)}):")
+    for line in lines[:max_lines]:
+        print(f"        {line}")
+    if len(lines) > max_lines:
+        print(f"        ... {len(lines) - max_lines} more")
+
+
+def print_fabric_diff(diff, new_switches, max_lines=20):
+    speed = ibdiag.short_speed_info
+    lft_moves = sum(len(v) for v in diff.lft_changes.values())
+    print(f"--- Fabric changes: {diff.change_count()}")
+    print(f"    switches: {len(diff.switches_removed)} removed, {len(diff.switches_added)} added, "
+          f"{len(diff.switch_lid_changes)} lid changes")
+    print(f"    ISLs: {len(diff.isls_down)} down, {len(diff.isls_up)} up, {len(diff.isls_rewired)} rewired, "
+          f"{len(diff.isl_speed_changes)} speed changes")
+    print(f"    endpoint links: {len(diff.endpoints_down)} down, {len(diff.endpoints_up)} up, "
+          f"{len(diff.endpoint_speed_changes)} speed changes, {len(diff.endpoint_lid_changes)} lid changes")
+    print(f"    forwarding tables: {lft_moves} changed entries on {len(diff.lft_changes)} switches")
+    print_section("Switches removed", [f"- {sw_str(sw)} {sw.guid}" for sw in diff.switches_removed], max_lines)
+    print_section("Switches added", [f"+ {sw_str(sw)} {sw.guid}" for sw in diff.switches_added], max_lines)
+    print_section("Switch lid changes", [f"~ {old.name} {old.guid}: lid {old.lid} -> {new.lid}"
+                                         for old, new in diff.switch_lid_changes], max_lines)
+    print_section("ISLs down", [f"- {sw_str(s)} p{p} --> {sw_str(d)} p{dp} ({speed(sp)})"
+                                for s, p, d, dp, sp in diff.isls_down], max_lines)
+    print_section("ISLs up", [f"+ {sw_str(s)} p{p} --> {sw_str(d)} p{dp} ({speed(sp)})"
+                              for s, p, d, dp, sp in diff.isls_up], max_lines)
+    print_section("ISLs rewired", [f"~ {sw_str(s)} p{p}: {sw_str(od)} p{odp} -> {sw_str(nd)} p{ndp}"
+                                   for s, p, (od, odp), (nd, ndp) in diff.isls_rewired], max_lines)
+    print_section("ISL speed changes", [f"~ {sw_str(s)} p{p} --> {sw_str(d)} p{dp}: {speed(a)} -> {speed(b)}"
+                                        for s, p, d, dp, a, b in diff.isl_speed_changes], max_lines)
+    print_section("Endpoint links down", [f"- {sw_str(s)} p{p}: '{ep.name}' (lid {ep.lid})"
+                                          for s, p, ep in diff.endpoints_down], max_lines)
+    print_section("Endpoint links up", [f"+ {sw_str(s)} p{p}: '{ep.name}' (lid {ep.lid})"
+                                        for s, p, ep in diff.endpoints_up], max_lines)
+    print_section("Endpoint speed changes", [f"~ {sw_str(s)} p{p}: '{ep.name}' {speed(a)} -> {speed(b)}"
+                                             for s, p, ep, a, b in diff.endpoint_speed_changes], max_lines)
+    print_section("Endpoint lid changes", [f"~ {sw_str(s)} p{p}: '{ep.name}' lid {a} -> {b}"
+                                           for s, p, ep, a, b in diff.endpoint_lid_changes], max_lines)
+    lft_lines = []
+    for lid, changes in sorted(diff.lft_changes.items(), key=lambda kv: -len(kv[1])):
+        examples = ", ".join(f"lid {l}: {lft_port_str(a)} -> {lft_port_str(b)}" for l, a, b in changes[:4])
+        lft_lines.append(f"~ {sw_str(new_switches[lid])}: {len(changes)} entries changed ({examples}"
+                         f"{', ...' if len(changes) > 4 else ''})")
+    print_section("Forwarding table changes", lft_lines, max_lines)
+
+
+def lft_port_str(port):
+    return "none" if port == ibdiag.LinearForwardingTable.NO_ROUTE else f"p{port}"
+
+
+def get_affected_subgraph(diff, new_switches):
+    # changed switches plus their ISL neighbors, so the graph shows both ends of every changed link
+    guids, lft_lids = diff.affected_switch_lids()
+    core = {lid for lid, sw in new_switches.items() if sw.guid in guids} | lft_lids
+    result = set(core)
+    for lid in core:
+        for dest_sw, _, _ in new_switches[lid].isls.values():
+            result.add(dest_sw.lid)
+    return {lid: sw for lid, sw in new_switches.items() if lid in result}
+
+
+def get_arg_parser(description="ibdiag_diff: Report changes between two parsed IB fabrics"):
+    my_parser = ibdiag.get_arg_parser(description=description)
+    my_parser.add_argument("--old_snapshot", dest="old_snapshot", required=True,
+        help="fabric snapshot (see --save_snapshot) to compare against")
+    my_parser.add_argument("--new_snapshot", dest="new_snapshot", default=None,
+        help="fabric snapshot to compare; if not provided the fabric is loaded from the input file options, "
+             "or collected from the fabric")
+    my_parser.add_argument("--diff_max_lines", dest="diff_max_lines", type=int, default=20,
+        help="maximum number of lines listed per kind of change")
+    my_parser.add_argument("--diff_graph_file", dest="diff_graph_file", default=None,
+        help="filename for a graph of the changed switches and their neighbors")
+    return my_parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    ibdiag.configure_logging(args)
+    ibdiag_metrics.configure(args)
+    with ibdiag_metrics.span("collect"):
+        old_switches, _, _ = ibdiag_snapshot.load_snapshot(args.old_snapshot)
+        if args.new_snapshot is not None:
+            new_switches, new_endpoints, _ = ibdiag_snapshot.load_snapshot(args.new_snapshot)
+        else:
+            new_switches, new_endpoints = ibdiag.load_fabric_cached(args)
+            ibdiag.save_requested_snapshot(args, new_switches, new_endpoints)
+    with ibdiag_metrics.span("diff") as span:
+        diff = diff_fabrics(old_switches, new_switches)
+        span.items = diff.change_count()
+    print_fabric_diff(diff, new_switches, args.diff_max_lines)
+    if args.diff_graph_file is not None:
+        subgraph = get_affected_subgraph(diff, new_switches)
+        if len(subgraph) == 0:
+            print(f"No changed switches to graph.")
+        else:
+            import ibdiag_graph
+            with ibdiag_metrics.span("graph"):
+                ibdiag_graph.do_switch_graph(subgraph, filename=args.diff_graph_file)
+    ibdiag_metrics.finish()
+
+
+if __name__ == '__main__':
+    main()
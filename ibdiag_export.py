@@ -0,0 +1,192 @@
+import csv
+import itertools
+import os
+import re
+
+import ibdiag
+import ibdiag_metrics
+import ibdiag_xlsx
+
+# Writes the tables of the xlsx output (ibdiag_xlsx.XLSX_SHEETS) to CSV files, Parquet files or a
+# SQLite database instead.  Rows are streamed from the same row generators and written in batches,
+# so no table is ever held in memory as a whole and there is no row limit.
+
+EXPORT_FORMATS = ["csv", "parquet", "sqlite"]
+DEFAULT_BATCH_ROWS = 50000
+
+# table -> indexes (column lists) created in the SQLite export, for joining on LID, switch and port
+SQLITE_INDEXES = {
+    'switches': [['switch_lid'], ['switch_name']],
+    'all_up_ports': [['switch_lid', 'switch_port'], ['connected_lid']],
+    'isls': [['switch_lid', 'switch_port'], ['dest_lid', 'dest_port']],
+    'endpoints': [['switch_lid', 'switch_port'], ['endpoint_lid'], ['endpoint_name']],
+    'routes': [['switch_lid', 'switch_port']],
+    'route_balance': [['switch_lid'], ['neighbor_lid']],
+    'down_ports': [['switch_lid', 'switch_port']],
+    'routes_by_lid': [['endpoint_lid'], ['switch_lid', 'exits_via_port']],
+}
+
+# table -> types of its columns, in column order, for the Parquet schema
+PARQUET_COLUMN_TYPES = {
+    'switches': ['str', 'int', 'int', 'int', 'int'],
+    'all_up_ports': ['str', 'int', 'int', 'str', 'int'],
+    'isls': ['str', 'int', 'int', 'str', 'int', 'int', 'str'],
+    'endpoints': ['str', 'int', 'int', 'str', 'int', 'str'],
+    'routes': ['str', 'int', 'int', 'int', 'str'],
+    'route_balance': ['str', 'int', 'str', 'int', 'int', 'int', 'int', 'int', 'float', 'float', 'float', 'str'],
+    'down_ports': ['str', 'int', 'int'],
+    'routes_by_lid': ['str', 'int', 'int', 'str', 'int'],
+}
+
+
+def get_sql_name(title):
+    # "Routes by Lid" -> routes_by_lid, "# LID Routes" -> lid_routes
+    return re.sub(r'[^a-z0-9]+', '_', title.lower()).strip('_')
+
+
+def iter_batches(rows, batch_rows):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_rows))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+class CsvExporter:
+    # one <table>.csv file per table in the output directory
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.outfile = None
+        self.writer = None
+
+    def begin_table(self, table, columns):
+        self.outfile = open(os.path.join(self.path, f"{table}.csv"), 'w', newline='')
+        self.writer = csv.writer(self.outfile)
+        self.writer.writerow(columns)
+
+    def write_batch(self, batch):
+        self.writer.writerows(batch)
+
+    def end_table(self):
+        self.outfile.close()
+
+    def close(self):
+        pass
+
+
+class ParquetExporter:
+    # one <table>.parquet file per table in the output directory, one row group per batch
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            ibdiag.log.error(f"*** Error: --export_format parquet needs the 'pyarrow' package")
+            exit(1)
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.types = {'int': pyarrow.int64(), 'float': pyarrow.float64(), 'str': pyarrow.string()}
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.schema = None
+        self.writer = None
+
+    def begin_table(self, table, columns):
+        # the schema is declared rather than inferred: a column that is all None in the first batch
+        # would otherwise get type null, and later batches with values would fail to cast
+        self.schema = self.pa.schema([(c, self.types[t]) for c, t in zip(columns, PARQUET_COLUMN_TYPES[table])])
+        self.writer = self.pq.ParquetWriter(os.path.join(self.path, f"{table}.parquet"), self.schema)
+
+    def write_batch(self, batch):
+        data = {c: [row[i] for row in batch] for i, c in enumerate(self.schema.names)}
+        self.writer.write_table(self.pa.Table.from_pydict(data, schema=self.schema))
+
+    def end_table(self):
+        self.writer.close()
+
+    def close(self):
+        pass
+
+
+class SqliteExporter:
+    # all tables in one database file, which is replaced if it exists; indexes are created after each
+    # table is loaded, which is faster than maintaining them during the inserts
+    def __init__(self, path):
+        import sqlite3
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.table = None
+        self.insert_sql = None
+
+    def begin_table(self, table, columns):
+        self.table = table
+        self.db.execute(f"CREATE TABLE {table} ({', '.join(columns)})")
+        self.insert_sql = f"INSERT INTO {table} VALUES ({', '.join('?' * len(columns))})"
+
+    def write_batch(self, batch):
+        self.db.executemany(self.insert_sql, batch)
+
+    def end_table(self):
+        for columns in SQLITE_INDEXES.get(self.table, []):
+            self.db.execute(f"CREATE INDEX {self.table}_{'_'.join(columns)} ON {self.table} ({', '.join(columns)})")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+EXPORTERS = {'csv': CsvExporter, 'parquet': ParquetExporter, 'sqlite': SqliteExporter}
+
+
+def get_default_export_path(export_format):
+    return "ibdiag.sqlite" if export_format == "sqlite" else f"ibdiag_{export_format}"
+
+
+def export_tables(switches, endpoints, export_format, path, batch_rows=DEFAULT_BATCH_ROWS):
+    exporter = EXPORTERS[export_format](path)
+    for title, header, _, row_func in ibdiag_xlsx.XLSX_SHEETS:
+        table = get_sql_name(title)
+        with ibdiag_metrics.span(table) as span:
+            exporter.begin_table(table, [get_sql_name(h) for h in header])
+            span.items = 0
+            for batch in iter_batches(row_func(switches, endpoints), batch_rows):
+                exporter.write_batch(batch)
+                span.items += len(batch)
+            exporter.end_table()
+    exporter.close()
+
+
+def get_arg_parser(description="ibdiag_export: Export IB fabric tables to CSV, Parquet or SQLite"):
+    my_parser = ibdiag.get_arg_parser(description=description)
+    my_parser.add_argument("--export_format", dest="export_format", choices=EXPORT_FORMATS, default="csv",
+        help="csv or parquet: one file per table in a directory; sqlite: one database file, with indexes "
+             "on the LID, switch and port columns")
+    my_parser.add_argument("--export_path", dest="export_path", default=None,
+        help="output directory (csv, parquet) or database file (sqlite); default ibdiag_csv, ibdiag_parquet "
+             "or ibdiag.sqlite")
+    my_parser.add_argument("--export_batch_rows", dest="export_batch_rows", type=int, default=DEFAULT_BATCH_ROWS,
+        help="number of rows written per batch")
+    return my_parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    ibdiag.configure_logging(args)
+    ibdiag_metrics.configure(args)
+    switches, endpoints = ibdiag.do_diag_run(args)
+    path = args.export_path or get_default_export_path(args.export_format)
+    with ibdiag_metrics.span("export", format=args.export_format):
+        export_tables(switches, endpoints, args.export_format, path, max(1, args.export_batch_rows))
+    ibdiag.log.info(f"Fabric tables exported to {path}")
+    ibdiag_metrics.finish()
+
+
+if __name__ == '__main__':
+    main()
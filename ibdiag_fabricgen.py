@@ -0,0 +1,258 @@
+import argparse
+import collections
+import os
+import time
+
+# Synthetic fat-tree fabric generator.  Produces text in the formats of 'ibswitches',
+# 'iblinkinfo --switches-only -l' and concatenated 'ibroute <lid>' output, so the whole
+# ibdiag pipeline can be exercised and timed without access to a live fabric.
+
+SPEED_STRINGS = {
+    "HDR": "4X 53.125 Gbps",
+    "EDR": "4X 25.78125 Gbps",
+    "FDR": "4X 14.0625 Gbps",
+    "QDR": "4X 10.0 Gbps",
+}
+
+
+class GenSwitch:
+    def __init__(self, lid, name, guid, portcount, tier):
+        self.lid = lid
+        self.name = name
+        self.guid = guid
+        self.portcount = portcount
+        self.tier = tier
+        self.ports = {}     # port -> (GenSwitch | GenHostPort, remote port)
+        self.next_port = 1
+
+    def take_port(self):
+        port = self.next_port
+        self.next_port += 1
+        return port
+
+
+class GenHostPort:
+    def __init__(self, lid, name, guid):
+        self.lid = lid
+        self.name = name
+        self.guid = guid
+
+
+class GenFabric:
+    def __init__(self, speed="HDR"):
+        self.switches = []
+        self.hostports = []
+        self.next_lid = 1
+        self.next_guid = 0x98039b0300a00000
+        self.speed = SPEED_STRINGS.get(speed, speed)
+
+    def _new_lid(self):
+        lid = self.next_lid
+        self.next_lid += 1
+        return lid
+
+    def _new_guid(self):
+        guid = self.next_guid
+        self.next_guid += 0x10
+        return guid
+
+    def add_switch(self, name, portcount, tier):
+        sw = GenSwitch(self._new_lid(), name, self._new_guid(), portcount, tier)
+        self.switches.append(sw)
+        return sw
+
+    def link_switches(self, sw1, sw2):
+        p1, p2 = sw1.take_port(), sw2.take_port()
+        sw1.ports[p1] = (sw2, p2)
+        sw2.ports[p2] = (sw1, p1)
+
+    def add_hostport(self, sw, name):
+        hp = GenHostPort(self._new_lid(), name, self._new_guid())
+        self.hostports.append(hp)
+        sw.ports[sw.take_port()] = (hp, 1)
+        return hp
+
+
+def get_group_size(count, half, radix):
+    # number of upper switches needed so that 'count' lower switches with 'half' uplinks each fit
+    # in their 'radix' ports; each lower switch then runs half // size parallel links to each of them
+    return min(half, max(1, -(-count * half // radix)))
+
+
+def build_fat_tree(hosts, tiers=None, radix=40, ports_per_host=1, speed="HDR"):
+    # leaves use half their ports for hosts and half for uplinks.  2 tiers: leaves x spines.  3 tiers:
+    # pods of radix/2 leaves fully connected to radix/2 aggregation switches; aggregation switch i of
+    # every pod uplinks to core group i.
+    fabric = GenFabric(speed)
+    half = radix // 2
+    host_ports = hosts * ports_per_host
+    num_leaves = max(1, -(-host_ports // half))
+    if tiers is None:
+        tiers = 2 if num_leaves <= radix else 3
+    if tiers == 2:
+        if num_leaves > radix:
+            raise ValueError(f"{host_ports} host ports don't fit a 2-tier radix {radix} fat tree; use 3 tiers")
+        num_spines = get_group_size(num_leaves, half, radix)
+        spines = [fabric.add_switch(f"MF0;spine{i + 1:02}:MQM8700/U1", radix, 1) for i in range(num_spines)]
+        leaves = [fabric.add_switch(f"MF0;leaf{i + 1:03}:MQM8700/U1", radix, 0) for i in range(num_leaves)]
+        for leaf in leaves:
+            for spine in spines:
+                for _ in range(half // num_spines):
+                    fabric.link_switches(leaf, spine)
+    else:
+        num_pods = -(-num_leaves // half)
+        if num_pods > radix:
+            raise ValueError(f"{host_ports} host ports don't fit a 3-tier radix {radix} fat tree")
+        group_size = get_group_size(num_pods, half, radix)
+        core_groups = [[fabric.add_switch(f"MF0;core{g + 1:02}-{c + 1:02}:MQM8700/U1", radix, 2)
+                        for c in range(group_size)] for g in range(half)]
+        leaves = []
+        for pod in range(num_pods):
+            aggs = [fabric.add_switch(f"MF0;p{pod + 1:02}-agg{i + 1:02}:MQM8700/U1", radix, 1)
+                    for i in range(half)]
+            pod_leaves = [fabric.add_switch(f"MF0;p{pod + 1:02}-leaf{i + 1:02}:MQM8700/U1", radix, 0)
+                          for i in range(min(half, num_leaves - len(leaves)))]
+            for leaf in pod_leaves:
+                for agg in aggs:
+                    fabric.link_switches(leaf, agg)
+            for agg, group in zip(aggs, core_groups):
+                for core in group:
+                    for _ in range(half // group_size):
+                        fabric.link_switches(agg, core)
+            leaves += pod_leaves
+    # host ports are dealt round-robin over the leaves, so multi-port hosts span adjacent leaves
+    for h in range(hosts):
+        for p in range(ports_per_host):
+            fabric.add_hostport(leaves[(h * ports_per_host + p) % num_leaves], f"host{h + 1:05} mlx5_{p}")
+    return fabric
+
+
+def compute_lfts(fabric):
+    # min-hop up/down routing with d-mod-k among equal-cost ports.  Host ports are ranked leaf by leaf,
+    # in port order, and each tier picks with its own digit of the rank: a switch divides it by the
+    # product of the up port counts of the tiers below before taking it modulo its up port count, and
+    # uses the digit of the tier below for its parallel down ports.  Every uplink of a leaf and every
+    # parallel link then carries an equal share of the destinations.
+    host_switch = {}
+    for sw in fabric.switches:
+        for port, (remote, _) in sw.ports.items():
+            if isinstance(remote, GenHostPort):
+                host_switch[remote.lid] = (sw, port)
+    dests_by_switch = collections.defaultdict(list)
+    for sw in fabric.switches:
+        dests_by_switch[sw.lid].append(sw.lid)
+    rank = {sw.lid: sw.lid for sw in fabric.switches}
+    for sw in fabric.switches:
+        for port, (remote, _) in sorted(sw.ports.items()):
+            if isinstance(remote, GenHostPort):
+                dests_by_switch[sw.lid].append(remote.lid)
+                rank[remote.lid] = len(rank) - len(fabric.switches)
+    up_ports = collections.Counter()
+    for sw in fabric.switches:
+        up = sum(1 for remote, _ in sw.ports.values() if isinstance(remote, GenSwitch) and remote.tier > sw.tier)
+        up_ports[sw.tier] = max(up_ports[sw.tier], up)
+    divisor = [1]
+    for tier in range(max(sw.tier for sw in fabric.switches)):
+        divisor.append(divisor[-1] * max(1, up_ports[tier]))
+    lfts = {sw.lid: {} for sw in fabric.switches}
+    for dest_sw in fabric.switches:
+        dist = {dest_sw.lid: 0}
+        queue = collections.deque([dest_sw])
+        while queue:
+            cur = queue.popleft()
+            for remote, _ in cur.ports.values():
+                if isinstance(remote, GenSwitch) and remote.lid not in dist:
+                    dist[remote.lid] = dist[cur.lid] + 1
+                    queue.append(remote)
+        for sw in fabric.switches:
+            if sw.lid not in dist:
+                continue
+            candidates = [(p, remote.tier > sw.tier) for p, (remote, _) in sorted(sw.ports.items())
+                          if isinstance(remote, GenSwitch) and dist.get(remote.lid, -1) == dist[sw.lid] - 1]
+            lft = lfts[sw.lid]
+            if sw is dest_sw:
+                for d in dests_by_switch[dest_sw.lid]:
+                    lft[d] = 0 if d == sw.lid else host_switch[d][1]
+                continue
+            digit = divisor[sw.tier] if candidates[0][1] else divisor[max(0, sw.tier - 1)]
+            for d in dests_by_switch[dest_sw.lid]:
+                lft[d] = candidates[rank[d] // digit % len(candidates)][0]
+    return lfts
+
+
+def write_switches(fabric, out):
+    for sw in fabric.switches:
+        out.write(f'Switch\t: 0x{sw.guid:016x} ports {sw.portcount} "{sw.name}" '
+                  f'enhanced port 0 lid {sw.lid} lmc 0\n')
+
+
+def write_linkinfo(fabric, out):
+    for sw in fabric.switches:
+        padded = sw.name.rjust(40)
+        for port in range(1, sw.portcount + 1):
+            if port in sw.ports:
+                remote, rport = sw.ports[port]
+                out.write(f'0x{sw.guid:016x} "{padded}" {sw.lid:5} {port:4}[  ] ==( {fabric.speed} Active/  LinkUp)==>'
+                          f'  0x{remote.guid:016x} {remote.lid:5} {rport:4}[  ] "{remote.name}" ( )\n')
+            else:
+                out.write(f'0x{sw.guid:016x} "{padded}" {sw.lid:5} {port:4}[  ] ==(                Down/ Polling)==>'
+                          f'             [  ] "" ( )\n')
+
+
+def write_routes(fabric, lfts, out):
+    info = {}
+    for sw in fabric.switches:
+        info[sw.lid] = f"(Switch portguid 0x{sw.guid:016x}: '{sw.name}')"
+    for hp in fabric.hostports:
+        info[hp.lid] = f"(Channel Adapter portguid 0x{hp.guid:016x}: '{hp.name}')"
+    top = fabric.next_lid - 1
+    for sw in fabric.switches:
+        lft = lfts[sw.lid]
+        out.write(f"Unicast lids [0x0-0x{top:x}] of switch Lid {sw.lid} guid 0x{sw.guid:016x} ({sw.name}):\n")
+        out.write("  Lid  Out   Destination\n       Port     Info \n")
+        out.writelines(f"0x{lid:04x} {lft[lid]:03} : {info[lid]}\n" for lid in sorted(lft))
+        out.write(f"{len(lft)} valid lids dumped \n")
+
+
+def write_fabric_files(fabric, outdir, prefix="fabric"):
+    os.makedirs(outdir, exist_ok=True)
+    lfts = compute_lfts(fabric)
+    names = {}
+    for kind, writer in (("switches", write_switches), ("links", write_linkinfo), ("routes", write_routes)):
+        names[kind] = os.path.join(outdir, f"{prefix}-{kind}.txt")
+        with open(names[kind], "w") as out:
+            if kind == "routes":
+                writer(fabric, lfts, out)
+            else:
+                writer(fabric, out)
+    return names["switches"], names["links"], names["routes"]
+
+
+def get_arg_parser(description="ibdiag_fabricgen: Generate synthetic fat-tree ibdiag input files"):
+    argparser = argparse.ArgumentParser(description=description, add_help=True)
+    argparser.add_argument("--hosts", dest="hosts", type=int, default=64, help="number of hosts")
+    argparser.add_argument("--tiers", dest="tiers", type=int, choices=[2, 3], default=None,
+                           help="fat-tree tiers (default: 2 if the hosts fit, otherwise 3)")
+    argparser.add_argument("--radix", dest="radix", type=int, default=40, help="switch port count")
+    argparser.add_argument("--ports_per_host", dest="ports_per_host", type=int, default=1,
+                           help="HCA ports per host")
+    argparser.add_argument("--speed", dest="speed", default="HDR", choices=sorted(SPEED_STRINGS),
+                           help="link speed")
+    argparser.add_argument("--outdir", dest="outdir", default="fabricgen", help="output directory")
+    argparser.add_argument("--prefix", dest="prefix", default="fabric",
+                           help="output file name prefix: <prefix>-switches.txt, <prefix>-links.txt, "
+                                "<prefix>-routes.txt")
+    return argparser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    time_a = time.time()
+    fabric = build_fat_tree(args.hosts, args.tiers, args.radix, args.ports_per_host, args.speed)
+    files = write_fabric_files(fabric, args.outdir, args.prefix)
+    print(f"{len(fabric.switches)} switches, {len(fabric.hostports)} host ports written to {files} "
+          f"in {time.time() - time_a:.2f} seconds.")
+
+
+if __name__ == '__main__':
+    main()
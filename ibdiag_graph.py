@@ -1,20 +1,25 @@
-from typing import Union
-import networkx as nx
-
 import ibdiag
+import ibdiag_metrics
 import ibdiag_xlsx
 import argparse
-import time
+import collections
+import itertools
+import json
+import math
 import sys
 import random
 import os
-import re
 
-import matplotlib
-import matplotlib.pyplot as plt
-matplotlib.use("agg")
-# matplotlib.use("pdf")
-# matplotlib.use("macosx")
+# networkx, matplotlib and numpy are imported by the functions that draw, so --xlsx_only runs and
+# modules that only need the argument parser don't pay for loading them
+
+def import_pyplot():
+    import matplotlib
+    matplotlib.use("agg")
+    # matplotlib.use("pdf")
+    # matplotlib.use("macosx")
+    import matplotlib.pyplot as plt
+    return plt
 
 # import bokeh.io
 # import bokeh.plotting
@@ -81,22 +86,14 @@ def get_speed_edge_color(speedinfo):
 #    print("Plotting bokeh html")
 #    bokeh.io.save(plot)
 
-def expand_hostlist(args, endpoints):
-    hosts = args.graph_subset
-
-    hosts_l = hosts.split(",")
-    if len(hosts_l) > 1:
-        hosts_l = "^(" + "|".join(hosts_l) + ")$"
-    else:
-        hosts_l = hosts_l[0]
-    regex = re.compile(hosts_l)
-    hostnames, _ = ibdiag.get_hostinfo_tables(endpoints)
-    result_list = []
-    for h in hostnames:
-        if regex.match(h):
-            result_list.append(h)
-    print(result_list)
-    result_list = ",".join(result_list)
+def expand_hostlist(args, endpoints, host_index=None):
+    # a single --graph_subset pattern matches from the start of host names; a comma separated list of
+    # them must match whole names
+    hosts_l = [h for h in args.graph_subset.replace(" ", "").split(",") if h != ""]
+    if host_index is None:
+        host_index = ibdiag.get_host_index(endpoints)
+    result_list = host_index.match_patterns(hosts_l, anchored_end=len(hosts_l) > 1)
+    ibdiag.log.debug(result_list)
     return result_list
 
 def graph_add_core_node_attrs(node_attrs, lid, type, color, width, height=None, label=None):
@@ -115,7 +112,21 @@ def graph_add_edge_attrs(edge_attrs, edge, type, color, width, label=None):
     if label is not None:
         edge_attrs['labels'][edge] = label
 
-def graph_add_switch(sw, lid, gnx, core_layer, sw_layer, isl_edges, node_attrs, edge_attrs, sw_label = None):
+def get_speed_gb(speedinfo):
+    # numeric speed for ordering; unrecognized speed strings sort lowest
+    speed = short_speed_info(speedinfo)
+    return int(speed[:-2]) if speed.endswith("Gb") and speed[:-2].isdigit() else 0
+
+def get_collapsed_edge_attrs(speeds):
+    # label, color and width of one edge standing for len(speeds) links: the color is the slowest
+    # link's, so a degraded link in a bundle stays visible
+    counts = collections.Counter(short_speed_info(sp) for sp in speeds)
+    label = ", ".join(f"{speed} x{count}" for speed, count in counts.most_common())
+    color = get_speed_edge_color(min(speeds, key=get_speed_gb))
+    return label, color, 1 + math.log2(len(speeds))
+
+def graph_add_switch(sw, lid, gnx, core_layer, sw_layer, isl_edges, node_attrs, edge_attrs, sw_label = None,
+                     switches=None, collapse=False):
     core_sw = 0
     if len(sw.endpoints) == 0:
         # outer_list[0].append(lid)
@@ -126,8 +137,23 @@ def graph_add_switch(sw, lid, gnx, core_layer, sw_layer, isl_edges, node_attrs,
         # outer_list[2].append(lid)
         gnx.add_node(lid, layer=sw_layer, size=20)
         graph_add_core_node_attrs(node_attrs, lid, 'leaf switch', 'skyblue', 25, 10, label=sw_label)
+    if collapse:
+        # parallel ISLs to the same switch become one weighted edge
+        dest_speeds = collections.defaultdict(list)
+        for p, (dest_sw, dest_swp, speed) in sw.isls.items():
+            if switches is None or dest_sw.lid in switches:
+                dest_speeds[dest_sw.lid].append(speed)
+        for dest_lid, speeds in dest_speeds.items():
+            edge = (lid, dest_lid, 0)
+            isl_edges.append(edge)
+            label, color, width = get_collapsed_edge_attrs(speeds)
+            gnx.add_edge(lid, dest_lid, label=label)
+            graph_add_edge_attrs(edge_attrs, edge, 'isl', color, width)
+        return core_sw
     for p, (dest_sw, dest_swp, speed) in sw.isls.items():
         # print("Destport, Speed: ", dest_swp, speed)
+        if switches is not None and dest_sw.lid not in switches:
+            continue
         edge = (lid, dest_sw.lid, gnx.new_edge_key(lid, dest_sw.lid))
         isl_edges.append(edge)
         isl_label = f"{short_speed_info(speed)}"
@@ -137,27 +163,108 @@ def graph_add_switch(sw, lid, gnx, core_layer, sw_layer, isl_edges, node_attrs,
         graph_add_edge_attrs(edge_attrs, edge, 'isl', get_speed_edge_color(speed), 1)
     return core_sw
 
-def graph_draw_nx_edges(gnx, pos, widths):
-    drawn = []
-    arrowstyle = "<|-|>"
-    for e in gnx.edges(keys=True, data=True):
-        (u, v, key, data) = e
-        # print(e)
+ARC_POINTS = 16
+
+def get_edge_rad(key):
+    # parallel edges between two nodes get alternating, widening arcs
+    rad = .01 * (key + 1)
+    return -rad if key % 2 == 0 else rad
+
+def get_arc_segments(starts, ends, rad, count=ARC_POINTS):
+    # points along the quadratic Bezier curve matplotlib's "arc3,rad=<rad>" connection style draws
+    # between each start and end point, for all edges at once: shape (edges, count, 2)
+    import numpy as np
+    mid = (starts + ends) / 2
+    delta = ends - starts
+    control = mid + rad * np.stack([delta[:, 1], -delta[:, 0]], axis=1)
+    t = np.linspace(0, 1, count)[None, :, None]
+    return ((1 - t) ** 2 * starts[:, None, :] + 2 * (1 - t) * t * control[:, None, :]
+            + t ** 2 * ends[:, None, :])
+
+def get_arrowheads(ax, segments, sizes_a, sizes_b, length=4, half_width=2):
+    # the "<|-|>" heads of all edges at once: a triangle at both ends of every arc, with its tip on the
+    # edge of the node marker (sizes in points^2, as node_size) like FancyArrowPatch's shrinkA/shrinkB.
+    # Lengths are in points; the triangles are built in display space and returned in data coordinates
+    import numpy as np
+    scale = ax.figure.dpi / 72
+    display = ax.transData.transform(segments.reshape(-1, 2)).reshape(segments.shape)
+    heads = []
+    for center, inner, sizes in [(display[:, 0], display[:, 1], sizes_a), (display[:, -1], display[:, -2], sizes_b)]:
+        direction = center - inner
+        direction /= np.maximum(np.linalg.norm(direction, axis=1, keepdims=True), 1e-9)
+        tip = center - direction * (np.sqrt(sizes) / 2 * scale)[:, None]
+        base = tip - direction * (length * scale)
+        normal = np.stack([-direction[:, 1], direction[:, 0]], axis=1) * (half_width * scale)
+        heads.append(np.stack([tip, base + normal, base - normal], axis=1))
+    heads = np.concatenate(heads)
+    return ax.transData.inverted().transform(heads.reshape(-1, 2)).reshape(heads.shape)
+
+def graph_draw_nx_edges(gnx, pos, node_sizes):
+    # one LineCollection and one PolyCollection of arrowheads per (color, width, arc radius) instead of
+    # one artist per edge; an ISL is in the graph in both directions and only drawn once.
+    # node_sizes: {node: marker size}, as passed to draw_networkx_nodes
+    import numpy as np
+    from matplotlib.collections import LineCollection, PolyCollection
+    plt = import_pyplot()
+    drawn = set()
+    groups = collections.defaultdict(list)
+    for (u, v, key, data) in gnx.edges(keys=True, data=True):
         if (v, u, key) in drawn:
             continue
-        rad = .01 * (key + 1)
-        if key % 2 == 0:
-            rad = -rad
-        arcstyle = "arc3,rad=" + str(rad)
-        nx.draw_networkx_edges(gnx, pos, edgelist=[e], connectionstyle=arcstyle, width=data['width'], 
-            edge_color=data['color'], node_size=widths, arrowstyle=arrowstyle)
-        drawn.append((u, v, key))
+        drawn.add((u, v, key))
+        groups[(data['color'], data['width'], get_edge_rad(key))].append((u, v))
+    ax = plt.gca()
+    arcs = {}
+    for (color, width, rad), edges in groups.items():
+        starts = np.array([pos[u] for u, _ in edges], dtype=float)
+        ends = np.array([pos[v] for _, v in edges], dtype=float)
+        arcs[(color, width, rad)] = get_arc_segments(starts, ends, rad)
+        ax.add_collection(LineCollection(arcs[(color, width, rad)], colors=color, linewidths=width, zorder=1))
+    # the arrowheads are sized in display space, so the data limits have to be final first
+    ax.autoscale_view()
+    for (color, width, rad), edges in groups.items():
+        sizes_a = np.array([node_sizes[u] for u, _ in edges], dtype=float)
+        sizes_b = np.array([node_sizes[v] for _, v in edges], dtype=float)
+        heads = get_arrowheads(ax, arcs[(color, width, rad)], sizes_a, sizes_b)
+        ax.add_collection(PolyCollection(heads, facecolors=color, edgecolors=color, linewidths=width, zorder=1),
+                          autolim=False)
     edge_labels_dict = {}
     for (u, v, data) in gnx.edges.data(keys=False):
-        edge_labels_dict[(u, v)] = data['label']
-    nx.draw_networkx_edge_labels(gnx, pos, edge_labels=edge_labels_dict)
+        if (v, u) not in edge_labels_dict:
+            edge_labels_dict[(u, v)] = data['label']
+    graph_draw_edge_labels(ax, pos, edge_labels_dict)
+
+def graph_draw_edge_labels(ax, pos, edge_labels_dict):
+    # plain text artists at the edge midpoints, turned along the edge like nx.draw_networkx_edge_labels
+    # does - its curved-arrow labels recompute their path on every draw, which dominated savefig
+    import numpy as np
+    if len(edge_labels_dict) == 0:
+        return
+    ax.autoscale_view()
+    starts = np.array([pos[u] for u, _ in edge_labels_dict], dtype=float)
+    ends = np.array([pos[v] for _, v in edge_labels_dict], dtype=float)
+    mids = (starts + ends) / 2
+    delta = ax.transData.transform(ends) - ax.transData.transform(starts)
+    angles = np.degrees(np.arctan2(delta[:, 1], delta[:, 0]))
+    angles = np.where(angles > 90, angles - 180, np.where(angles < -90, angles + 180, angles))
+    bbox = dict(boxstyle="round", ec=(1.0, 1.0, 1.0), fc=(1.0, 1.0, 1.0))
+    for (x, y), angle, label in zip(mids, angles, edge_labels_dict.values()):
+        ax.text(x, y, label, size=10, ha="center", va="center", rotation=angle, rotation_mode="anchor",
+                bbox=bbox, zorder=1, clip_on=True)
+
+def graph_add_endpoint_summary(sw, gnx, ep_layer, end_edges, node_attrs, edge_attrs, endpoints):
+    # one node for all of a leaf switch's (selected) endpoints, with their count per speed
+    node = ('endpoints', sw.lid)
+    gnx.add_node(node, layer=ep_layer)
+    label, color, width = get_collapsed_edge_attrs([ep.speed for ep in endpoints])
+    node_label = f"{len(endpoints)} endpoint(s)\n" + label.replace(", ", "\n")
+    graph_add_core_node_attrs(node_attrs, node, 'endpoints', 'wheat', 20, 6, label=node_label)
+    edge = (sw.lid, node, 0)
+    end_edges.append(edge)
+    graph_add_edge_attrs(edge_attrs, edge, 'edge', color, width, label=f"{len(endpoints)} port(s)")
 
 def set_nx_node_attributes(gnx, node_attrs):
+    import networkx as nx
     nx.set_node_attributes(gnx, node_attrs['types'], 'types')
     nx.set_node_attributes(gnx, node_attrs['colors'], 'colors')
     nx.set_node_attributes(gnx, node_attrs['labels'], 'names')
@@ -166,6 +273,7 @@ def set_nx_node_attributes(gnx, node_attrs):
     nx.set_node_attributes(gnx, node_attrs['ports'], 'ports')
 
 def set_nx_edge_attributes(gnx, edge_attrs):
+    import networkx as nx
     nx.set_edge_attributes(gnx, edge_attrs['labels'], 'label')
     nx.set_edge_attributes(gnx, edge_attrs['colors'], 'color')
     nx.set_edge_attributes(gnx, edge_attrs['widths'], 'width')
@@ -182,7 +290,7 @@ def update_switch_layer_info(sw_layer, core_layer, uppertotal, lowertotal, added
     return sw_layer, core_layer, uppertotal, lowertotal
 
 def adjust_positions(pos, switches, figsize):
-    print(f"len pos: {len(pos)}, switches: {len(switches)}, figsize={figsize}")
+    ibdiag.log.debug(f"len pos: {len(pos)}, switches: {len(switches)}, figsize={figsize}")
     ep_adjustx = .2/13   # shift within layer/number layers
     sw_adjustx, sw_adjusty = 0, 0
     if len(switches) > 2:
@@ -200,73 +308,153 @@ def adjust_positions(pos, switches, figsize):
         else:
             v[0] = v[0] - (ep_adjustx * shift)
 
-def do_switch_graph(switches, filename="graph", host_list=None):
+def get_graph_positions(gnx, switches, node_keys, layout, figsize):
+    # Node positions from layout ({node key: [x, y]}, updated in place) where it has them.  Only when
+    # some node is missing is a fresh layout computed; a new node is then put at its fresh offset from
+    # a neighbor that already has a position, so the rest of the picture doesn't move.
+    import networkx as nx
+    import numpy as np
+    pos = {n: np.array(layout[k], dtype=float) for n, k in node_keys.items() if k in layout}
+    if len(pos) < len(node_keys):
+        fresh = nx.multipartite_layout(gnx, subset_key="layer", align='vertical', scale=1)
+        adjust_positions(fresh, switches, figsize)
+        placed = dict(pos)
+        for n in gnx.nodes():
+            if n in placed:
+                continue
+            anchors = [m for m in itertools.chain(gnx.predecessors(n), gnx.successors(n)) if m in placed]
+            if len(anchors) > 0:
+                pos[n] = placed[anchors[0]] + (fresh[n] - fresh[anchors[0]])
+            else:
+                pos[n] = fresh[n]
+        layout.update({node_keys[n]: [float(x), float(y)] for n, (x, y) in pos.items()})
+    return pos
+
+def load_graph_layouts(filename):
+    # {layout name: {node key: [x, y]}} from a layout file, or from the extras of a fabric snapshot
+    if filename is None or not os.path.isfile(filename):
+        return {}
+    import ibdiag_snapshot
+    if ibdiag_snapshot.is_snapshot_file(filename):
+        return ibdiag_snapshot.load_snapshot(filename)[2].get('graph_layouts', {})
+    with open(filename, 'r') as infile:
+        return json.load(infile)
+
+def save_graph_layouts(filename, layouts):
+    tmpname = f"{filename}.{os.getpid()}.tmp"
+    with open(tmpname, 'w') as outfile:
+        json.dump(layouts, outfile)
+    os.replace(tmpname, filename)
+
+def save_run_graph_layouts(parsed_args, layouts, switches, endpoints):
+    # back into the layout file, unless that is a snapshot, and into the --save_snapshot snapshot
+    import ibdiag_snapshot
+    layout_file = parsed_args.graph_layout_file
+    if layout_file is not None and not (os.path.isfile(layout_file) and ibdiag_snapshot.is_snapshot_file(layout_file)):
+        save_graph_layouts(layout_file, layouts)
+        ibdiag.log.info(f"Graph layout saved to {layout_file}")
+    if parsed_args.save_snapshot is not None:
+        ibdiag_snapshot.save_snapshot(parsed_args.save_snapshot, switches, endpoints, {'graph_layouts': layouts})
+        ibdiag.log.info(f"Graph layout saved with the fabric snapshot {parsed_args.save_snapshot}")
+
+def do_switch_graph(switches, filename="graph", host_list=None, collapse=False, layout=None):
+    # collapse: per leaf switch one summary node for its endpoints, and one weighted edge per switch pair
+    # instead of one per ISL, so the graph's size depends on the switch count only.
+    # layout: {node key: [x, y]} positions to reuse, updated with the positions of this graph
+    import matplotlib.lines
+    import networkx as nx
+    plt = import_pyplot()
     labeldict = {}
     isl_edges, isl_nodes, end_edges, end_nodes = [], [], [], []
+    node_keys = {}
     if host_list is not None:
-        host_list = host_list.replace(" ", "")
-        host_list = host_list.split(",")
-
-    core_layer, sw_layer = 0, 2
-    core_count = 0
-    uppertotal = lowertotal = 0
-    node_attrs = {'types': {}, 'colors': {}, 'labels': {}, 'names': {}, 'heights': {}, 'widths': {}, 'ports': {}}
-    edge_attrs = {'labels': {}, 'types': {}, 'colors': {}, 'widths': {}}
-    gnx = nx.MultiDiGraph()
-    for lid, sw in switches.items():
-        isl_nodes.append(lid)
-        sw_display_name = sw.name.replace(" - ", "- ")
-        sw_display_name = sw_display_name.replace(" ", "\n")
-        sw_label = f"{sw_display_name}\n{len(sw.connections)}/{sw.portcount} ports up\n(lid {lid})"
-        core_count += graph_add_switch(sw, lid, gnx, core_layer, sw_layer, isl_edges, node_attrs, edge_attrs, sw_label=sw_label)
-        endpoints_added = 0
-        for port, ep in sw.endpoints.items():
-            if host_list is None or ibdiag.get_portstripped_hostname(ep.name) in host_list:
-                labeldict[ep.lid] = ep.name
-                end_nodes.append(ep.lid)
-                endpoints_added += 1
-                if sw_layer < core_layer:
-                    #ep_layer = sw_layer - random.randrange(3, 6)
-                    ep_layer = sw_layer - ((ep.lid % 3) + 3)
-                else:
-                    #ep_layer = sw_layer + random.randrange(3, 6)
-                    ep_layer = sw_layer + ((ep.lid % 3) + 3)
-                gnx.add_node(ep.lid, layer=ep_layer)
-                if ep.name.find("weka") > -1:
-                    node_color = "lavender"
-                else:
-                    node_color = "wheat"
-                node_label = ep.name.replace(' ', '\n') + f"\nport {port}\n{ep.lid}"
-                node_attrs['ports'][ep.lid] = port
-                graph_add_core_node_attrs(node_attrs, ep.lid, 'node', node_color, 12, 4, label = node_label)
-                node_edge = (ep.switch.lid, ep.lid, gnx.new_edge_key(ep.switch.lid, ep.lid))
-                end_edges.append(node_edge)
-                edge_label = f"port {port} ({short_speed_info(ep.speed)})"
-                graph_add_edge_attrs(edge_attrs, node_edge, 'edge', get_speed_edge_color(ep.speed), 1, label=edge_label)
-        sw_layer, core_layer, uppertotal, lowertotal = \
-            update_switch_layer_info(sw_layer, core_layer, uppertotal, lowertotal, endpoints_added)
+        # host names, as a comma separated string or a collection; looked up once per endpoint
+        if isinstance(host_list, str):
+            host_list = host_list.replace(" ", "").split(",")
+        host_list = set(host_list)
+
+    with ibdiag_metrics.span("build") as span:
+        core_layer, sw_layer = 0, 2
+        core_count = 0
+        uppertotal = lowertotal = 0
+        node_attrs = {'types': {}, 'colors': {}, 'labels': {}, 'names': {}, 'heights': {}, 'widths': {}, 'ports': {}}
+        edge_attrs = {'labels': {}, 'types': {}, 'colors': {}, 'widths': {}}
+        gnx = nx.MultiDiGraph()
+        # GUID order, so the layers switches end up in don't depend on the order they were discovered in
+        for lid, sw in sorted(switches.items(), key=lambda item: item[1].guid):
+            isl_nodes.append(lid)
+            node_keys[lid] = f"sw:{sw.guid}"
+            sw_display_name = sw.name.replace(" - ", "- ")
+            sw_display_name = sw_display_name.replace(" ", "\n")
+            sw_label = f"{sw_display_name}\n{len(sw.connections)}/{sw.portcount} ports up\n(lid {lid})"
+            core_count += graph_add_switch(sw, lid, gnx, core_layer, sw_layer, isl_edges, node_attrs, edge_attrs,
+                                           sw_label=sw_label, switches=switches, collapse=collapse)
+            endpoints_added = 0
+            if collapse:
+                selected = [ep for ep in sw.endpoints.values()
+                            if host_list is None or ibdiag.get_portstripped_hostname(ep.name) in host_list]
+                if len(selected) > 0:
+                    ep_layer = sw_layer - 3 if sw_layer < core_layer else sw_layer + 3
+                    graph_add_endpoint_summary(sw, gnx, ep_layer, end_edges, node_attrs, edge_attrs, selected)
+                    node_keys[('endpoints', lid)] = f"eps:{sw.guid}"
+                    endpoints_added = 1
+            else:
+                for port, ep in sw.endpoints.items():
+                    if host_list is None or ibdiag.get_portstripped_hostname(ep.name) in host_list:
+                        labeldict[ep.lid] = ep.name
+                        end_nodes.append(ep.lid)
+                        endpoints_added += 1
+                        if sw_layer < core_layer:
+                            #ep_layer = sw_layer - random.randrange(3, 6)
+                            ep_layer = sw_layer - ((ep.lid % 3) + 3)
+                        else:
+                            #ep_layer = sw_layer + random.randrange(3, 6)
+                            ep_layer = sw_layer + ((ep.lid % 3) + 3)
+                        gnx.add_node(ep.lid, layer=ep_layer)
+                        node_keys[ep.lid] = f"ep:{sw.guid}:{port}"
+                        if ep.name.find("weka") > -1:
+                            node_color = "lavender"
+                        else:
+                            node_color = "wheat"
+                        node_label = ep.name.replace(' ', '\n') + f"\nport {port}\n{ep.lid}"
+                        node_attrs['ports'][ep.lid] = port
+                        graph_add_core_node_attrs(node_attrs, ep.lid, 'node', node_color, 12, 4, label = node_label)
+                        node_edge = (ep.switch.lid, ep.lid, gnx.new_edge_key(ep.switch.lid, ep.lid))
+                        end_edges.append(node_edge)
+                        edge_label = f"port {port} ({short_speed_info(ep.speed)})"
+                        graph_add_edge_attrs(edge_attrs, node_edge, 'edge', get_speed_edge_color(ep.speed), 1,
+                                             label=edge_label)
+            sw_layer, core_layer, uppertotal, lowertotal = \
+                update_switch_layer_info(sw_layer, core_layer, uppertotal, lowertotal, endpoints_added)
  
-    set_nx_node_attributes(gnx, node_attrs)
-    gnx.add_edges_from(end_edges)
-    set_nx_edge_attributes(gnx, edge_attrs)
+        set_nx_node_attributes(gnx, node_attrs)
+        gnx.add_edges_from(end_edges)
+        set_nx_edge_attributes(gnx, edge_attrs)
+        span.items = gnx.number_of_nodes() + gnx.number_of_edges()
 
-    print(f"isl_edges len: {len(isl_edges)}, end_edges len: {len(end_edges)}")
+    ibdiag.log.debug(f"isl_edges len: {len(isl_edges)}, end_edges len: {len(end_edges)}")
     #for (s, e, k) in isl_edges:
     #    if k == 0:
     #        print(f"Between switches: {s} and {e} there are {count_edges_for(isl_edges, s, e)} ISL(s)")
 
-    pos = nx.multipartite_layout(gnx, subset_key="layer", align='vertical', scale=1)
-    figsize = max(50, uppertotal / 2.5, lowertotal / 2.5, len(switches))
-    plt.figure(figsize=(figsize, figsize*1.3))
-    adjust_positions(pos, switches, figsize)
+    with ibdiag_metrics.span("layout") as span:
+        figsize = max(50, uppertotal / 2.5, lowertotal / 2.5, len(switches))
+        plt.figure(figsize=(figsize, figsize*1.3))
+        if layout is None:
+            pos = nx.multipartite_layout(gnx, subset_key="layer", align='vertical', scale=1)
+            adjust_positions(pos, switches, figsize)
+            span.items = len(pos)
+        else:
+            span.items = len([k for k in node_keys.values() if k not in layout])
+            pos = get_graph_positions(gnx, switches, node_keys, layout, figsize)
 
     colors = [c for (i, c) in gnx.nodes(data='colors')]
     widths = [w*400 for (i, w) in gnx.nodes(data='widths')]
-    time_a = time.time()
-    nx.draw_networkx_nodes(gnx, pos, list(gnx.nodes()), node_size=widths, node_color=colors)
-    nx.draw_networkx_labels(gnx, pos, labels=node_attrs['labels'])
-    graph_draw_nx_edges(gnx, pos, widths)
-    print(f"Calculating/adding edges and nodes took {time.time() - time_a} seconds.")
+    with ibdiag_metrics.span("draw") as span:
+        nx.draw_networkx_nodes(gnx, pos, list(gnx.nodes()), node_size=widths, node_color=colors)
+        nx.draw_networkx_labels(gnx, pos, labels=node_attrs['labels'])
+        graph_draw_nx_edges(gnx, pos, dict(zip(gnx.nodes(), widths)))
+        span.items = gnx.number_of_nodes() + gnx.number_of_edges()
     # not useful for now - sizing, spread, and multiple edges not handled well yet
     # do_bokeh_html_graph(gnx, pos, filename)
 
@@ -277,21 +465,29 @@ def do_switch_graph(switches, filename="graph", host_list=None):
         ]
     plt.legend(custom_legend_lines, ['200Gb', '100Gb', '56Gb', '40Gb', '10Gb or other'], loc='lower left', fontsize=20)
     plt.title('Infiniband network', fontsize=30)
-    time_a = time.time()
-    plt.savefig(filename + ".pdf", bbox_inches='tight', pad_inches=0.5)
-    print(f"plt.savefig took {time.time() - time_a} seconds.")
+    with ibdiag_metrics.span("savefig"):
+        plt.savefig(filename + ".pdf", bbox_inches='tight', pad_inches=0.5)
     plt.show()
+    plt.close()
 
 def get_arg_parser(description="ibdiag_graph: Generate IB network map(s) and excel data file"):
     my_parser = ibdiag_xlsx.get_arg_parser(description=description)
     my_parser.add_argument("--graph_subset", dest="graph_subset", default=None,
-                           help="comma separated list, or a regex, of names to be included in the graph")
+                           help="comma separated list, or a regex, of names to be included in the graph; a pattern "
+                                "that matches host names as written (e.g. 'cn3.2') is not taken as a regex")
     my_parser.add_argument("--graph_subset_file", dest="graph_subset_file", default="graph", 
         help="filename for graph subset output when --graph_subset is supplied")
     my_parser.add_argument("--graph_all_file", dest="graph_all_file", default="graph-full", 
         help="filename for full graph output; this file is always produced")
     my_parser.add_argument("--xlsx_only", dest="xlsx_only", action='store_true',
         help="if provided no graph(s) are generated, just a spreadsheet file")
+    my_parser.add_argument("--graph_collapse", dest="graph_collapse", action='store_true',
+        help="draw each leaf switch's endpoints as one summary node and parallel ISLs as one weighted edge, "
+             "for fabrics too large to draw every host")
+    my_parser.add_argument("--graph_layout_file", dest="graph_layout_file", default=None,
+        help="file the graph node positions are kept in: positions of nodes already in it are reused, new "
+             "nodes are placed next to their neighbors, and the file is updated; may also name a snapshot "
+             "saved by ibdiag_graph with --save_snapshot, to read the positions stored in it")
     return my_parser
 
 def get_args():
@@ -301,25 +497,34 @@ def get_args():
 
 def main():
     args = get_args()
-    time_a = time.time()
+    ibdiag.configure_logging(args)
+    ibdiag_metrics.configure(args)
     all_switches, all_endpoints = ibdiag.do_diag_run(args)
-    print(f"Diag run took {time.time() - time_a} seconds.  Processed {len(all_switches)} switches.")
-    print(all_switches)
-    ibdiag_xlsx.write_xlsx(all_switches, all_endpoints, args.xlsx_file)
+    ibdiag.log.info(f"Processed {len(all_switches)} switches.")
+    ibdiag.log.debug(all_switches)
+    with ibdiag_metrics.span("xlsx") as span:
+        ibdiag_xlsx.write_xlsx(all_switches, all_endpoints, args.xlsx_file, args.xlsx_max_rows, args.xlsx_overflow)
+        span.items = len(all_switches)
     if not args.xlsx_only:
-        print(f"Creating full graph...")
-        time_b = time.time()
-        do_switch_graph(all_switches, filename=args.graph_all_file, host_list=None)
-        print(f"Full graph took {time.time() - time_b}")
+        layouts, layout = None, None
+        if args.graph_layout_file is not None or args.save_snapshot is not None:
+            layouts = load_graph_layouts(args.graph_layout_file)
+            layout = layouts.setdefault("collapsed" if args.graph_collapse else "full", {})
+        ibdiag.log.info(f"Creating full graph...")
+        with ibdiag_metrics.span("graph_full"):
+            do_switch_graph(all_switches, filename=args.graph_all_file, host_list=None, collapse=args.graph_collapse,
+                            layout=layout)
         if args.graph_subset is not None:
-            time_b = time.time()
-            print(all_endpoints)
-            host_subset = expand_hostlist(args, all_endpoints)
-            print(f"Creating graph with graph_subset list: {args.graph_subset}")
-            print(f"hostlist expanded: {host_subset}")
-            do_switch_graph(all_switches, filename=args.graph_subset_file, host_list=host_subset)
-            print(f"SubGraph creation time: {time.time() - time_b} seconds.")
-    print(f"Full run took {time.time() - time_a} seconds.")
+            with ibdiag_metrics.span("graph_subset"):
+                ibdiag.log.debug(all_endpoints)
+                host_subset = expand_hostlist(args, all_endpoints)
+                ibdiag.log.info(f"Creating graph with graph_subset list: {args.graph_subset}")
+                ibdiag.log.debug(f"hostlist expanded: {host_subset}")
+                do_switch_graph(all_switches, filename=args.graph_subset_file, host_list=host_subset,
+                                collapse=args.graph_collapse, layout=layout)
+        if layouts is not None:
+            save_run_graph_layouts(args, layouts, all_switches, all_endpoints)
+    ibdiag_metrics.finish()
     # print(f"Graph created and saved in {args.graph_file}.")
 
 def use_uconn_sample_data():
@@ -0,0 +1,164 @@
+import contextlib
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:     # not available on Windows; peak RSS is then not recorded
+    resource = None
+
+log = logging.getLogger("ibdiag")
+
+# Phase timing for the ibdiag tools.  Code wraps each stage in a named span:
+#
+#     with ibdiag_metrics.span("xlsx") as s:
+#         ...
+#         s.items = len(switches)
+#
+# Spans nest (names are joined with '.', e.g. "graph.savefig") and record wall time, CPU time, the
+# process' peak RSS at the end of the span and how much the span raised it, plus an optional item
+# count.  Spans named in --profile additionally run under cProfile; a matching span nested in one
+# that is already being profiled is part of that profile rather than a profile of its own.
+
+
+class SpanRecord:
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_rss_mb = None
+        self.rss_growth_mb = None
+        self.items = None
+        self.attrs = {}
+
+    def to_dict(self):
+        result = {'name': self.name, 'wall_s': round(self.wall, 6), 'cpu_s': round(self.cpu, 6),
+                  'peak_rss_mb': self.peak_rss_mb, 'rss_growth_mb': self.rss_growth_mb}
+        if self.items is not None:
+            result['items'] = self.items
+        if len(self.attrs) > 0:
+            result['attrs'] = self.attrs
+        return result
+
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class PhaseMetrics:
+    def __init__(self):
+        self.spans = []
+        self.stack = []
+        self.profile = set()
+        self.profile_dir = "."
+        self.metrics_file = None
+        self.profiler = None        # the cProfile.Profile of the outermost profiled span, while it runs
+        self.started = time.time()
+
+    def configure(self, metrics_file=None, profile=None, profile_dir=None):
+        self.metrics_file = metrics_file
+        self.profile = set(p.strip() for p in profile.split(",")) if profile else set()
+        if profile_dir is not None:
+            self.profile_dir = profile_dir
+
+    def should_profile(self, full_name):
+        return 'all' in self.profile or full_name in self.profile or full_name.split('.')[-1] in self.profile
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        full_name = ".".join([s.name for s in self.stack] + [name])
+        record = SpanRecord(name, len(self.stack))
+        record.attrs.update(attrs)
+        self.spans.append((full_name, record))
+        self.stack.append(record)
+        profiler = None
+        if self.profiler is None and self.should_profile(full_name):
+            import cProfile
+            profiler = cProfile.Profile()
+        rss_before = get_peak_rss_mb()
+        wall_a, cpu_a = time.perf_counter(), time.process_time()
+        if profiler is not None:
+            try:
+                profiler.enable()
+                self.profiler = profiler
+            except ValueError as exc:
+                # another profiler (e.g. python -m cProfile) is active; Python 3.12+ allows only one
+                log.warning(f"Not profiling '{full_name}': {exc}")
+                profiler = None
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.profiler = None
+            record.wall = time.perf_counter() - wall_a
+            record.cpu = time.process_time() - cpu_a
+            record.peak_rss_mb = get_peak_rss_mb()
+            if rss_before is not None:
+                record.rss_growth_mb = round(record.peak_rss_mb - rss_before, 1)
+            self.stack.pop()
+            if profiler is not None:
+                self.write_profile(full_name, profiler)
+
+    def write_profile(self, full_name, profiler):
+        import io
+        import pstats
+        os.makedirs(self.profile_dir, exist_ok=True)
+        filename = os.path.join(self.profile_dir, f"profile-{full_name}.prof")
+        profiler.dump_stats(filename)
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(15)
+        log.info(f"--- Profile of '{full_name}' (saved to {filename}, view with 'python -m pstats'):")
+        log.info(out.getvalue())
+
+    def summary_lines(self):
+        lines = [f"{'phase':32} {'wall s':>9} {'cpu s':>9} {'peak RSS MB':>12} {'items':>10}"]
+        for full_name, r in self.spans:
+            name = "  " * r.depth + r.name
+            rss = "" if r.peak_rss_mb is None else f"{r.peak_rss_mb:.1f}"
+            items = "" if r.items is None else str(r.items)
+            lines.append(f"{name:32} {r.wall:9.3f} {r.cpu:9.3f} {rss:>12} {items:>10}")
+        return lines
+
+    def print_summary(self):
+        log.info(f"--- Phase timing:")
+        for line in self.summary_lines():
+            log.info(f"    {line}")
+
+    def to_dict(self):
+        return {'started': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                'argv': sys.argv, 'total_wall_s': round(time.time() - self.started, 6),
+                'peak_rss_mb': get_peak_rss_mb(),
+                'spans': [dict(r.to_dict(), name=full_name) for full_name, r in self.spans]}
+
+    def finish(self):
+        # prints the summary and writes the metrics file, if one was requested
+        self.print_summary()
+        if self.metrics_file is not None:
+            with open(self.metrics_file, 'w') as outfile:
+                json.dump(self.to_dict(), outfile, indent=2)
+            log.info(f"Metrics written to {self.metrics_file}")
+
+
+METRICS = PhaseMetrics()
+
+
+def span(name, **attrs):
+    return METRICS.span(name, **attrs)
+
+
+def configure(parsed_args):
+    METRICS.configure(parsed_args.metrics_file, parsed_args.profile, parsed_args.profile_dir)
+
+
+def finish():
+    METRICS.finish()
@@ -0,0 +1,303 @@
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import urllib.parse
+
+import ibdiag
+import ibdiag_metrics
+import ibdiag_snapshot
+
+# Answers route, LID, neighbor and port queries over HTTP (on localhost or a Unix socket) from a fabric
+# loaded once, with the lookups served from indexes built at load time.  With --snapshot the file is
+# checked every --reload_interval seconds and reloaded when it changes, e.g. when ibdiag_watch
+# (--save_snapshot) writes a new one; queries keep using the old indexes until the new ones are built.
+#
+#   curl 'http://127.0.0.1:8642/route?src=host01&dst=host02'
+#   curl --unix-socket /tmp/ibdiag.sock 'http://localhost/port?switch=leaf001&port=37'
+
+
+class QueryError(Exception):
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class FabricIndex:
+    def __init__(self, switches, endpoints, source):
+        self.switches = switches
+        self.endpoints = endpoints
+        self.source = source
+        self.loaded = time.time()
+        _, self.host_lids = ibdiag.get_hostinfo_tables(endpoints)
+        self.endpoint_lids = dict((ep.name, lid) for lid, ep in endpoints.items())
+        self.switch_lids = {}
+        for lid, sw in switches.items():
+            self.switch_lids.setdefault(sw.name, []).append(lid)
+        for sw in switches.values():
+            sw.routes.by_port()     # port -> routed LIDs, built now rather than on the first query
+
+    def resolve(self, name):
+        # LID (decimal or 0x hex), host name, full endpoint name ("host01 mlx5_0") or switch name -> LIDs
+        name = name.strip()
+        try:
+            lid = int(name, 16) if name.lower().startswith("0x") else int(name)
+        except ValueError:
+            lid = None
+        if lid is not None:
+            if lid not in self.switches and lid not in self.endpoints:
+                raise QueryError(f"unknown lid {lid}", 404)
+            return [lid]
+        for table in [self.host_lids, self.switch_lids]:
+            if name in table:
+                return list(table[name])
+        if name in self.endpoint_lids:
+            return [self.endpoint_lids[name]]
+        raise QueryError(f"unknown host, endpoint or switch '{name}'", 404)
+
+    def get_switch(self, name):
+        lids = [lid for lid in self.resolve(name) if lid in self.switches]
+        if len(lids) != 1:
+            raise QueryError(f"'{name}' is not a single switch")
+        return self.switches[lids[0]]
+
+    def lid_info(self, lid):
+        if lid in self.switches:
+            sw = self.switches[lid]
+            return {'lid': lid, 'type': "switch", 'name': sw.name, 'guid': sw.guid, 'ports': int(sw.portcount)}
+        ep = self.endpoints[lid]
+        return {'lid': lid, 'type': "endpoint", 'name': ep.name, 'guid': ep.guid, 'switch': ep.switch.name,
+                'switch_lid': ep.switch.lid, 'switch_port': ep.switch_port, 'speed': ep.speed}
+
+    def port_info(self, sw, port):
+        result = {'switch': sw.name, 'switch_lid': sw.lid, 'port': port, 'connected': None}
+        if port in sw.isls:
+            dest, dest_port, speed = sw.isls[port]
+            result['connected'] = {'type': "switch", 'name': dest.name, 'lid': dest.lid, 'port': dest_port,
+                                   'speed': speed}
+        elif port in sw.endpoints:
+            ep = sw.endpoints[port]
+            result['connected'] = {'type': "endpoint", 'name': ep.name, 'lid': ep.lid, 'speed': ep.speed}
+        return result
+
+    def trace(self, src, dst):
+        # the path from src to dst through the forwarding tables; status as in ibdiag_trace
+        max_hops = len(self.switches) + 1
+        sw = self.switches[src] if src in self.switches else self.endpoints[src].switch
+        end_sw = self.switches[dst] if dst in self.switches else self.endpoints[dst].switch
+        hops = []
+        while True:
+            port = sw.routes.get(dst)
+            if port is None:
+                return "no route", hops
+            hops.append({'switch': sw.name, 'lid': sw.lid, 'port': port})
+            if sw is end_sw:
+                return "ok", hops
+            if len(hops) >= max_hops:
+                return "loop", hops
+            if port not in sw.isls:
+                return "dead port", hops
+            sw = sw.isls[port][0]
+
+    def query_route(self, params):
+        result = []
+        for src in self.resolve(get_param(params, 'src')):
+            for dst in self.resolve(get_param(params, 'dst')):
+                if src == dst:
+                    continue
+                status, hops = self.trace(src, dst)
+                result.append({'src': src, 'dst': dst, 'status': status, 'hops': hops})
+        return {'routes': result}
+
+    def query_lid(self, params):
+        return {'lids': [self.lid_info(lid) for lid in self.resolve(get_param(params, 'name'))]}
+
+    def query_neighbors(self, params):
+        result = []
+        for lid in self.resolve(get_param(params, 'name')):
+            if lid in self.switches:
+                sw = self.switches[lid]
+                ports = [self.port_info(sw, port) for port in sorted(sw.connections)]
+            else:
+                ep = self.endpoints[lid]
+                ports = [self.port_info(ep.switch, ep.switch_port)]
+            result.append({'lid': lid, 'ports': ports})
+        return {'neighbors': result}
+
+    def query_port(self, params):
+        sw = self.get_switch(get_param(params, 'switch'))
+        port = get_int_param(params, 'port')
+        result = self.port_info(sw, port)
+        lids = sw.routes.by_port().get(port, [])
+        result['routed_lids'] = [{'lid': lid, 'name': self.endpoints[lid].name if lid in self.endpoints
+                                  else self.switches[lid].name if lid in self.switches else None} for lid in lids]
+        return result
+
+    def query_status(self, params):
+        return {'source': self.source, 'loaded': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.loaded)),
+                'switches': len(self.switches), 'endpoints': len(self.endpoints), 'hosts': len(self.host_lids)}
+
+
+# path -> FabricIndex method
+QUERIES = {
+    '/route': FabricIndex.query_route,
+    '/lid': FabricIndex.query_lid,
+    '/neighbors': FabricIndex.query_neighbors,
+    '/port': FabricIndex.query_port,
+    '/status': FabricIndex.query_status,
+}
+
+
+def get_param(params, name):
+    if name not in params:
+        raise QueryError(f"missing parameter '{name}'")
+    return params[name][-1]
+
+
+def get_int_param(params, name):
+    try:
+        return int(get_param(params, name))
+    except ValueError:
+        raise QueryError(f"parameter '{name}' must be an integer")
+
+
+class FabricServer:
+    # holds the current FabricIndex; a reload builds a new one and swaps it in, so a query never sees a
+    # half-built index
+    def __init__(self, parsed_args):
+        self.args = parsed_args
+        self.index = None
+        self.snapshot_stat = None
+
+    def get_snapshot_stat(self):
+        try:
+            st = os.stat(self.args.snapshot)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def load(self):
+        if self.args.snapshot is not None:
+            self.snapshot_stat = self.get_snapshot_stat()
+            switches, endpoints, _ = ibdiag_snapshot.load_snapshot(self.args.snapshot)
+            source = self.args.snapshot
+        else:
+            switches, endpoints = ibdiag.load_fabric_cached(self.args)
+            source = "fabric"
+        self.index = FabricIndex(switches, endpoints, source)
+        ibdiag.log.info(f"Loaded {len(switches)} switches and {len(endpoints)} endpoints from {source}")
+
+    def watch_snapshot(self):
+        while True:
+            time.sleep(self.args.reload_interval)
+            stat = self.get_snapshot_stat()
+            if stat is None or stat == self.snapshot_stat:
+                continue
+            try:
+                self.load()
+            except Exception as exc:
+                # keep serving the fabric we have; a snapshot that fails to load is tried again when it changes
+                self.snapshot_stat = stat
+                ibdiag.log.error(f"*** Error reloading {self.args.snapshot}: {type(exc).__name__}: {exc}")
+
+    def handle(self, path, params):
+        if path not in QUERIES:
+            raise QueryError(f"unknown query {path}; queries are: {', '.join(QUERIES)}", 404)
+        return QUERIES[path](self.index, params)
+
+
+_server_classes = None
+
+def get_server_classes():
+    # http.server is only imported when the server starts, which keeps it out of the import time of
+    # this module; the classes derived from its types are built on first use
+    global _server_classes
+    if _server_classes is not None:
+        return _server_classes
+    import http.server
+    import socketserver
+
+    class QueryHandler(http.server.BaseHTTPRequestHandler):
+        fabric_server = None
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            try:
+                status, result = 200, self.fabric_server.handle(url.path, urllib.parse.parse_qs(url.query))
+            except QueryError as exc:
+                status, result = exc.status, {'error': str(exc)}
+            body = json.dumps(result).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            ibdiag.log.debug(format % args)
+
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def get_request(self):
+            # http.server expects a (host, port) client address
+            request, _ = self.socket.accept()
+            return request, ("local", 0)
+
+    _server_classes = (QueryHandler, UnixHTTPServer, http.server.ThreadingHTTPServer)
+    return _server_classes
+
+
+def make_http_server(listen, fabric_server):
+    # "unix:<path>" or "[host:]port"
+    query_handler, unix_server, tcp_server = get_server_classes()
+    query_handler.fabric_server = fabric_server
+    if listen.startswith("unix:"):
+        path = listen[len("unix:"):]
+        if os.path.exists(path):
+            os.remove(path)
+        return unix_server(path, query_handler)
+    host, _, port = listen.rpartition(":")
+    return tcp_server((host or "127.0.0.1", int(port)), query_handler)
+
+
+def get_arg_parser(description="ibdiag_server: Answer route, LID, neighbor and port queries about an IB fabric"):
+    my_parser = ibdiag.get_arg_parser(description=description)
+    my_parser.add_argument("--snapshot", dest="snapshot", default=None,
+        help="fabric snapshot file (--save_snapshot) to serve and reload when it changes, instead of the input "
+             "files or the fabric")
+    my_parser.add_argument("--listen", dest="listen", default="127.0.0.1:8642",
+        help="[host:]port to listen on, or unix:<path> for a Unix socket")
+    my_parser.add_argument("--reload_interval", dest="reload_interval", type=float, default=2,
+        help="seconds between checks of the snapshot file for changes")
+    return my_parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    ibdiag.configure_logging(args)
+    ibdiag_metrics.configure(args)
+    fabric_server = FabricServer(args)
+    with ibdiag_metrics.span("load"):
+        fabric_server.load()
+    ibdiag_metrics.finish()
+    if args.snapshot is not None:
+        threading.Thread(target=fabric_server.watch_snapshot, daemon=True).start()
+    httpd = make_http_server(args.listen, fabric_server)
+    ibdiag.log.info(f"Listening on {args.listen}")
+    # stopped like a service (SIGTERM) or by hand (Ctrl-C), the server cleans up the same way
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if args.listen.startswith("unix:"):
+            os.remove(args.listen[len("unix:"):])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import struct
+import zlib
+
+import ibdiag
+
+# Compact on-disk form of a parsed fabric (switches, endpoints, ISLs and forwarding tables), and a
+# cache of such snapshots keyed on the content of the input files they were parsed from.  Snapshots are
+# shared between hosts and tools, so the format is data only: after the magic, a zlib-compressed JSON
+# header of the switch and endpoint records, followed by the forwarding tables as raw bytes that the
+# header gives the lengths of.
+
+SNAPSHOT_MAGIC = b"IBDSNAP2"
+SNAPSHOT_VERSION = 2
+HEADER_LENGTH = struct.Struct("<Q")
+DEFAULT_CACHE_MAX_MB = 1024
+
+
+def fabric_to_records(switches, endpoints):
+    # plain tuples only, in dict insertion order so a reloaded fabric prints/iterates like the original
+    switch_records = []
+    for lid, sw in switches.items():
+        links = []
+        for port, dest in sw.connections.items():
+            if port in sw.isls:
+                dest_sw, dest_port, speed = sw.isls[port]
+                links.append((port, dest_sw.lid, dest_port, speed))
+            else:
+                links.append((port, dest.lid, None, None))
+        switch_records.append((lid, sw.name, sw.guid, sw.portcount, bytes(sw.routes.ports), links))
+    endpoint_records = [(lid, ep.name, ep.guid, ep.switch.lid, ep.switch_port, ep.speed)
+                        for lid, ep in endpoints.items()]
+    return switch_records, endpoint_records
+
+
+def records_to_fabric(switch_records, endpoint_records):
+    switches = {}
+    for lid, name, guid, portcount, lft, _ in switch_records:
+        sw = ibdiag.IBSwitch(lid, name, guid, portcount)
+        sw.routes = ibdiag.LinearForwardingTable(lft)
+        switches[lid] = sw
+    endpoints = {}
+    for lid, name, guid, sw_lid, sw_port, speed in endpoint_records:
+        endpoints[lid] = ibdiag.IBHost(lid, name, guid, switches[sw_lid], sw_port, speed)
+    for lid, _, _, _, _, links in switch_records:
+        sw = switches[lid]
+        for port, dest_lid, dest_port, speed in links:
+            if dest_port is not None:
+                sw.connections[port] = switches[dest_lid]
+                sw.isls[port] = (switches[dest_lid], dest_port, speed)
+            else:
+                sw.connections[port] = endpoints[dest_lid]
+                sw.endpoints[port] = endpoints[dest_lid]
+    return switches, endpoints
+
+
+def snapshot_to_bytes(switches, endpoints, extras=None):
+    switch_records, endpoint_records = fabric_to_records(switches, endpoints)
+    # the lfts go after the header; in the header each is replaced by its length
+    lfts = [record[4] for record in switch_records]
+    data = {'version': SNAPSHOT_VERSION,
+            'switches': [record[:4] + (len(lft),) + record[5:] for record, lft in zip(switch_records, lfts)],
+            'endpoints': endpoint_records, 'extras': extras if extras is not None else {}}
+    header = json.dumps(data, separators=(",", ":")).encode()
+    return SNAPSHOT_MAGIC + zlib.compress(b"".join([HEADER_LENGTH.pack(len(header)), header] + lfts), 6)
+
+
+def snapshot_from_bytes(blob):
+    if not blob.startswith(SNAPSHOT_MAGIC):
+        raise ValueError("not an ibdiag snapshot")
+    payload = memoryview(zlib.decompress(blob[len(SNAPSHOT_MAGIC):]))
+    (header_length,) = HEADER_LENGTH.unpack_from(payload)
+    offset = HEADER_LENGTH.size + header_length
+    data = json.loads(bytes(payload[HEADER_LENGTH.size:offset]))
+    if data.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"unsupported ibdiag snapshot version {data.get('version')}")
+    switch_records = []
+    for lid, name, guid, portcount, lft_length, links in data['switches']:
+        if offset + lft_length > len(payload):
+            raise ValueError("truncated ibdiag snapshot")
+        switch_records.append((lid, name, guid, portcount, payload[offset:offset + lft_length], links))
+        offset += lft_length
+    switches, endpoints = records_to_fabric(switch_records, data['endpoints'])
+    return switches, endpoints, data['extras']
+
+
+def save_snapshot(filename, switches, endpoints, extras=None):
+    # written to a temporary file and renamed, so readers never see a partial snapshot
+    tmpname = f"{filename}.{os.getpid()}.tmp"
+    with open(tmpname, 'wb') as outfile:
+        outfile.write(snapshot_to_bytes(switches, endpoints, extras))
+    os.replace(tmpname, filename)
+
+
+def is_snapshot_file(filename):
+    with open(filename, 'rb') as infile:
+        return infile.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+def load_snapshot(filename):
+    with open(filename, 'rb') as infile:
+        return snapshot_from_bytes(infile.read())
+
+
+def get_default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "ibdiag_graph")
+
+
+def get_input_files_key(input_files, skip_routing):
+    # None unless every input is an existing file - live command output can't be keyed before it is
+    # collected, and collecting it is the expensive part
+    if any(f is None or not os.path.isfile(f) for f in input_files):
+        return None
+    digest = hashlib.sha256(f"{SNAPSHOT_VERSION} {skip_routing}".encode())
+    for f in input_files:
+        # the same content read by another parser (e.g. renamed to or from .lst) is another fabric
+        digest.update(f"\0{ibdiag.get_input_format(f)}\0".encode())
+        with open(f, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def get_run_cache_key(parsed_args):
+    input_files = [parsed_args.switch_info_file, parsed_args.link_info_file]
+    if not parsed_args.skip_routing:
+        input_files.append(parsed_args.route_info_file)
+    return get_input_files_key(input_files, parsed_args.skip_routing)
+
+
+def get_cache_file(cache_dir, key):
+    return os.path.join(cache_dir, f"{key}.ibdsnap")
+
+
+def load_cached_fabric(cache_dir, key):
+    filename = get_cache_file(cache_dir, key)
+    if not os.path.isfile(filename):
+        return None
+    try:
+        result = load_snapshot(filename)
+    except (OSError, ValueError, KeyError, TypeError, struct.error, zlib.error) as exc:
+        ibdiag.log.warning(f"Ignoring unreadable cache file {filename}: {exc}")
+        return None
+    os.utime(filename)     # mtime doubles as last-used time for eviction
+    return result
+
+
+def store_cached_fabric(cache_dir, key, switches, endpoints, max_bytes, extras=None):
+    os.makedirs(cache_dir, exist_ok=True)
+    save_snapshot(get_cache_file(cache_dir, key), switches, endpoints, extras)
+    evict_cache(cache_dir, max_bytes)
+
+
+def evict_cache(cache_dir, max_bytes):
+    # least recently used snapshots go first until the cache fits in max_bytes
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".ibdsnap"):
+            st = os.stat(os.path.join(cache_dir, name))
+            entries.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(os.path.join(cache_dir, name))
+        total -= size
@@ -0,0 +1,223 @@
+import ibdiag
+
+np = ibdiag.LazyModule("numpy")
+
+# Vectorized route tracing: the forwarding tables of all switches are packed into one switch x LID
+# matrix, and many (source lid, destination lid) pairs are walked through it together, one hop
+# per step, with array gathers instead of per-pair dict lookups.
+
+NO_ROUTE = ibdiag.LinearForwardingTable.NO_ROUTE
+MAX_PORTS = 256
+
+# per-pair trace status
+TRACE_OK = 0
+TRACE_NO_ROUTE = 1       # a switch on the path has no LFT entry for the destination
+TRACE_DEAD_PORT = 2      # the LFT entry points at a port that is down or not an ISL
+TRACE_LOOP = 3           # still not at the destination after max_hops switches
+TRACE_UNKNOWN_LID = 4    # source or destination lid is not an endpoint or switch in the fabric
+TRACE_STATUS_NAMES = {TRACE_OK: "ok", TRACE_NO_ROUTE: "no route", TRACE_DEAD_PORT: "dead port",
+                      TRACE_LOOP: "loop", TRACE_UNKNOWN_LID: "unknown lid"}
+
+
+class FabricTables:
+    # integer-indexed arrays built from the parsed switches/endpoints dicts:
+    #   lft[s, lid]        exit port on switch index s for destination lid (NO_ROUTE if none)
+    #   neighbor[s, p]     switch index reached through port p of switch s, -1 if p is not an ISL
+    #   lid_switch[lid]    switch index an endpoint lid is attached to (a switch lid maps to itself)
+    def __init__(self, switches, endpoints):
+        self.switch_lids = np.array(sorted(switches), dtype=np.int64)
+        self.switch_index = {lid: i for i, lid in enumerate(self.switch_lids.tolist())}
+        self.switches = [switches[lid] for lid in self.switch_lids.tolist()]
+        max_lid = max([0] + list(switches) + list(endpoints) + [len(sw.routes.ports) - 1 for sw in self.switches])
+        self.max_lid = max_lid
+        self.lft = np.full((len(self.switches), max_lid + 1), NO_ROUTE, dtype=np.uint8)
+        self.neighbor = np.full((len(self.switches), MAX_PORTS), -1, dtype=np.int32)
+        self.neighbor_port = np.zeros((len(self.switches), MAX_PORTS), dtype=np.uint8)
+        self.lid_switch = np.full(max_lid + 1, -1, dtype=np.int32)
+        self.lid_port = np.zeros(max_lid + 1, dtype=np.uint8)
+        for i, sw in enumerate(self.switches):
+            ports = np.frombuffer(bytes(sw.routes.ports), dtype=np.uint8)
+            self.lft[i, :len(ports)] = ports
+            for p, (dest_sw, dest_port, _) in sw.isls.items():
+                self.neighbor[i, p] = self.switch_index[dest_sw.lid]
+                self.neighbor_port[i, p] = dest_port
+            self.lid_switch[sw.lid] = i
+        for lid, ep in endpoints.items():
+            self.lid_switch[lid] = self.switch_index[ep.switch.lid]
+            self.lid_port[lid] = ep.switch_port
+
+    def endpoint_lids(self):
+        # the lids of the endpoints, i.e. every lid attached to a switch that isn't a switch's own
+        is_switch_lid = np.zeros(self.max_lid + 1, dtype=bool)
+        is_switch_lid[self.switch_lids] = True
+        return np.flatnonzero((self.lid_switch >= 0) & ~is_switch_lid)
+
+    def isl_channels(self):
+        # (switch index, port) of every ISL direction, as flat channel ids s * MAX_PORTS + p
+        return np.flatnonzero(self.neighbor.ravel() >= 0)
+
+    def channel_str(self, channel):
+        s, p = divmod(int(channel), MAX_PORTS)
+        d, dp = self.neighbor[s, p], self.neighbor_port[s, p]
+        return f"{self.switches[s].name}({p}) --> {self.switches[d].name}({dp})"
+
+
+class TraceResult:
+    # path_switches[i, h] / path_ports[i, h]: switch index and exit port at hop h of pair i (-1/NO_ROUTE
+    # past the end of the path).  hops[i] is the number of switches traversed; isl_usage[s, p] the
+    # number of traced pairs leaving switch index s through ISL port p.  weights[i] is the number of
+    # host pairs entry i stands for (see trace_all_pairs).
+    def __init__(self, tables, src, dst, status, hops, isl_usage, path_switches=None, path_ports=None,
+                 weights=None):
+        self.tables = tables
+        self.src = src
+        self.dst = dst
+        self.status = status
+        self.hops = hops
+        self.isl_usage = isl_usage
+        self.path_switches = path_switches
+        self.path_ports = path_ports
+        self.weights = np.ones(len(src), dtype=np.int64) if weights is None else weights
+
+    def __len__(self):
+        return len(self.src)
+
+    def pair_count(self):
+        return int(self.weights.sum())
+
+    def status_counts(self):
+        counts = np.bincount(self.status, weights=self.weights, minlength=len(TRACE_STATUS_NAMES))
+        return {TRACE_STATUS_NAMES[k]: int(c) for k, c in enumerate(counts) if c > 0}
+
+    def hop_histogram(self):
+        # {switch hops: pair count} for the successfully traced pairs
+        ok = self.status == TRACE_OK
+        counts = np.bincount(self.hops[ok], weights=self.weights[ok])
+        return {h: int(c) for h, c in enumerate(counts) if c > 0}
+
+    def route(self, i):
+        # pair i in the format returned by ibdiag.get_route
+        t = self.tables
+        src, dst = int(self.src[i]), int(self.dst[i])
+        result = [(src, int(t.lid_port[src]))]
+        for h in range(int(self.hops[i])):
+            result.append((int(t.switch_lids[self.path_switches[i, h]]), int(self.path_ports[i, h])))
+        result.append(dst)
+        return result
+
+    def isl_usage_items(self):
+        # [((switch lid, port), (dest switch lid, dest port), pair count), ...] for every used ISL
+        t = self.tables
+        result = []
+        for channel in np.flatnonzero(self.isl_usage.ravel()):
+            s, p = divmod(int(channel), MAX_PORTS)
+            d = t.neighbor[s, p]
+            result.append(((int(t.switch_lids[s]), p), (int(t.switch_lids[d]), int(t.neighbor_port[s, p])),
+                           int(self.isl_usage[s, p])))
+        return result
+
+
+def pairs_product(src_lids, dst_lids, skip_same=True):
+    # all (src, dst) combinations as two flat arrays
+    src = np.repeat(np.asarray(src_lids, dtype=np.int64), len(dst_lids))
+    dst = np.tile(np.asarray(dst_lids, dtype=np.int64), len(src_lids))
+    if skip_same:
+        keep = src != dst
+        src, dst = src[keep], dst[keep]
+    return src, dst
+
+
+def trace_routes(tables, src, dst, weights=None, max_hops=64, keep_paths=True, count_usage=True):
+    # count_usage=False leaves isl_usage at zero, for callers that only need statuses, hops or paths
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    n = len(src)
+    weights = np.ones(n, dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+    status = np.full(n, TRACE_OK, dtype=np.uint8)
+    hops = np.zeros(n, dtype=np.int32)
+    usage = np.zeros(len(tables.switches) * MAX_PORTS, dtype=np.int64)
+    known = (src >= 0) & (src <= tables.max_lid) & (dst >= 0) & (dst <= tables.max_lid)
+    cur = np.full(n, -1, dtype=np.int32)
+    end = np.full(n, -1, dtype=np.int32)
+    cur[known] = tables.lid_switch[src[known]]
+    end[known] = tables.lid_switch[dst[known]]
+    status[(cur < 0) | (end < 0)] = TRACE_UNKNOWN_LID
+    path_switches, path_ports = [], []
+    active = np.flatnonzero(status == TRACE_OK)
+    for h in range(max_hops):
+        if len(active) == 0:
+            break
+        sw = cur[active]
+        port = tables.lft[sw, dst[active]]
+        if keep_paths:
+            hop_sw = np.full(n, -1, dtype=np.int32)
+            hop_port = np.full(n, NO_ROUTE, dtype=np.uint8)
+            hop_sw[active] = sw
+            hop_port[active] = port
+            path_switches.append(hop_sw)
+            path_ports.append(hop_port)
+        hops[active] += 1
+        arrived = sw == end[active]
+        unrouted = port == NO_ROUTE
+        status[active[unrouted]] = TRACE_NO_ROUTE
+        moving = ~arrived & ~unrouted
+        nxt = tables.neighbor[sw[moving], port[moving]]
+        dead = nxt < 0
+        status[active[moving][dead]] = TRACE_DEAD_PORT
+        active = active[moving][~dead]
+        if count_usage:
+            channels = sw[moving][~dead].astype(np.int64) * MAX_PORTS + port[moving][~dead]
+            usage += np.bincount(channels, weights=weights[active], minlength=len(usage)).astype(np.int64)
+        cur[active] = nxt[~dead]
+    status[active] = TRACE_LOOP
+    usage = usage.reshape(len(tables.switches), MAX_PORTS)
+    if keep_paths:
+        width = max(1, len(path_switches))
+        ps = np.stack(path_switches, axis=1) if path_switches else np.full((n, width), -1, dtype=np.int32)
+        pp = np.stack(path_ports, axis=1) if path_ports else np.full((n, width), NO_ROUTE, dtype=np.uint8)
+        return TraceResult(tables, src, dst, status, hops, usage, ps, pp, weights=weights)
+    return TraceResult(tables, src, dst, status, hops, usage, weights=weights)
+
+
+def source_switch_flows(tables, src_lids, dst_lids, skip_same=True):
+    # Routing is destination based, so every source endpoint on a switch follows the same path to a
+    # given destination from that switch on.  All src x dst pairs therefore collapse into
+    # (source switch lid, dst) flows weighted by the number of source endpoints on that switch.
+    # Source lids that are not in the fabric are dropped; unknown destinations are left for
+    # trace_routes to report.
+    src_lids = np.asarray(src_lids, dtype=np.int64)
+    dst_lids = np.asarray(dst_lids, dtype=np.int64)
+    src_lids = src_lids[(src_lids >= 0) & (src_lids <= tables.max_lid)]
+    src_lids = src_lids[tables.lid_switch[src_lids] >= 0]
+    sw_index, counts = np.unique(tables.lid_switch[src_lids], return_counts=True)
+    src = np.repeat(tables.switch_lids[sw_index], len(dst_lids))
+    dst = np.tile(dst_lids, len(sw_index))
+    weights = np.repeat(counts, len(dst_lids)).astype(np.int64)
+    if skip_same:
+        in_src = np.zeros(tables.max_lid + 1, dtype=bool)
+        in_src[src_lids] = True
+        known = (dst >= 0) & (dst <= tables.max_lid)
+        same = np.zeros(len(dst), dtype=bool)
+        same[known] = in_src[dst[known]] & (tables.lid_switch[dst[known]] == tables.lid_switch[src[known]])
+        weights -= same
+    keep = weights > 0
+    return src[keep], dst[keep], weights[keep]
+
+
+def trace_all_pairs(tables, src_lids, dst_lids, chunk_size=1 << 20, max_hops=64, skip_same=True):
+    # traces every src x dst pair (as weighted source-switch flows, in bounded-size chunks); paths are
+    # not kept, only per-ISL usage, hop counts and statuses.  Source lids that are not in the fabric
+    # are dropped.
+    src, dst, weights = source_switch_flows(tables, src_lids, dst_lids, skip_same)
+    usage = np.zeros((len(tables.switches), MAX_PORTS), dtype=np.int64)
+    statuses, hops = [], []
+    for start in range(0, len(src), chunk_size):
+        end = start + chunk_size
+        result = trace_routes(tables, src[start:end], dst[start:end], weights[start:end],
+                              max_hops=max_hops, keep_paths=False)
+        usage += result.isl_usage
+        statuses.append(result.status)
+        hops.append(result.hops)
+    if len(src) == 0:
+        return TraceResult(tables, src, dst, np.zeros(0, np.uint8), np.zeros(0, np.int32), usage, weights=weights)
+    return TraceResult(tables, src, dst, np.concatenate(statuses), np.concatenate(hops), usage, weights=weights)
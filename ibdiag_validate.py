@@ -0,0 +1,215 @@
+import itertools
+
+import ibdiag
+import ibdiag_metrics
+import ibdiag_snapshot
+import ibdiag_trace
+
+np = ibdiag.LazyModule("numpy")
+
+# Checks the forwarding table entry of every switch for every LID in the fabric.  For one destination
+# LID the entries give each switch one successor (the switch its exit port leads to), and they are
+# valid when they form a tree rooted at the destination's switch.  Where every switch's walk ends is
+# found for all switches and a chunk of destinations at once by pointer doubling: each round replaces
+# every switch's successor by its successor's successor, so after log2(switches) rounds of array
+# gathers each walk has settled - on the destination's switch, in a black hole, or on a loop.
+
+NO_ROUTE = ibdiag_trace.NO_ROUTE
+
+# problems, per (switch, destination lid) entry
+LFT_NO_ROUTE = 1        # the switch has no entry for the destination
+LFT_DEAD_PORT = 2       # the entry points at a port that is down or leads to an endpoint
+LFT_WRONG_PORT = 3      # the destination's own switch sends it out of a port it isn't on
+LFT_LOOP = 4            # the switch is on a forwarding loop for the destination
+LFT_PROBLEM_NAMES = {LFT_NO_ROUTE: "no route", LFT_DEAD_PORT: "dead port", LFT_WRONG_PORT: "wrong port",
+                     LFT_LOOP: "loop"}
+
+
+class LftValidation:
+    # one entry per offending (switch index, exit port, destination lid) triple, and per checked
+    # destination lid the number of switches whose packets for it are not delivered
+    def __init__(self, tables, dest_lids, switch_index, ports, lids, problems, undelivered):
+        self.tables = tables
+        self.dest_lids = dest_lids
+        self.switch_index = switch_index
+        self.ports = ports
+        self.lids = lids
+        self.problems = problems
+        self.undelivered = undelivered
+
+    def __len__(self):
+        return len(self.problems)
+
+    def problem_counts(self):
+        counts = np.bincount(self.problems, minlength=len(LFT_PROBLEM_NAMES) + 1)
+        return {LFT_PROBLEM_NAMES[k]: int(c) for k, c in enumerate(counts) if k > 0 and c > 0}
+
+    def unreachable_lids(self):
+        # [(lid, number of switches it is not delivered from), ...], worst first
+        bad = np.flatnonzero(self.undelivered)
+        order = np.argsort(-self.undelivered[bad], kind='stable')
+        return [(int(self.dest_lids[i]), int(self.undelivered[i])) for i in bad[order]]
+
+    def triples(self):
+        # (switch lid, exit port or None, destination lid, problem name) for every offending entry
+        for s, p, lid, problem in zip(self.switch_index.tolist(), self.ports.tolist(), self.lids.tolist(),
+                                      self.problems.tolist()):
+            yield (int(self.tables.switch_lids[s]), None if p == NO_ROUTE else p, lid, LFT_PROBLEM_NAMES[problem])
+
+
+def validate_tables(tables, dest_lids=None, chunk_size=4096):
+    # dest_lids: the destinations to check, by default every switch and endpoint lid in the fabric
+    if dest_lids is None:
+        dest_lids = np.flatnonzero(tables.lid_switch >= 0)
+    dest_lids = np.asarray(dest_lids, dtype=np.int64)
+    n = len(tables.switches)
+    sink = n            # an extra row every walk that ends in a black hole goes to, and stays in
+    rounds = int(np.ceil(np.log2(n + 1))) + 1
+    rows = np.arange(n, dtype=np.int32)[:, None]
+    is_switch_lid = np.zeros(tables.max_lid + 1, dtype=bool)
+    is_switch_lid[tables.switch_lids] = True
+    undelivered = np.zeros(len(dest_lids), dtype=np.int64)
+    found = []
+    for start in range(0, len(dest_lids), chunk_size):
+        lids = dest_lids[start:start + chunk_size]
+        dest_sw = tables.lid_switch[lids][None, :]
+        port = tables.lft[:, lids]
+        at_dest = rows == dest_sw
+        routed = port != NO_ROUTE
+        nxt = tables.neighbor[rows, port]
+        # a switch lid is delivered through port 0 of its switch, an endpoint lid through its own port
+        expected = np.where(is_switch_lid[lids], 0, tables.lid_port[lids])[None, :]
+        problem = np.where(routed, 0, LFT_NO_ROUTE).astype(np.uint8)
+        problem[routed & at_dest & (port != expected)] = LFT_WRONG_PORT
+        problem[routed & ~at_dest & (nxt < 0)] = LFT_DEAD_PORT
+        # the destination's switch points at itself, so walks that get there stay there
+        nxt = np.where(at_dest, rows, nxt)
+        nxt[problem != 0] = sink
+        nxt = np.vstack([nxt, np.full((1, len(lids)), sink, dtype=nxt.dtype)])
+        cols = np.arange(len(lids))[None, :]
+        for _ in range(rounds):
+            nxt = nxt[nxt, cols]
+        end = nxt[:n]
+        failed = end != dest_sw
+        undelivered[start:start + len(lids)] = failed.sum(axis=0)
+        # after more rounds than there are switches a looping walk is on the loop itself; the switches
+        # on it are the ones whose entries need fixing, not the ones leading into it
+        s, c = np.nonzero(failed & (end != sink))
+        on_loop = np.zeros((n + 1, len(lids)), dtype=bool)
+        on_loop[end[s, c], c] = True
+        problem[on_loop[:n] & (problem == 0)] = LFT_LOOP
+        s, c = np.nonzero(problem)
+        found.append((s, port[s, c], lids[c], problem[s, c]))
+    if len(found) == 0:
+        found = [(np.zeros(0, np.int64), np.zeros(0, np.uint8), np.zeros(0, np.int64), np.zeros(0, np.uint8))]
+    return LftValidation(tables, dest_lids, *[np.concatenate(a) for a in zip(*found)], undelivered)
+
+
+def validate_lfts(switches, endpoints, chunk_size=4096):
+    return validate_tables(ibdiag_trace.FabricTables(switches, endpoints), chunk_size=chunk_size)
+
+
+def get_lid_name(lid, switches, endpoints):
+    if lid in endpoints:
+        return endpoints[lid].name
+    if lid in switches:
+        return switches[lid].name
+    return ""
+
+
+def print_lft_validation(validation, switches, endpoints, top=20):
+    print(f"--- LFT validation: {len(validation.dest_lids)} destination LIDs x {len(validation.tables.switches)} "
+          f"switches")
+    if len(validation) == 0:
+        print(f"    All forwarding table entries lead to their destination.")
+        return
+    counts = validation.problem_counts()
+    print(f"    {len(validation)} offending entries: {', '.join(f'{c} {name}' for name, c in counts.items())}")
+    unreachable = validation.unreachable_lids()
+    switch_count = len(validation.tables.switches)
+    nowhere = sum(1 for _, count in unreachable if count == switch_count)
+    print(f"    {len(unreachable)} LIDs are not delivered from every switch ({nowhere} from no switch at all)")
+    for lid, count in unreachable[:top]:
+        print(f"        lid {lid:5} {get_lid_name(lid, switches, endpoints):32} not delivered from {count} switches")
+    print(f"    Offending entries (switch, exit port, destination lid), first {min(top, len(validation))}:")
+    for slid, port, lid, problem in itertools.islice(validation.triples(), top):
+        print(f"        {switches[slid].name}({slid}) port {'-' if port is None else port} -> lid {lid} "
+              f"{get_lid_name(lid, switches, endpoints)}: {problem}")
+
+
+def write_lft_validation_csv(validation, switches, endpoints, filename):
+    with open(filename, 'w') as outfile:
+        outfile.write("switch,switch_lid,port,dest_lid,dest_name,problem\n")
+        for slid, port, lid, problem in validation.triples():
+            outfile.write(f'"{switches[slid].name}",{slid},{"" if port is None else port},{lid},'
+                          f'"{get_lid_name(lid, switches, endpoints)}",{problem}\n')
+
+
+def print_credit_loops(cdg, loops, switches, endpoints, top=20):
+    print(f"--- Credit loops: channel dependency graph of {len(cdg)} ISL channels, {len(cdg.src)} dependencies "
+          f"(one virtual lane assumed)")
+    if len(loops) == 0:
+        print(f"    No dependency cycles: the routes can't deadlock.")
+        return
+    print(f"    {len(loops)} dependency cycle(s), as sets of ISL channels that depend on each other in a circle:")
+    for i, loop in enumerate(loops[:top]):
+        lids = ", ".join(f"{lid} {get_lid_name(lid, switches, endpoints)}" for lid in loop.dest_lids[:top])
+        more = f" and {len(loop.dest_lids) - top} more" if len(loop.dest_lids) > top else ""
+        print(f"    Cycle {i + 1}: {len(loop.channels)} channels, from the routes to {len(loop.dest_lids)} LIDs: "
+              f"{lids}{more}")
+        for channel in loop.cycle:
+            print(f"        {cdg.channel_str(channel)}")
+
+
+def get_arg_parser(description="ibdiag_validate: Check the forwarding tables of an IB fabric for loops, black holes "
+                               "and unreachable LIDs"):
+    my_parser = ibdiag.get_arg_parser(description=description)
+    my_parser.add_argument("--snapshot", dest="snapshot", default=None,
+        help="fabric snapshot file (--save_snapshot) to check instead of the input files or the fabric")
+    my_parser.add_argument("--validate_top", dest="validate_top", type=int, default=20,
+        help="number of offending entries and unreachable LIDs listed")
+    my_parser.add_argument("--validate_file", dest="validate_file", default=None,
+        help="file name for a CSV file with every offending switch/port/LID entry")
+    my_parser.add_argument("--credit_loops", dest="credit_loops", action='store_true',
+        help="also check the routes for credit loops (cycles in the channel dependency graph), which can deadlock "
+             "the fabric")
+    return my_parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    if args.skip_routing:
+        ibdiag.log.error(f"*** Error: forwarding tables can't be checked with --skip_routing")
+        exit(1)
+    ibdiag.configure_logging(args)
+    ibdiag_metrics.configure(args)
+    with ibdiag_metrics.span("collect"):
+        if args.snapshot is not None:
+            switches, endpoints, _ = ibdiag_snapshot.load_snapshot(args.snapshot)
+        else:
+            switches, endpoints = ibdiag.load_fabric_cached(args)
+            ibdiag.save_requested_snapshot(args, switches, endpoints)
+    with ibdiag_metrics.span("validate") as span:
+        tables = ibdiag_trace.FabricTables(switches, endpoints)
+        validation = validate_tables(tables)
+        span.items = len(validation.dest_lids) * len(switches)
+    print_lft_validation(validation, switches, endpoints, args.validate_top)
+    if args.validate_file is not None:
+        write_lft_validation_csv(validation, switches, endpoints, args.validate_file)
+        print(f"    Offending entries written to {args.validate_file}")
+    loops = []
+    if args.credit_loops:
+        import ibdiag_cdg
+        with ibdiag_metrics.span("credit_loops") as span:
+            with ibdiag_metrics.span("build") as build_span:
+                cdg = ibdiag_cdg.build_channel_dependency_graph(tables)
+                build_span.items = len(cdg.src)
+            loops = ibdiag_cdg.find_credit_loops(cdg)
+            span.items = len(loops)
+        print_credit_loops(cdg, loops, switches, endpoints, args.validate_top)
+    ibdiag_metrics.finish()
+    if len(validation) > 0 or len(loops) > 0:
+        exit(1)
+
+if __name__ == '__main__':
+    main()
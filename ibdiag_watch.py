@@ -0,0 +1,183 @@
+import time
+
+import ibdiag
+import ibdiag_metrics
+
+# Keeps a parsed fabric up to date: polls 'iblinkinfo' every --watch_interval seconds and updates the
+# switches and endpoints in place.  Only switches whose links or LID changed are re-parsed and only
+# their forwarding tables are collected again with 'ibroute', instead of the full ibroute sweep of a
+# fresh ibdiag run.  With --link_info_file (and --route_info_file) the files are re-read on every poll.
+
+
+def get_link_state(lines):
+    # switch guid -> (lid, {port: split_linkinfo_line() tuple}) for the active ports in iblinkinfo output
+    state = {}
+    for line in ibdiag.iter_active_link_lines(lines):
+        link = ibdiag.split_linkinfo_line(line)
+        src_guid, _, src_lid, src_port = link[:4]
+        if src_guid not in state:
+            state[src_guid] = (src_lid, {})
+        state[src_guid][1][src_port] = link
+    return state
+
+
+def get_changed_switches(old_state, new_state):
+    # guids of switches that appeared, disappeared, changed LID or have a port that changed; a link that
+    # changes shows up in the port lists on both of its ends
+    return set(guid for guid in set(old_state) | set(new_state) if old_state.get(guid) != new_state.get(guid))
+
+
+class FabricWatcher:
+    def __init__(self, parsed_args):
+        self.args = parsed_args
+        self.switches = {}
+        self.endpoints = {}
+        self.link_state = {}
+        self.pending_routes = set()     # guids of switches whose routes couldn't be collected yet
+        self.polls = 0
+
+    def read_link_lines(self):
+        return list(ibdiag.iter_input_lines(self.args.link_info_file, ibdiag.get_linkinfo_cmd()))
+
+    def collect_routes(self, switch_lids=None):
+        # returns the guids of the switches whose routes weren't collected
+        if self.args.skip_routing:
+            return set()
+        failed = ibdiag.compute_route_info(self.switches, self.args.route_info_file, self.args.route_jobs,
+                                           self.args.route_timeout, self.args.route_retries, switch_lids)
+        return set(self.switches[lid].guid for lid in failed)
+
+    def load(self):
+        with ibdiag_metrics.span("switches") as span:
+            self.switches = ibdiag.get_switches(self.args.switch_info_file)
+            span.items = len(self.switches)
+        with ibdiag_metrics.span("links") as span:
+            lines = self.read_link_lines()
+            self.link_state = get_link_state(lines)
+            self.endpoints = ibdiag.parse_linkinfo_lines(self.switches, lines)
+            span.items = len(self.endpoints)
+        with ibdiag_metrics.span("routes") as span:
+            self.pending_routes = self.collect_routes()
+            span.items = sum(len(sw.routes) for sw in self.switches.values())
+
+    def add_new_switches(self, guids):
+        # iblinkinfo doesn't report port counts, so new switches are looked up with ibswitches
+        known = dict((sw.guid, sw) for sw in ibdiag.get_switches(self.args.switch_info_file).values())
+        new_switches = {}
+        for guid in guids:
+            lid, ports = self.link_state[guid]
+            sw = known.get(guid)
+            if sw is None:
+                name = ibdiag.switch_short_name(next(iter(ports.values()))[1])
+                sw = ibdiag.IBSwitch(lid, name, guid, str(max(ports)))
+            new_switches[guid] = sw
+        return new_switches
+
+    def apply_link_changes(self, changed):
+        by_guid = dict((sw.guid, sw) for sw in self.switches.values())
+        added = [guid for guid in changed if guid not in by_guid]
+        new_switches = self.add_new_switches(added) if len(added) > 0 else {}
+        # take every changed switch out first, so LIDs that moved between switches can't collide
+        peers = set()
+        for guid in changed:
+            sw = by_guid.get(guid)
+            if sw is None:
+                continue
+            peers.update(peer.guid for peer, _, _ in sw.isls.values() if peer.guid not in changed)
+            if self.switches.get(sw.lid) is sw:
+                del self.switches[sw.lid]
+            for endpoint in sw.endpoints.values():
+                if self.endpoints.get(endpoint.lid) is endpoint:
+                    del self.endpoints[endpoint.lid]
+            sw.connections = {}
+            sw.isls = {}
+            sw.endpoints = {}
+        for guid in changed:
+            if guid not in self.link_state:
+                continue    # gone from the fabric
+            sw = by_guid.get(guid) or new_switches[guid]
+            sw.lid = self.link_state[guid][0]
+            self.switches[sw.lid] = sw
+        for guid in changed:
+            if guid in self.link_state:
+                for link in self.link_state[guid][1].values():
+                    ibdiag.add_link(link, self.switches, self.endpoints)
+        # an unchanged neighbor's side of its links to the changed switches, in case only that side is listed
+        for guid in peers:
+            for link in self.link_state.get(guid, (None, {}))[1].values():
+                if link[4] in changed:
+                    ibdiag.add_link(link, self.switches, self.endpoints)
+        return len(added), len([guid for guid in changed if guid not in self.link_state])
+
+    def poll(self):
+        # returns whether the fabric model changed
+        self.polls += 1
+        time_a = time.perf_counter()
+        new_state = get_link_state(self.read_link_lines())
+        changed = get_changed_switches(self.link_state, new_state)
+        self.link_state = new_state
+        full_routes = self.args.watch_full_routes > 0 and self.polls % self.args.watch_full_routes == 0
+        if len(changed) == 0 and len(self.pending_routes) == 0 and not full_routes:
+            ibdiag.log.debug(f"Poll {self.polls}: no changes")
+            return False
+        added, removed = 0, 0
+        if len(changed) > 0:
+            added, removed = self.apply_link_changes(changed)
+            names = sorted(self.switches[new_state[guid][0]].name for guid in changed if guid in new_state)
+            ibdiag.log.info(f"Poll {self.polls}: {len(changed)} switch(es) changed ({added} added, {removed} "
+                            f"removed): {', '.join(names)}")
+        if not self.args.skip_routing:
+            if full_routes:
+                refresh = list(self.switches.keys())
+            else:
+                refresh = [sw.lid for sw in self.switches.values()
+                           if sw.guid in changed or sw.guid in self.pending_routes]
+            self.pending_routes = self.collect_routes(refresh)
+            ibdiag.log.info(f"Poll {self.polls}: routes collected for {len(refresh)} of {len(self.switches)} "
+                            f"switches")
+        ibdiag.log.info(f"Poll {self.polls}: fabric updated in {time.perf_counter() - time_a:.2f} seconds")
+        return True
+
+    def publish(self):
+        # summary, and the report file and snapshot if requested, of the fabric as of the last poll
+        host_names_only, host_lids = ibdiag.get_hostinfo_tables(self.endpoints)
+        ibdiag.print_fabric_summary(self.switches, self.endpoints, host_lids)
+        if self.args.report_file is not None:
+            with open(self.args.report_file, 'w') as outfile:
+                ibdiag.print_fabric_report(self.switches, self.endpoints, host_lids, outfile)
+        ibdiag.save_requested_snapshot(self.args, self.switches, self.endpoints)
+
+
+def get_arg_parser(description="ibdiag_watch: Keep an IB fabric model up to date by polling iblinkinfo"):
+    my_parser = ibdiag.get_arg_parser(description=description)
+    my_parser.add_argument("--watch_interval", dest="watch_interval", type=float, default=60,
+        help="seconds between 'iblinkinfo' polls")
+    my_parser.add_argument("--watch_count", dest="watch_count", type=int, default=0,
+        help="stop after this many polls (default 0: run until interrupted)")
+    my_parser.add_argument("--watch_full_routes", dest="watch_full_routes", type=int, default=0,
+        help="collect the routes of all switches every this many polls, not only of those that changed "
+             "(default 0: never)")
+    return my_parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    ibdiag.configure_logging(args)
+    ibdiag_metrics.configure(args)
+    watcher = FabricWatcher(args)
+    with ibdiag_metrics.span("load"):
+        watcher.load()
+    watcher.publish()
+    ibdiag_metrics.finish()
+    try:
+        while args.watch_count == 0 or watcher.polls < args.watch_count:
+            time.sleep(args.watch_interval)
+            if watcher.poll():
+                watcher.publish()
+    except KeyboardInterrupt:
+        pass
+    ibdiag.log.info(f"Stopped after {watcher.polls} polls.")
+
+
+if __name__ == '__main__':
+    main()
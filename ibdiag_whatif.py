@@ -0,0 +1,422 @@
+import ibdiag
+import ibdiag_metrics
+import ibdiag_snapshot
+import ibdiag_trace
+
+np = ibdiag.LazyModule("numpy")
+
+# What-if failure simulation: which host pairs lose their path when switches or ISLs go away, where
+# their routes move to and how the ISL load shifts.  Every route from an endpoint's switch to an
+# endpoint is traced once, as weighted source-switch flows, into a reverse index from each ISL direction
+# ("channel") to the flows that cross it.  A failure then only touches the flows the index lists for the
+# failed channels: the failed channels are masked out of the forwarding table arrays, the table entries
+# on the affected routes are repaired, the affected flows are traced again and the tables are restored,
+# so a sweep over every single ISL failure doesn't re-trace the fabric.
+#
+# The repair stands in for the subnet manager's reroute: each switch on an affected route, up to the
+# failed link, keeps or picks an exit port on a shortest remaining path to the destination (preferring
+# its current port, otherwise spreading destinations over the equal choices by LID), through neighbors
+# whose own routes are intact or already repaired.  Entries left without a path are dropped, and the
+# flows through them are counted as lost.
+
+MAX_PORTS = ibdiag_trace.MAX_PORTS
+NO_ROUTE = ibdiag_trace.NO_ROUTE
+
+
+class FailureResult:
+    # flows[i]: index (into the RouteIndex flows) of an affected flow, lost[i] whether it has no route
+    # after the failure; usage_before/usage_after: per-channel host pair counts
+    def __init__(self, channels, failed_switches, flows, lost, old_hops, new_hops, entries, usage_before,
+                 usage_after):
+        self.channels = channels
+        self.failed_switches = failed_switches
+        self.flows = flows
+        self.lost = lost
+        self.old_hops = old_hops
+        self.new_hops = new_hops
+        self.entries = entries          # (switch indexes, lids, old ports, new ports) of the repaired entries
+        self.usage_before = usage_before
+        self.usage_after = usage_after
+
+    def changed_entries(self):
+        _, _, old_ports, new_ports = self.entries
+        return int((old_ports != new_ports).sum())
+
+
+def get_path_channels(result):
+    # (channel, pair index) for every ISL hop of the traced paths: hop h leaves its switch through an
+    # ISL when the path has a hop h + 1
+    i, h = np.nonzero(result.path_switches[:, 1:] >= 0)
+    return result.path_switches[i, h].astype(np.int64) * MAX_PORTS + result.path_ports[i, h], i
+
+
+class RouteIndex:
+    # src[f], dst[f], weights[f]: source switch lid, destination endpoint lid and the number of host
+    # pairs of flow f; flows[indptr[c]:indptr[c + 1]] are the flows crossing channel c
+    def __init__(self, tables, chunk_size=1 << 18):
+        self.tables = tables
+        n = len(tables.switches)
+        lids = tables.endpoint_lids()
+        self.src, self.dst, self.weights = ibdiag_trace.source_switch_flows(tables, lids, lids)
+        self.usage = np.zeros(n * MAX_PORTS, dtype=np.int64)
+        channels, flows = [], []
+        for start in range(0, len(self.src), chunk_size):
+            end = start + chunk_size
+            result = ibdiag_trace.trace_routes(tables, self.src[start:end], self.dst[start:end],
+                                               self.weights[start:end])
+            self.usage += result.isl_usage.ravel()
+            path_channels, i = get_path_channels(result)
+            channels.append(path_channels)
+            flows.append((i + start).astype(np.int32))
+        channels = np.concatenate(channels) if channels else np.zeros(0, dtype=np.int64)
+        order = np.argsort(channels, kind='stable')
+        self.flows = np.concatenate(flows)[order] if flows else np.zeros(0, dtype=np.int32)
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(channels, minlength=n * MAX_PORTS))])
+        self.isl_channels = tables.isl_channels()
+        # the ISL ports of switch s are isl_channels[port_start[s]:port_start[s + 1]]
+        self.port_start = np.searchsorted(self.isl_channels, np.arange(n + 1) * MAX_PORTS)
+
+    def __len__(self):
+        return len(self.src)
+
+    def flows_through(self, channels):
+        if len(channels) == 0:
+            return np.zeros(0, dtype=np.int32)
+        return np.unique(np.concatenate([self.flows[self.indptr[c]:self.indptr[c + 1]] for c in channels]))
+
+    def reverse_channel(self, channel):
+        s, p = divmod(int(channel), MAX_PORTS)
+        return int(self.tables.neighbor[s, p]) * MAX_PORTS + int(self.tables.neighbor_port[s, p])
+
+    def link_channels(self):
+        # one channel per ISL (the lower numbered direction)
+        return [c for c in self.isl_channels.tolist() if c < self.reverse_channel(c)]
+
+    def switch_channels(self, s):
+        # every channel out of and into switch index s
+        out = self.isl_channels[self.port_start[s]:self.port_start[s + 1]]
+        return np.concatenate([out, [self.reverse_channel(c) for c in out.tolist()]]).astype(np.int64)
+
+    def get_candidates(self, x, d, channel_mask):
+        # every live ISL port of switch x[e] as a way to lid d[e]: (entry, channel, neighbor switch)
+        counts = self.port_start[x + 1] - self.port_start[x]
+        cand_entry = np.repeat(np.arange(len(x)), counts)
+        first = np.repeat(self.port_start[x] - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+        cand_channel = self.isl_channels[first + np.arange(len(cand_entry))]
+        keep = ~channel_mask[cand_channel]
+        cand_entry, cand_channel = cand_entry[keep], cand_channel[keep]
+        return cand_entry, cand_channel, self.tables.neighbor.ravel()[cand_channel]
+
+    def repair_entries(self, keys, channel_mask):
+        # keys: broken forwarding table entries, switch index * (max lid + 1) + lid.  Returns the entries
+        # repaired - those and the neighbors' entries found broken on the way - and a new exit channel
+        # (or -1) for each, found in rounds of increasing path length, Dijkstra fashion
+        t = self.tables
+        if len(keys) == 0:
+            return keys, keys, np.zeros(0, dtype=np.int64)
+        key_base = t.max_lid + 1
+        new_keys = keys
+        found = []
+        while len(new_keys) > 0:
+            x, d = new_keys // key_base, new_keys % key_base
+            cand_entry, cand_channel, cand_n = self.get_candidates(x, d, channel_mask)
+            cand_key = cand_n.astype(np.int64) * key_base + d[cand_entry]
+            pair_keys, inverse = np.unique(cand_key, return_inverse=True)
+            trace = ibdiag_trace.trace_routes(t, t.switch_lids[pair_keys // key_base], pair_keys % key_base,
+                                              count_usage=False)
+            ok = trace.status == ibdiag_trace.TRACE_OK
+            # a neighbor whose route runs into a failed channel needs repairing too, and can be used once it is
+            last = np.maximum(trace.hops - 1, 0)
+            rows = np.arange(len(pair_keys))
+            last_channel = (trace.path_switches[rows, last].astype(np.int64) * MAX_PORTS
+                            + trace.path_ports[rows, last])
+            broken = (trace.status == ibdiag_trace.TRACE_DEAD_PORT) & channel_mask[last_channel]
+            found.append((new_keys[cand_entry], cand_channel, cand_key,
+                          np.where(ok, trace.hops + 1, np.inf)[inverse]))
+            new_keys = np.setdiff1d(pair_keys[broken], keys)
+            keys = np.union1d(keys, new_keys)
+        entry_key, cand_channel, cand_key, val_intact = [np.concatenate(a) for a in zip(*found)]
+        order = np.argsort(entry_key, kind='stable')
+        entry_key, cand_channel, cand_key, val_intact = (entry_key[order], cand_channel[order], cand_key[order],
+                                                         val_intact[order])
+        x, d = keys // key_base, keys % key_base
+        cand_entry = np.searchsorted(keys, entry_key)
+        cand_ref = np.minimum(np.searchsorted(keys, cand_key), len(keys) - 1)
+        cand_ref[keys[cand_ref] != cand_key] = -1
+        current = cand_channel == x[cand_entry].astype(np.int64) * MAX_PORTS + t.lft[x, d][cand_entry]
+        fixed_val = np.full(len(x), np.inf)
+        chosen = np.full(len(x), -1, dtype=np.int64)
+        while True:
+            val = val_intact.copy()
+            ref = cand_ref >= 0
+            val[ref] = fixed_val[cand_ref[ref]] + 1
+            val[np.isfinite(fixed_val)[cand_entry]] = np.inf
+            best = np.full(len(x), np.inf)
+            np.minimum.at(best, cand_entry, val)
+            if not np.isfinite(best).any():
+                break
+            layer = best.min()
+            fix = best == layer
+            fixed_val[fix] = layer
+            eligible = fix[cand_entry] & (val == layer)
+            ce, cc, cur = cand_entry[eligible], cand_channel[eligible], current[eligible]
+            has_current = np.zeros(len(x), dtype=bool)
+            has_current[ce[cur]] = True
+            count = np.bincount(ce, minlength=len(x))
+            rank = np.arange(len(ce)) - (np.cumsum(count) - count)[ce]
+            pick = np.where(has_current[ce], cur, rank == d[ce] % np.maximum(count[ce], 1))
+            chosen[ce[pick]] = cc[pick]
+        return x, d, chosen
+
+    def simulate(self, channels, failed_switches=()):
+        # channels: failed channels, both directions of a failed ISL; failed_switches: switch indexes
+        t = self.tables
+        n = len(t.switches)
+        channels = np.unique(np.asarray(channels, dtype=np.int64))
+        failed_switches = np.asarray(failed_switches, dtype=np.int64)
+        affected = self.flows_through(channels)
+        src, dst, weights = self.src[affected], self.dst[affected], self.weights[affected]
+        before = ibdiag_trace.trace_routes(t, src, dst, weights, count_usage=False)
+        # flows from or to the endpoints of a failed switch have nowhere else to go
+        switch_down = np.zeros(n, dtype=bool)
+        switch_down[failed_switches] = True
+        stranded = switch_down[t.lid_switch[src]] | switch_down[t.lid_switch[dst]]
+        reroute = np.flatnonzero(~stranded)
+        channel_mask = np.zeros(n * MAX_PORTS, dtype=bool)
+        channel_mask[channels] = True
+        # the broken entries: every switch on an affected route up to its first failed channel
+        ps, pp = before.path_switches[reroute], before.path_ports[reroute]
+        on_path = ps >= 0
+        hit = on_path & channel_mask[np.where(on_path, ps, 0).astype(np.int64) * MAX_PORTS + pp]
+        first_hit = np.where(hit.any(axis=1), hit.argmax(axis=1), ps.shape[1])
+        i, h = np.nonzero(on_path & (np.arange(ps.shape[1])[None, :] <= first_hit[:, None]))
+        keys = np.unique(ps[i, h].astype(np.int64) * (t.max_lid + 1) + dst[reroute][i])
+        neighbor = t.neighbor.ravel()
+        saved_neighbor = neighbor[channels].copy()
+        neighbor[channels] = -1
+        try:
+            x, d, chosen = self.repair_entries(keys, channel_mask)
+            saved_lft = t.lft[x, d].copy()
+            new_ports = np.where(chosen >= 0, chosen % MAX_PORTS, NO_ROUTE).astype(np.uint8)
+            t.lft[x, d] = new_ports
+            try:
+                after = ibdiag_trace.trace_routes(t, src[reroute], dst[reroute], weights[reroute], count_usage=False)
+            finally:
+                t.lft[x, d] = saved_lft
+        finally:
+            neighbor[channels] = saved_neighbor
+        lost = stranded.copy()
+        lost[reroute] = after.status != ibdiag_trace.TRACE_OK
+        new_hops = np.zeros(len(affected), dtype=np.int32)
+        new_hops[reroute] = after.hops
+        new_hops[lost] = 0
+        # the load moves only on the channels of the old and new paths
+        usage_after = self.usage.copy()
+        old_channels, i = get_path_channels(before)
+        np.subtract.at(usage_after, old_channels, weights[i])
+        new_channels, i = get_path_channels(after)
+        np.add.at(usage_after, new_channels, weights[reroute][i])
+        return FailureResult(channels, failed_switches, affected, lost, before.hops, new_hops,
+                             (x, d, saved_lft, new_ports), self.usage, usage_after)
+
+
+def get_route_index(switches, endpoints):
+    return RouteIndex(ibdiag_trace.FabricTables(switches, endpoints))
+
+
+def find_switch(tables, name):
+    # switch index by name or lid
+    name = name.strip()
+    for i, sw in enumerate(tables.switches):
+        if sw.name == name or str(sw.lid) == name:
+            return i
+    raise ValueError(f"unknown switch '{name}'")
+
+
+def get_failure_channels(index, fail_switches=None, fail_links=None, fail_bundles=None):
+    # (failed channels, failed switch indexes) for comma separated "switch", "switch:port" and
+    # "switch/switch" lists; a failed link takes both of its directions
+    t = index.tables
+    channels, switch_index = [], []
+    for name in (fail_switches or "").split(",") if fail_switches else []:
+        s = find_switch(t, name)
+        switch_index.append(s)
+        channels.extend(index.switch_channels(s).tolist())
+    for link in fail_links.split(",") if fail_links else []:
+        name, _, port = link.rpartition(":")
+        s = find_switch(t, name)
+        if not port.isdigit() or t.neighbor[s, int(port)] < 0:
+            raise ValueError(f"'{link}' is not an ISL port")
+        channels.extend([s * MAX_PORTS + int(port), index.reverse_channel(s * MAX_PORTS + int(port))])
+    for bundle in fail_bundles.split(",") if fail_bundles else []:
+        a, _, b = bundle.partition("/")
+        sa, sb = find_switch(t, a), find_switch(t, b)
+        ports = np.flatnonzero(t.neighbor[sa] == sb)
+        if len(ports) == 0:
+            raise ValueError(f"no ISLs between {a} and {b}")
+        for p in ports.tolist():
+            channels.extend([sa * MAX_PORTS + p, index.reverse_channel(sa * MAX_PORTS + p)])
+    return sorted(set(channels)), sorted(set(switch_index))
+
+
+def get_load_shifts(index, result, top=20):
+    # [(channel, pairs before, pairs after), ...] of the ISLs that gained the most
+    isl = index.isl_channels
+    gain = result.usage_after[isl] - result.usage_before[isl]
+    order = np.argsort(-gain, kind='stable')[:top]
+    return [(int(isl[i]), int(result.usage_before[isl[i]]), int(result.usage_after[isl[i]]))
+            for i in order if gain[i] > 0]
+
+
+def print_failure_result(index, result, top=20):
+    t = index.tables
+    names = [t.switches[s].name for s in result.failed_switches.tolist()]
+    failed = set(result.failed_switches.tolist())
+    links = [t.channel_str(c) for c in result.channels.tolist() if c < index.reverse_channel(c)
+             and c // MAX_PORTS not in failed and index.reverse_channel(c) // MAX_PORTS not in failed]
+    print(f"--- What-if: {len(names)} switch(es) and {len(links)} ISL(s) failed")
+    for name in names:
+        print(f"    switch {name}")
+    for link in links[:top]:
+        print(f"    ISL {link}")
+    weights = index.weights[result.flows]
+    affected, lost = int(weights.sum()), int(weights[result.lost].sum())
+    print(f"    {affected} host pairs ({len(result.flows)} source switch/destination flows) lose their current path; "
+          f"{affected - lost} are rerouted and {lost} have no route left")
+    moved = ~result.lost
+    if moved.any():
+        longer = int(weights[moved & (result.new_hops > result.old_hops)].sum())
+        print(f"    {result.changed_entries()} forwarding table entries changed; {longer} rerouted host pairs take a "
+              f"longer path")
+    isl = index.isl_channels
+    print(f"    Host pairs per ISL: max {int(result.usage_before[isl].max(initial=0))} before, "
+          f"{int(result.usage_after[isl].max(initial=0))} after")
+    shifts = get_load_shifts(index, result, top)
+    if len(shifts) > 0:
+        print(f"    ISLs with the most added load:")
+        for channel, before, after in shifts:
+            print(f"        {before:8} -> {after:8} host pairs: {t.channel_str(channel)}")
+    lost_flows = result.flows[result.lost]
+    if len(lost_flows) > 0:
+        print(f"    Flows without a route, first {min(top, len(lost_flows))}:")
+        for f in lost_flows[:top].tolist():
+            print(f"        {t.switches[t.lid_switch[index.src[f]]].name} -> lid {index.dst[f]}: "
+                  f"{index.weights[f]} host pairs")
+
+
+def write_failure_csv(index, result, endpoints, filename):
+    t = index.tables
+    with open(filename, 'w') as outfile:
+        outfile.write("source_switch,source_switch_lid,dest_lid,dest_name,host_pairs,old_hops,new_hops,status\n")
+        for f, lost, old_hops, new_hops in zip(result.flows.tolist(), result.lost.tolist(), result.old_hops.tolist(),
+                                               result.new_hops.tolist()):
+            sw = t.switches[t.lid_switch[index.src[f]]]
+            dst = int(index.dst[f])
+            outfile.write(f'"{sw.name}",{sw.lid},{dst},"{endpoints[dst].name}",{index.weights[f]},{old_hops},'
+                          f'{"" if lost else new_hops},{"lost" if lost else "rerouted"}\n')
+
+
+def sweep_isl_failures(index):
+    # one row per ISL: (channel, affected host pairs, lost host pairs, max pairs per ISL after, most
+    # added pairs on one ISL)
+    isl = index.isl_channels
+    rows = []
+    for channel in index.link_channels():
+        result = index.simulate([channel, index.reverse_channel(channel)])
+        weights = index.weights[result.flows]
+        gain = result.usage_after[isl] - result.usage_before[isl]
+        rows.append((channel, int(weights.sum()), int(weights[result.lost].sum()),
+                     int(result.usage_after[isl].max(initial=0)), int(gain.max(initial=0))))
+    return rows
+
+
+def print_isl_sweep(index, rows, top=20):
+    isl = index.isl_channels
+    print(f"--- What-if sweep: every single ISL failure ({len(rows)} ISLs); host pairs per ISL now: max "
+          f"{int(index.usage[isl].max(initial=0))}")
+    losing = [r for r in rows if r[2] > 0]
+    print(f"    {len(losing)} ISL failures leave host pairs without a route")
+    for channel, affected, lost, max_after, gain in sorted(losing, key=lambda r: -r[2])[:top]:
+        print(f"        {lost:8} of {affected:8} host pairs lost: {index.tables.channel_str(channel)}")
+    print(f"    Largest load shifts onto one remaining ISL, first {min(top, len(rows))}:")
+    for channel, affected, lost, max_after, gain in sorted(rows, key=lambda r: (-r[4], -r[3]))[:top]:
+        print(f"        +{gain:<8} host pairs (max {max_after} per ISL after), {affected} host pairs moved: "
+              f"{index.tables.channel_str(channel)}")
+
+
+def write_isl_sweep_csv(index, rows, filename):
+    t = index.tables
+    with open(filename, 'w') as outfile:
+        outfile.write("switch,switch_lid,port,dest_switch,dest_lid,dest_port,affected_pairs,lost_pairs,"
+                      "max_pairs_per_isl,max_added_pairs\n")
+        for channel, affected, lost, max_after, gain in rows:
+            s, p = divmod(channel, MAX_PORTS)
+            d = t.switches[t.neighbor[s, p]]
+            outfile.write(f'"{t.switches[s].name}",{t.switches[s].lid},{p},"{d.name}",{d.lid},'
+                          f'{t.neighbor_port[s, p]},{affected},{lost},{max_after},{gain}\n')
+
+
+def get_arg_parser(description="ibdiag_whatif: Simulate switch and ISL failures in an IB fabric"):
+    my_parser = ibdiag.get_arg_parser(description=description)
+    my_parser.add_argument("--snapshot", dest="snapshot", default=None,
+        help="fabric snapshot file (--save_snapshot) to use instead of the input files or the fabric")
+    my_parser.add_argument("--fail_switch", dest="fail_switch", default=None,
+        help="comma separated list of switch names or LIDs to fail")
+    my_parser.add_argument("--fail_isl", dest="fail_isl", default=None,
+        help="comma separated list of <switch>:<port> ISLs to fail (both directions)")
+    my_parser.add_argument("--fail_bundle", dest="fail_bundle", default=None,
+        help="comma separated list of <switch>/<switch> pairs whose ISLs all fail")
+    my_parser.add_argument("--whatif_sweep", dest="whatif_sweep", action='store_true',
+        help="simulate the failure of every single ISL, one at a time")
+    my_parser.add_argument("--whatif_top", dest="whatif_top", type=int, default=20,
+        help="number of ISLs and flows listed in the reports")
+    my_parser.add_argument("--whatif_file", dest="whatif_file", default=None,
+        help="file name for a CSV file with every affected flow, or with --whatif_sweep every ISL's result")
+    return my_parser
+
+
+def main():
+    my_parser = get_arg_parser()
+    args = my_parser.parse_args()
+    if not (args.fail_switch or args.fail_isl or args.fail_bundle or args.whatif_sweep):
+        my_parser.error("one of --fail_switch, --fail_isl, --fail_bundle and --whatif_sweep is needed")
+    if args.skip_routing:
+        ibdiag.log.error(f"*** Error: failures can't be simulated with --skip_routing")
+        exit(1)
+    ibdiag.configure_logging(args)
+    ibdiag_metrics.configure(args)
+    with ibdiag_metrics.span("collect"):
+        if args.snapshot is not None:
+            switches, endpoints, _ = ibdiag_snapshot.load_snapshot(args.snapshot)
+        else:
+            switches, endpoints = ibdiag.load_fabric_cached(args)
+            ibdiag.save_requested_snapshot(args, switches, endpoints)
+    with ibdiag_metrics.span("index") as span:
+        index = get_route_index(switches, endpoints)
+        span.items = len(index)
+    if args.fail_switch or args.fail_isl or args.fail_bundle:
+        try:
+            channels, failed_switches = get_failure_channels(index, args.fail_switch, args.fail_isl, args.fail_bundle)
+        except ValueError as exc:
+            ibdiag.log.error(f"*** Error: {exc}")
+            exit(1)
+        with ibdiag_metrics.span("simulate") as span:
+            result = index.simulate(channels, failed_switches)
+            span.items = len(result.flows)
+        print_failure_result(index, result, args.whatif_top)
+        if args.whatif_file is not None and not args.whatif_sweep:
+            write_failure_csv(index, result, endpoints, args.whatif_file)
+            print(f"    Affected flows written to {args.whatif_file}")
+    if args.whatif_sweep:
+        with ibdiag_metrics.span("sweep") as span:
+            rows = sweep_isl_failures(index)
+            span.items = len(rows)
+        print_isl_sweep(index, rows, args.whatif_top)
+        if args.whatif_file is not None:
+            write_isl_sweep_csv(index, rows, args.whatif_file)
+            print(f"    Per-ISL results written to {args.whatif_file}")
+    ibdiag_metrics.finish()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,92 +1,181 @@
 import ibdiag
-import time
+import ibdiag_metrics
 import sys
-import xlsxwriter
-import xlsxwriter.worksheet    
 import argparse
 
-class IBWorksheet(xlsxwriter.worksheet.Worksheet):
-    def __init__(self):
-        super().__init__()
-        self.next_row = 0
-    
-    def write_next_row(self, data, cell_format = None):
-        self.write_row(self.next_row, 0, data, cell_format=cell_format)
-        self.next_row += 1
-
-    def set_column_widths(self, widths_list):
-        for i, w in enumerate(widths_list):
-            self.set_column(i, i, w)
-
-class IBWorkbook(xlsxwriter.Workbook):
-    def __init__(self, filename):
-        xlsxwriter.Workbook.__init__(self, filename)
-        self.bold = self.add_format()
-        self.bold.set_bold()
-        self.sheets = {}
-
-    def add_worksheets(self, name_tab_tuples):
-        for name, tab in name_tab_tuples:
-            self.sheets[name] = self.add_worksheet(name=tab, worksheet_class=IBWorksheet)
+# Excel's limits: rows per sheet (including the header row) and characters per cell
+XLSX_MAX_ROWS = 1048576
+XLSX_MAX_CELL_CHARS = 32767
+XLSX_OVERFLOW_MODES = ["split", "truncate"]
+
+_workbook_classes = None
+
+def get_workbook_classes():
+    # xlsxwriter is only imported when a workbook is written; the classes derived from its types are
+    # built on first use
+    global _workbook_classes
+    if _workbook_classes is not None:
+        return _workbook_classes
+    import xlsxwriter
+    import xlsxwriter.worksheet
+
+    class IBWorksheet(xlsxwriter.worksheet.Worksheet):
+        def __init__(self):
+            super().__init__()
+            self.next_row = 0
+
+        def write_next_row(self, data, cell_format = None):
+            data = [d if not isinstance(d, str) or len(d) <= XLSX_MAX_CELL_CHARS
+                    else d[:XLSX_MAX_CELL_CHARS - 4] + " ..." for d in data]
+            self.write_row(self.next_row, 0, data, cell_format=cell_format)
+            self.next_row += 1
+
+        def set_column_widths(self, widths_list):
+            for i, w in enumerate(widths_list):
+                self.set_column(i, i, w)
+
+    class IBWorkbook(xlsxwriter.Workbook):
+        # constant_memory: xlsxwriter keeps only the current row of each sheet and streams the rest to a
+        # temporary file, so every sheet has to be written strictly in row order
+        def __init__(self, filename):
+            xlsxwriter.Workbook.__init__(self, filename, {'constant_memory': True})
+            self.bold = self.add_format()
+            self.bold.set_bold()
+            self.sheets = {}
+
+        def add_ib_worksheet(self, tab, header, widths):
+            sheet = self.add_worksheet(name=tab, worksheet_class=IBWorksheet)
+            sheet.set_column_widths(widths)
+            sheet.write_next_row(header, self.bold)
+            return sheet
+
+    _workbook_classes = (IBWorkbook, IBWorksheet)
+    return _workbook_classes
 
 def open_xlsx(outfile):
-    wb = IBWorkbook(outfile)
-    wb.add_worksheets([('switches', 'Switches'), ('sw_ports', 'All Up Ports'), ('isls', 'ISLs'), 
-        ('endpoints', 'Endpoints'), ('routes', 'Routes'), ('downports', 'Down Ports'),
-        ('lidroutes', 'Routes by Lid')])
-
-    wb.sheets['switches'].write_next_row(["Switch Name", "Switch LID", "# Ports", "# ISLs", "# Endpoints"], wb.bold)
-    wb.sheets['switches'].set_column_widths([30, 8, 7, 7, 11])
-    wb.sheets['sw_ports'].write_next_row(["Switch Name", "Switch LID", "Switch Port", "Connected Name", "Connected Lid"], wb.bold)
-    wb.sheets['sw_ports'].set_column_widths([30, 8, 10, 30, 12])
-    wb.sheets['endpoints'].write_next_row(["Switch Name", "Switch LID", "Switch Port", "Endpoint name", "Endpoint Lid", "Speed"], wb.bold)
-    wb.sheets['endpoints'].set_column_widths([30, 8, 10, 30, 10, 8])
-    wb.sheets['isls'].write_next_row(["Switch Name", "Switch LID", "Switch Port", "Dest Switch", "Dest Lid", "Dest Port", "Speed"], wb.bold)
-    wb.sheets['isls'].set_column_widths([30, 8, 10, 30, 8, 10, 8])
-    wb.sheets['downports'].write_next_row(["Switch Name", "Switch LID", "Switch Port"], wb.bold)
-    wb.sheets['downports'].set_column_widths([30, 8, 10, 2, 2])
-    wb.sheets['routes'].write_next_row(["Switch Name", "Switch LID", "Switch Port", "# LID Routes", "LIDs Routed via this port"], wb.bold)
-    wb.sheets['routes'].set_column_widths([30, 8, 10, 10, 100])
-    wb.sheets['lidroutes'].write_next_row(["Endpoint Name", "Endpoint LID", "Exits via port", "on Switch"], wb.bold)
-    wb.sheets['lidroutes'].set_column_widths([30, 20, 20, 20, 20])
-    return wb
-
-def write_xlsx(switches, endpoints, outfile):
-    wb = open_xlsx(outfile)
-    for switchnum, (k, s) in enumerate(switches.items()):
-        switchpp = f"{s.name} ({s.lid})"
-        wb.sheets['switches'].write_next_row([switchpp, s.lid, int(s.portcount), len(s.isls), len(s.endpoints)])
+    workbook_class, _ = get_workbook_classes()
+    return workbook_class(outfile)
+
+def switch_pp(s):
+    return f"{s.name} ({s.lid})"
+
+def iter_port_connections(switches):
+    # (switch, port, connected lid, connected display name) for every up port, in switch/port order
+    for s in switches.values():
         for portnum in range(0, int(s.portcount)):
             if portnum in s.connections.keys():
                 dest_lid = s.connections[portnum].lid
                 dest_name = s.connections[portnum].name
                 if dest_lid in switches.keys():
                     dest_name = f"{dest_name} ({dest_lid})"
-                wb.sheets['sw_ports'].write_next_row([switchpp, s.lid, portnum, dest_name, dest_lid])
-                if dest_lid in switches.keys():
-                    _, port, speedinfo = s.isls[portnum]
-                    speedinfo = ibdiag.short_speed_info(speedinfo)
-                    wb.sheets['isls'].write_next_row([switchpp, s.lid, portnum, dest_name, dest_lid, port, speedinfo])
-                    if portnum in s.routes_by_port.keys():
-                        wb.sheets['routes'].write_next_row([switchpp, s.lid, portnum, len(s.routes_by_port[portnum]), 
-                            ' '.join(str(r) for r in s.routes_by_port[portnum])])
-                else:
-                    speedinfo = s.endpoints[portnum].speed
-                    speedinfo = ibdiag.short_speed_info(speedinfo)
-                    wb.sheets['endpoints'].write_next_row([switchpp, s.lid, portnum, dest_name, dest_lid, speedinfo])
-                if portnum in s.routes_by_port.keys():
-                    for r in s.routes_by_port[portnum]:
-                        if r in endpoints.keys():
-                            name = endpoints[r].name
-                            wb.sheets['lidroutes'].write_next_row([name, r, portnum, switchpp])
-            else:
-                wb.sheets['downports'].write_next_row([switchpp, s.lid, portnum])
+                yield s, portnum, dest_lid, dest_name
+
+def iter_switch_rows(switches, endpoints):
+    for s in switches.values():
+        yield [switch_pp(s), s.lid, int(s.portcount), len(s.isls), len(s.endpoints)]
+
+def iter_sw_port_rows(switches, endpoints):
+    for s, portnum, dest_lid, dest_name in iter_port_connections(switches):
+        yield [switch_pp(s), s.lid, portnum, dest_name, dest_lid]
+
+def iter_isl_rows(switches, endpoints):
+    for s, portnum, dest_lid, dest_name in iter_port_connections(switches):
+        if dest_lid in switches.keys():
+            _, port, speedinfo = s.isls[portnum]
+            yield [switch_pp(s), s.lid, portnum, dest_name, dest_lid, port, ibdiag.short_speed_info(speedinfo)]
+
+def iter_endpoint_rows(switches, endpoints):
+    for s, portnum, dest_lid, dest_name in iter_port_connections(switches):
+        if dest_lid not in switches.keys():
+            speedinfo = ibdiag.short_speed_info(s.endpoints[portnum].speed)
+            yield [switch_pp(s), s.lid, portnum, dest_name, dest_lid, speedinfo]
+
+def iter_route_rows(switches, endpoints):
+    for s, portnum, dest_lid, dest_name in iter_port_connections(switches):
+        if dest_lid in switches.keys() and portnum in s.routes_by_port.keys():
+            lids = s.routes_by_port[portnum]
+            yield [switch_pp(s), s.lid, portnum, len(lids), ' '.join(str(r) for r in lids)]
+
+def iter_route_balance_rows(switches, endpoints):
+    if all(len(s.routes) == 0 for s in switches.values()):
+        return
+    import ibdiag_balance
+    balance = ibdiag_balance.get_route_balance(switches, endpoints)
+    for s, d, ports, lids, low, high, mean, stddev, imbalance, bad in ibdiag_balance.iter_balance_rows(balance):
+        yield [switch_pp(s), s.lid, "(all ISLs)" if d is None else switch_pp(d), None if d is None else d.lid,
+               ports, lids, low, high, round(mean, 2), round(stddev, 2), round(imbalance, 3), "yes" if bad else ""]
+
+def iter_downport_rows(switches, endpoints):
+    for s in switches.values():
+        for portnum in range(0, int(s.portcount)):
+            if portnum not in s.connections.keys():
+                yield [switch_pp(s), s.lid, portnum]
+
+def iter_lidroute_rows(switches, endpoints):
+    for s, portnum, dest_lid, dest_name in iter_port_connections(switches):
+        if portnum in s.routes_by_port.keys():
+            for r in s.routes_by_port[portnum]:
+                if r in endpoints.keys():
+                    yield [endpoints[r].name, r, portnum, switch_pp(s), s.lid]
+
+# (tab name, header, column widths, row generator) in tab order; each sheet is written in its own pass
+XLSX_SHEETS = [
+    ('Switches', ["Switch Name", "Switch LID", "# Ports", "# ISLs", "# Endpoints"],
+        [30, 8, 7, 7, 11], iter_switch_rows),
+    ('All Up Ports', ["Switch Name", "Switch LID", "Switch Port", "Connected Name", "Connected Lid"],
+        [30, 8, 10, 30, 12], iter_sw_port_rows),
+    ('ISLs', ["Switch Name", "Switch LID", "Switch Port", "Dest Switch", "Dest Lid", "Dest Port", "Speed"],
+        [30, 8, 10, 30, 8, 10, 8], iter_isl_rows),
+    ('Endpoints', ["Switch Name", "Switch LID", "Switch Port", "Endpoint name", "Endpoint Lid", "Speed"],
+        [30, 8, 10, 30, 10, 8], iter_endpoint_rows),
+    ('Routes', ["Switch Name", "Switch LID", "Switch Port", "# LID Routes", "LIDs Routed via this port"],
+        [30, 8, 10, 10, 100], iter_route_rows),
+    ('Route Balance', ["Switch Name", "Switch LID", "Neighbor Switch", "Neighbor LID", "# ISL Ports", "# LIDs Routed",
+                       "Min LIDs", "Max LIDs", "Mean LIDs", "Stddev", "Max/Mean", "Out of Balance"],
+        [30, 8, 30, 12, 10, 12, 9, 9, 10, 8, 9, 14], iter_route_balance_rows),
+    ('Down Ports', ["Switch Name", "Switch LID", "Switch Port"],
+        [30, 8, 10, 2, 2], iter_downport_rows),
+    ('Routes by Lid', ["Endpoint Name", "Endpoint LID", "Exits via port", "on Switch", "Switch LID"],
+        [30, 20, 20, 20, 10], iter_lidroute_rows),
+]
+
+def write_sheet(wb, tab, header, widths, rows, max_rows=XLSX_MAX_ROWS, overflow="split"):
+    # a full sheet continues on "<tab> (2)", "<tab> (3)", ... or, with overflow "truncate", the rest is dropped
+    sheet = wb.add_ib_worksheet(tab, header, widths)
+    part = 1
+    for row in rows:
+        if sheet.next_row >= max_rows:
+            if overflow == "truncate":
+                dropped = 1 + sum(1 for _ in rows)
+                ibdiag.log.warning(f"*** Warning: sheet '{tab}' truncated at {max_rows} rows; {dropped} rows not "
+                                   f"written")
+                break
+            part += 1
+            sheet = wb.add_ib_worksheet(f"{tab} ({part})", header, widths)
+        sheet.write_next_row(row)
+
+def write_xlsx(switches, endpoints, outfile, max_rows=XLSX_MAX_ROWS, overflow="split"):
+    wb = open_xlsx(outfile)
+    for tab, header, widths, row_func in XLSX_SHEETS:
+        write_sheet(wb, tab, header, widths, row_func(switches, endpoints), max_rows, overflow)
     wb.close()
 
+def xlsx_max_rows_arg(value):
+    rows = int(value)
+    if not 2 <= rows <= XLSX_MAX_ROWS:
+        raise argparse.ArgumentTypeError(f"must be between 2 and {XLSX_MAX_ROWS}")
+    return rows
+
 def get_arg_parser(description="ibdiag_xlsx: Generate IB excel data file"):
     my_parser = ibdiag.get_arg_parser(description=description)
     my_parser.add_argument("--xlsx_file", dest="xlsx_file", default="ibdiag.xlsx",
                            help="file name for .xlsx output file")
+    my_parser.add_argument("--xlsx_max_rows", dest="xlsx_max_rows", type=xlsx_max_rows_arg, default=XLSX_MAX_ROWS,
+                           help=f"rows per sheet, including the header row (default and maximum: Excel's "
+                                f"{XLSX_MAX_ROWS})")
+    my_parser.add_argument("--xlsx_overflow", dest="xlsx_overflow", choices=XLSX_OVERFLOW_MODES, default="split",
+                           help="what to do with the rows of a sheet beyond --xlsx_max_rows: continue them on "
+                                "extra sheets, or drop them")
     return my_parser
 
 def get_args(allow_unknown_args=False):
@@ -95,12 +184,14 @@ def get_args(allow_unknown_args=False):
     return a
 
 def main():
-    time_a = time.time()
     args = get_args()
+    ibdiag.configure_logging(args)
+    ibdiag_metrics.configure(args)
     switches, endpoints = ibdiag.do_diag_run(args)
-    write_xlsx(switches, endpoints, args.xlsx_file)
-    time_c = time.time()
-    print(f"run took: {time_c - time_a}")
+    with ibdiag_metrics.span("xlsx") as span:
+        write_xlsx(switches, endpoints, args.xlsx_file, args.xlsx_max_rows, args.xlsx_overflow)
+        span.items = len(switches)
+    ibdiag_metrics.finish()
 
 def use_ucon_sample_data():
     if len(sys.argv) == 1:
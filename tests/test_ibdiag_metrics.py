@@ -0,0 +1,42 @@
+import os
+import tempfile
+import unittest
+
+import ibdiag_metrics
+
+
+def busy(n):
+    return sum(i * i for i in range(n))
+
+
+class NestedProfileTest(unittest.TestCase):
+    def test_nested_profiled_spans(self):
+        with tempfile.TemporaryDirectory() as profile_dir:
+            metrics = ibdiag_metrics.PhaseMetrics()
+            metrics.configure(profile="all", profile_dir=profile_dir)
+            with metrics.span("outer"):
+                with metrics.span("inner") as inner:
+                    busy(10000)
+                    inner.items = 1
+                with metrics.span("inner2"):
+                    busy(10000)
+            # only the outermost span is profiled, and the nested spans are still timed
+            self.assertEqual(os.listdir(profile_dir), ["profile-outer.prof"])
+            self.assertIsNone(metrics.profiler)
+            self.assertEqual([name for name, _ in metrics.spans], ["outer", "outer.inner", "outer.inner2"])
+            self.assertEqual(metrics.spans[1][1].items, 1)
+
+    def test_sibling_profiled_spans(self):
+        with tempfile.TemporaryDirectory() as profile_dir:
+            metrics = ibdiag_metrics.PhaseMetrics()
+            metrics.configure(profile="parse,route", profile_dir=profile_dir)
+            with metrics.span("load"):
+                with metrics.span("parse"):
+                    busy(1000)
+                with metrics.span("route"):
+                    busy(1000)
+            self.assertEqual(sorted(os.listdir(profile_dir)), ["profile-load.parse.prof", "profile-load.route.prof"])
+
+
+if __name__ == '__main__':
+    unittest.main()